@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# Node sync agent, long-polls the portal and keeps the local BIND zone set up to date
+# Usage: ./agent.py https://portal.example.com [/etc/bind]
+
+import asyncio
+import json
+import os
+import sys
+
+import aiohttp
+
+LOCAL_TEMPLATE = 'zone "{zone}" {{\n  type master;\n  file "{path}";\n}};\n'
+
+# rndc reloads run at once
+RELOAD_CONCURRENCY = 16
+
+# Above this many changed zones a single rndc reload of every zone is cheaper than one per zone
+RELOAD_ALL_OVER = 500
+
+
+def _write_atomic(path, data):
+    """
+    Write a file so readers see either the old or the new content
+    :param path: File path
+    :param data: File content
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+async def _rndc(*args):
+    """
+    Run an rndc command
+    :return: True if rndc succeeded
+    """
+    process = await asyncio.create_subprocess_exec("rndc", *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        print("rndc " + " ".join(args) + " failed: " + stderr.decode().strip())
+    return process.returncode == 0
+
+
+async def _lines(content, chunk_size=1 << 16):
+    """
+    Split a response body into lines of any length, aiohttp's line reader rejects lines over its buffer size
+    :param content: aiohttp StreamReader
+    :param chunk_size: Bytes to read at a time
+    :return: async generator of lines without the newline
+    """
+    buffer = b""
+    async for chunk in content.iter_chunked(chunk_size):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+
+    if buffer:
+        yield buffer
+
+
+class NodeAgent:
+    def __init__(self, portal, bind_dir="/etc/bind", timeout=30, reload_concurrency=RELOAD_CONCURRENCY, reload_all_over=RELOAD_ALL_OVER):
+        self.portal = portal.rstrip("/")
+        self.bind_dir = bind_dir
+        self.timeout = timeout
+        self.reload_concurrency = reload_concurrency
+        self.reload_all_over = reload_all_over
+
+        self._state_path = os.path.join(bind_dir, "delivr-agent.json")
+        self.state = {"version": None, "export": None, "zones": []}
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r") as state_file:
+                self.state = json.load(state_file)
+
+    async def wait_for_change(self, session):
+        """
+        Long-poll the portal until the zone set version changes
+        :return: new zone set version
+        """
+        params = {"timeout": self.timeout}
+        if self.state["version"]:
+            params["version"] = self.state["version"]
+
+        async with session.get(self.portal + "/export/wait", params=params, timeout=aiohttp.ClientTimeout(total=self.timeout + 15)) as response:
+            response.raise_for_status()
+            return (await response.json())["version"]
+
+    async def _reload(self, zones):
+        """
+        Reload zones with a bounded number of rndc processes, or all zones at once when there are many
+        :param zones: Zones to reload
+        :return: True if every reload succeeded
+        """
+        if len(zones) > self.reload_all_over:
+            return await _rndc("reload")
+
+        semaphore = asyncio.Semaphore(self.reload_concurrency)
+
+        async def reload(zone):
+            async with semaphore:
+                return await _rndc("reload", zone)
+
+        return all(await asyncio.gather(*[reload(zone) for zone in zones]))
+
+    async def sync(self, session):
+        """
+        Download changed zones, write them and reload them
+        The export version is only kept once BIND has the zones, so a failed sync is sent again in full
+        """
+        params = {"format": "ndjson"}
+        if self.state["export"]:
+            params["since"] = self.state["export"]
+
+        zones = set(self.state["zones"])
+        export = None
+        changed = []
+        deleted = []
+
+        async with session.get(self.portal + "/export/zones", params=params) as response:
+            response.raise_for_status()
+            full = "X-Export-Since" not in response.headers
+            seen = set()
+
+            # A zone can be megabytes on a single line
+            async for line in _lines(response.content):
+                if not line.strip():
+                    continue
+
+                entry = json.loads(line)
+                if "version" in entry:
+                    export = entry["version"]
+                elif entry["data"] is None:
+                    deleted.append(entry["zone"])
+                else:
+                    seen.add(entry["zone"])
+                    _write_atomic(os.path.join(self.bind_dir, "db." + entry["zone"]), entry["data"])
+                    changed.append(entry["zone"])
+
+        if full:
+            deleted = list(zones - seen)
+
+        new_zones = (zones | set(changed)) - set(deleted)
+        if new_zones != zones:
+            # Zone set changed, rewrite named.conf.local and let BIND pick up added and removed zones
+            _write_atomic(os.path.join(self.bind_dir, "named.conf.local"), "".join(
+                LOCAL_TEMPLATE.format(zone=zone, path=os.path.join(self.bind_dir, "db." + zone)) for zone in sorted(new_zones)))
+            if not await _rndc("reconfig"):
+                raise RuntimeError("rndc reconfig failed")
+
+            for zone in deleted:
+                path = os.path.join(self.bind_dir, "db." + zone)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if not await self._reload([zone for zone in changed if zone in zones]):
+            raise RuntimeError("rndc reload failed")
+
+        self.state["zones"] = sorted(new_zones)
+        self.state["export"] = export
+        print("Synced " + str(len(changed)) + " changed and " + str(len(deleted)) + " deleted zones")
+
+    async def run(self):
+        """
+        Sync forever, backing off on errors
+        """
+        backoff = 1
+        async with aiohttp.ClientSession(headers={"Accept-Encoding": "gzip"}) as session:
+            while True:
+                try:
+                    version = await self.wait_for_change(session)
+                    if version != self.state["version"]:
+                        await self.sync(session)
+                        self.state["version"] = version
+                        _write_atomic(self._state_path, json.dumps(self.state))
+                    backoff = 1
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    print("Portal unavailable (" + str(e) + "), retrying in " + str(backoff) + "s")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+                except Exception as e:
+                    # Bad responses or local write errors must not stop the agent, the next sync starts over
+                    print("Sync failed (" + type(e).__name__ + ": " + str(e) + "), retrying in " + str(backoff) + "s")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage ./agent.py https://portal.example.com [/etc/bind]")
+        exit(1)
+
+    asyncio.run(NodeAgent(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "/etc/bind").run())
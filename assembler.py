@@ -1,14 +1,137 @@
+import json
+import os
+import random
 import sys
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+LOCAL_TEMPLATE = 'zone "{zone}" {{\n  type master;\n  file "/etc/bind/db.{zone}";\n}};\n'
 
 try:
     portal_url = sys.argv[1]
-except KeyError:
-    print("Usage ./assembler.py https://portal.example.com/export")
+except IndexError:
+    print("Usage ./assembler.py https://portal.example.com/export/zones [staging directory] [poll interval]")
     exit(1)
 
-zones = requests.get(portal_url).json()
+staging_dir = sys.argv[2] if len(sys.argv) > 2 else "staging"
+poll_interval = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+
+def _write_atomic(path, data):
+    """
+    Write a file so readers see either the old or the new content
+    :param path: File path
+    :param data: File content
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _session():
+    """
+    Keep-alive session that retries connection errors and 5xx responses with exponential backoff
+    :return: requests session
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], allowed_methods=["GET"])
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
+
+
+def fetch(session, state):
+    """
+    Fetch changed zones into the staging directory
+    :param session: requests session
+    :param state: State of the last fetch, updated in place
+    :return: True if anything changed
+    """
+    headers = {}
+    params = {"format": "ndjson"}
+    if state.get("etag"):
+        headers["If-None-Match"] = '"' + state["etag"] + '"'
+    if state.get("export"):
+        params["since"] = state["export"]
+
+    with session.get(portal_url, headers=headers, params=params, stream=True, timeout=(5, 60)) as response:
+        if response.status_code == 304:
+            return False  # Nothing changed
+
+        response.raise_for_status()
+        full = "X-Export-Since" not in response.headers
+
+        zones = set(state.get("zones", []))
+        seen = set()
+        deleted = set()
+
+        # One zone per line, decompressed as it streams. The last line holds the export version
+        for line in response.iter_lines():
+            if not line:
+                continue
+
+            entry = json.loads(line)
+            if "version" in entry:
+                state["export"] = entry["version"]
+            elif entry["data"] is None:
+                deleted.add(entry["zone"])
+            else:
+                seen.add(entry["zone"])
+                _write_atomic(os.path.join(staging_dir, "db." + entry["zone"]), entry["data"])
+
+        state["etag"] = response.headers.get("ETag", "").strip('"') or None
+
+    if full:
+        deleted = zones - seen
+
+    new_zones = (zones | seen) - deleted
+    for zone in deleted:
+        path = os.path.join(staging_dir, "db." + zone)
+        if os.path.exists(path):
+            os.remove(path)
+
+    if new_zones != zones or not os.path.exists(os.path.join(staging_dir, "named.conf.local")):
+        _write_atomic(os.path.join(staging_dir, "named.conf.local"), "".join(LOCAL_TEMPLATE.format(zone=zone) for zone in sorted(new_zones)))
+
+    state["zones"] = sorted(new_zones)
+    print("Fetched " + str(len(seen)) + " changed and " + str(len(deleted)) + " deleted zones")
+    return True
+
+
+if __name__ == "__main__":
+    os.makedirs(staging_dir, exist_ok=True)
+
+    state_path = os.path.join(staging_dir, ".assembler.json")
+    fetch_state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as state_file:
+            fetch_state = json.load(state_file)
+
+    http = _session()
+    backoff = 1
+    while True:
+        try:
+            if fetch(http, fetch_state):
+                _write_atomic(state_path, json.dumps(fetch_state))
+            backoff = 1
+        except (requests.RequestException, ValueError) as e:
+            # Retries are exhausted or the response was broken, a later poll starts over
+            if poll_interval is None:
+                print("Fetch failed: " + str(e))
+                exit(1)
+
+            delay = backoff * random.uniform(0.5, 1.5)
+            print("Fetch failed (" + str(e) + "), retrying in " + str(round(delay, 1)) + "s")
+            time.sleep(delay)
+            backoff = min(backoff * 2, 300)
+            continue
 
-for zone in zones:
-    print(zones[zone])
+        if poll_interval is None:
+            break
+        time.sleep(poll_interval)
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# Time the zone linter across many zones
+# Run from the repository root: python3 -m benchmarks.lint [records] [zones]
+
+import sys
+from time import perf_counter
+
+from lib.linter import lint_zones
+
+TYPES = [
+    ("A", "192.0.2.{}"),
+    ("AAAA", "2001:db8::{:x}"),
+    ("MX", "10 mail{}.example.net."),
+    ("TXT", "\"v=spf1 include:{}.example.net -all\""),
+    ("CNAME", "target{}.example.net."),
+]
+
+
+def _zones(records, zones):
+    per_zone = records // zones
+    return [{
+        "zone": "zone" + str(z) + ".example",
+        "records": [{
+            "domain": "host" + str(i),
+            "type": TYPES[i % len(TYPES)][0],
+            "value": TYPES[i % len(TYPES)][1].format(i % 256),
+            "ttl": "3600"
+        } for i in range(per_zone)]
+    } for z in range(zones)]
+
+
+if __name__ == "__main__":
+    record_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    zone_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    zones = _zones(record_count, zone_count)
+
+    start = perf_counter()
+    results = lint_zones(zones)
+    elapsed = perf_counter() - start
+
+    print("records:  %d in %d zones" % (record_count, zone_count))
+    print("lint:     %.3fs (%.0f records/s)" % (elapsed, record_count / elapsed))
+    print("errors:   %d zones" % len(results))
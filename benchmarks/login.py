@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# Measure login throughput and its effect on concurrent read traffic
+# Run from the repository root: python3 -m benchmarks.login [logins] [readers]
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from lib.auth import hash_password, verify_password
+from lib.renderer import serialize_zone
+
+RECORDS = [{"domain": "host" + str(i), "type": "A", "value": "192.0.2." + str(i % 256), "ttl": "3600"} for i in range(2000)]
+
+
+def _reader(stop, latencies):
+    # Stand-in for dashboard and export requests
+    while not stop.is_set():
+        start = perf_counter()
+        serialize_zone(1, RECORDS, ["ns1.example.com"], "root.example.com")
+        latencies.append(perf_counter() - start)
+
+
+def _read_latency(readers, seconds, during=None):
+    stop = threading.Event()
+    latencies = []
+    threads = [threading.Thread(target=_reader, args=(stop, latencies)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+
+    result = during() if during else threading.Event().wait(seconds)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return result, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], len(latencies)
+
+
+if __name__ == "__main__":
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    stored, _ = hash_password("correct horse battery staple")
+
+    def burst():
+        # Request threads all trying to log in at once
+        start = perf_counter()
+        with ThreadPoolExecutor(32) as requests:
+            results = list(requests.map(lambda _: verify_password(stored, "wrong password"), range(logins)))
+        elapsed = perf_counter() - start
+        return elapsed, sum(1 for result in results if result[2])
+
+    _, idle_p50, idle_p99, idle_reads = _read_latency(readers, 3)
+    (elapsed, rejected), burst_p50, burst_p99, burst_reads = _read_latency(readers, 0, burst)
+
+    print("logins:        %d in %.2fs (%.1f/s), %d rejected by queue limit" % (logins, elapsed, (logins - rejected) / elapsed, rejected))
+    print("reads idle:    p50 %.2fms p99 %.2fms (%d reads)" % (idle_p50 * 1000, idle_p99 * 1000, idle_reads))
+    print("reads burst:   p50 %.2fms p99 %.2fms (%d reads)" % (burst_p50 * 1000, burst_p99 * 1000, burst_reads))
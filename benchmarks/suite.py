@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# Seed synthetic tenants and time the portal's hot paths
+# Run from the repository root:
+#   python3 -m benchmarks.suite --scale small --output bench.json
+#   python3 -m benchmarks.suite --scale small --baseline bench.json
+# --mongomock uses an in-process stand-in instead of a local mongod, if mongomock is installed
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from bson.objectid import ObjectId
+
+from lib.aggregator import build_manifest, build_zones, stream_zones
+from lib.database import CDNDatabase
+from lib.exporter import build_zones as export_zones
+
+# users, zones, records
+SCALES = {
+    "tiny": (10, 100, 10000),
+    "small": (100, 10000, 1000000),
+    "medium": (1000, 100000, 10000000),
+}
+
+
+def _seed(db, users, zones, records):
+    """
+    Insert synthetic users, zones and records directly
+    Collections are emptied rather than dropped, so the indexes built by the migrations stay in place
+    """
+    for collection in ("users", "zones", "journal", "record_search", "nodes"):
+        db._db[collection].delete_many({})
+
+    user_ids = [ObjectId() for _ in range(users)]
+    per_zone = records // zones
+    batch = []
+    user_zones = {user: [] for user in user_ids}
+
+    for z in range(zones):
+        zone_id = ObjectId()
+        owner = user_ids[z % users]
+        user_zones[owner].append(zone_id)
+        batch.append({
+            "_id": zone_id,
+            "zone": "zone" + str(z) + ".example",
+            "users": [owner],
+            "serial": 2020091400,
+            "records": [{
+                "id": ObjectId(),
+                "domain": "host" + str(r),
+                "type": "A",
+                "value": "192.0.2." + str(r % 256),
+                "ttl": "3600"
+            } for r in range(per_zone)]
+        })
+
+        if len(batch) >= 100:
+            db._db["zones"].insert_many(batch, ordered=False)
+            batch = []
+
+    if batch:
+        db._db["zones"].insert_many(batch, ordered=False)
+
+    db._db["users"].insert_many([{
+        "_id": user,
+        "username": "user" + str(index) + "@example.com",
+        "password": "",
+        "zones": user_zones[user]
+    } for index, user in enumerate(user_ids)], ordered=False)
+
+    db._db["nodes"].insert_many([{
+        "uid": "pop" + str(n) + "-us",
+        "location": "PoP " + str(n),
+        "management": "192.0.2." + str(n),
+        "operational": True
+    } for n in range(20)])
+
+    db.reconcile_counters(settle=0)
+    return user_ids
+
+
+def _time(db, func, iterations):
+    """
+    Time a function inside a simulated request
+    :return: {"p50", "p95", "mean", "queries"}, seconds and queries per call, queries is None if they can't be counted
+    """
+    times = []
+    queries = []
+    for _ in range(iterations):
+        db.begin_request()
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+        queries.append(db.end_request())
+
+    times.sort()
+    return {
+        "p50": round(times[len(times) // 2], 6),
+        "p95": round(times[min(int(len(times) * 0.95), len(times) - 1)], 6),
+        "mean": round(statistics.mean(times), 6),
+        "queries": round(statistics.mean(queries), 1) if db.counts_queries else None
+    }
+
+
+def run(db, scale, iterations):
+    users, zones, records = SCALES[scale]
+
+    start = perf_counter()
+    user_ids = _seed(db, users, zones, records)
+    results = {"seed": {"seconds": round(perf_counter() - start, 3)}}
+
+    user = str(user_ids[0])
+    zone = "zone0.example"
+    added = []
+
+    def dashboard():
+        db.get_dashboard(user)
+        db.get_nodes()
+
+    def records_view():
+        db.authorized_for_zone(user, zone)
+        db.get_records(zone, 0, 100)
+
+    def record_add():
+        db.authorized_for_zone(user, zone)
+        db.add_record(zone, "bench" + str(len(added)), "A", "192.0.2.1", "60")
+        added.append(len(added))
+
+    def record_delete():
+        db.authorized_for_zone(user, zone)
+        record = db.get_records(zone, 0, 1)["records"][0]
+        db.delete_record(zone, str(record["id"]))
+
+    def export_json():
+        _, manifest = build_manifest(db.get_all_zones())
+        build_zones(None, manifest=manifest)
+
+    def export_ndjson():
+        for _ in stream_zones(db.get_all_zones()):
+            pass
+
+    results["dashboard"] = _time(db, dashboard, iterations)
+    results["records_view"] = _time(db, records_view, iterations)
+    results["record_add"] = _time(db, record_add, iterations)
+    results["record_delete"] = _time(db, record_delete, iterations)
+    results["export_json"] = _time(db, export_json, max(iterations // 10, 1))
+    results["export_json_cached"] = _time(db, export_json, max(iterations // 10, 1))
+    results["export_ndjson"] = _time(db, export_ndjson, max(iterations // 10, 1))
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        results["export_files"] = _time(db, lambda: export_zones(db.get_all_zones(), export_dir), max(iterations // 20, 1))
+
+    return results
+
+
+def compare(report, baseline, threshold):
+    """
+    Find benchmarks that got slower than the baseline by more than the threshold
+    Query counts are only compared when both runs could count them
+    :return: list of regression messages
+    """
+    if baseline.get("backend", "mongod") != report.get("backend"):
+        return ["baseline ran on " + str(baseline.get("backend", "mongod")) + ", not " + str(report.get("backend")) + ", compare runs on the same backend"]
+
+    regressions = []
+    for name, result in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or "p50" not in result or not previous.get("p50"):
+            continue
+
+        ratio = result["p50"] / previous["p50"]
+        if ratio > threshold:
+            regressions.append(name + ": p50 " + str(previous["p50"]) + "s -> " + str(result["p50"]) + "s (" + str(round(ratio, 2)) + "x)")
+        if result["queries"] is not None and previous.get("queries") is not None and result["queries"] > previous["queries"]:
+            regressions.append(name + ": queries " + str(previous["queries"]) + " -> " + str(result["queries"]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="delivr benchmark suite")
+    parser.add_argument("--uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="delivr_bench")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="tiny")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--mongomock", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Allowed p50 slowdown against the baseline")
+    args = parser.parse_args()
+
+    client = None
+    if args.mongomock:
+        import mongomock
+        client = mongomock.MongoClient()
+
+    database = CDNDatabase(args.uri, "", args.database, client)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+
+    report = {
+        "commit": commit,
+        "scale": args.scale,
+        "backend": "mongomock" if args.mongomock else "mongod",
+        "results": run(database, args.scale, args.iterations)
+    }
+    if not database.counts_queries:
+        print("mongomock publishes no command events, queries are not counted and their thresholds are skipped", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baseline_file:
+            found = compare(report, json.load(baseline_file), args.threshold)
+        for regression in found:
+            print("REGRESSION " + regression)
+        sys.exit(1 if found else 0)
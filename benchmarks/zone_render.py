@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# Compare Jinja zone rendering against the fast path serializer
+# Run from the repository root: python3 -m benchmarks.zone_render [records]
+
+import sys
+from time import perf_counter
+
+from lib.renderer import render, serialize_zone
+
+NAMESERVERS = ["ns1.example.com", "ns2.example.com"]
+SOA_ROOT = "root.example.com"
+
+
+def _records(count):
+    return [{
+        "domain": "host" + str(i),
+        "type": "A" if i % 2 else "AAAA",
+        "value": "192.0.2." + str(i % 256) if i % 2 else "2001:db8::" + format(i % 65536, "x"),
+        "ttl": "3600"
+    } for i in range(count)]
+
+
+def _time(func, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    records = _records(count)
+
+    def jinja():
+        return render("zone.j2", serial="2020091401", records=records, nameservers=NAMESERVERS, soa_root=SOA_ROOT)
+
+    def fast():
+        return serialize_zone("2020091401", records, NAMESERVERS, SOA_ROOT)
+
+    if jinja() != fast():
+        print("Fast path output differs from zone.j2")
+        exit(1)
+
+    jinja_time = _time(jinja)
+    fast_time = _time(fast)
+
+    print("records:  %d" % count)
+    print("jinja:    %.3fs (%.0f records/s)" % (jinja_time, count / jinja_time))
+    print("fast:     %.3fs (%.0f records/s)" % (fast_time, count / fast_time))
+    print("speedup:  %.1fx" % (jinja_time / fast_time))
@@ -1,11 +1,18 @@
 #!/usr/bin/python3
+# Print the management address of every node in the Ansible inventory written by lib.exporter.build_nodes
+# Usage: ./jump.py [inventory]
+
+import sys
 
 hosts = {}
 
-with open("hosts", "w") as hosts_file:
-    _hosts = hosts_file.read().split("\n")
+with open(sys.argv[1] if len(sys.argv) > 1 else "automation/hosts", "r") as hosts_file:
+    for line in hosts_file.read().split("\n"):
+        fields = line.split()
+        if not fields:
+            continue
 
-    for host in _hosts:
-        hosts[host] = _hosts[host]
+        variables = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+        hosts[fields[0]] = variables.get("ansible_host", fields[0])
 
 print(hosts)
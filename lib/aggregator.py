@@ -1,54 +1,221 @@
-from jinja2 import Template
+import hashlib
+import json
+import time
+from collections import OrderedDict
 
-from lib.config import configuration
+from lib.metrics import inc, observe, register_collector, replace_gauges
+from lib.renderer import render_zone_file
 
+# Rendered zone cache, zone name -> (content hash, rendered zone text), least recently used first
+# It grows to the zone count of the last export, exports scan zones in the same order so a smaller LRU never hits
+_zone_cache = OrderedDict()
+MAX_CACHED_ZONES = 10000
+_export_zone_count = 0
 
-def _build_template(filename, **kwargs) -> str:
+# Recent export versions, version -> {zone name: content hash}
+# Bounded by the zones they hold in total, at 100k zones about 10 versions are kept
+_export_versions = OrderedDict()
+MAX_EXPORT_VERSIONS = 64
+MAX_EXPORT_ENTRIES = 1000000
+
+# Last render of every zone, zone name -> (seconds, bytes)
+_render_stats = {}
+TOP_ZONES = 10
+
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def zone_hash(zone) -> str:
     """
-    Build and render a template
-    :param filename: Path of j2 template file
-    :return: Template
+    Hash the content of a zone that ends up in the zone file
+    :param zone: Zone document
+    :return: hex digest of the zone's serial and records
     """
-    with open(filename, "r") as template_file:
-        return Template(template_file.read()).render(kwargs)
+    content = json.dumps({"serial": zone.get("serial"), "records": zone.get("records")}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
 
 
-def build_zones(db_zones):
+def serial_version(serials) -> str:
     """
-    Build zone object
+    Cheap version of the zone set from zone serials, changes whenever a zone is added, deleted or edited
+    :param serials: {zone name: serial}
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for name in sorted(serials):
+        digest.update((name + ":" + str(serials[name]) + "\n").encode())
+    return digest.hexdigest()
+
+
+def render_zone(zone, content_hash=None) -> str:
+    """
+    Render a zone file, reusing the cached render if the zone hasn't changed
+    :param zone: Zone document
+    :param content_hash: Precomputed zone_hash of the zone, computed if None
+    :return: Rendered zone file
+    """
+    if content_hash is None:
+        content_hash = zone_hash(zone)
+
+    cached = _zone_cache.get(zone["zone"])
+    if cached and cached[0] == content_hash:
+        _zone_cache.move_to_end(zone["zone"])
+        inc("delivr_zone_render_cache_total", "Zone renders by cache result", result="hit")
+        return cached[1]
+
+    start = time.monotonic()
+    rendered = render_zone_file(zone["serial"], zone["records"])
+    seconds = time.monotonic() - start
+    _zone_cache[zone["zone"]] = (content_hash, rendered)
+    _zone_cache.move_to_end(zone["zone"])
+    while len(_zone_cache) > max(MAX_CACHED_ZONES, _export_zone_count):
+        _zone_cache.popitem(last=False)
+
+    inc("delivr_zone_render_cache_total", "Zone renders by cache result", result="miss")
+    observe("delivr_zone_render_seconds", seconds, "Zone file render duration")
+    observe("delivr_zone_size_bytes", len(rendered), "Rendered zone file size", buckets=SIZE_BUCKETS)
+    _render_stats[zone["zone"]] = (seconds, len(rendered))
+    return rendered
+
+
+def _zone_gauges():
+    """
+    Export the slowest and largest zones, keeping per-zone labels to a bounded set
+    """
+    for zone in list(_render_stats):
+        if zone not in _zone_cache:
+            _render_stats.pop(zone, None)
+
+    stats = list(_render_stats.items())
+    slowest = sorted(stats, key=lambda item: -item[1][0])[:TOP_ZONES]
+    largest = sorted(stats, key=lambda item: -item[1][1])[:TOP_ZONES]
+    replace_gauges("delivr_zone_slowest_render_seconds", [({"zone": zone}, stat[0]) for zone, stat in slowest], "Last render duration of the slowest zones")
+    replace_gauges("delivr_zone_largest_bytes", [({"zone": zone}, stat[1]) for zone, stat in largest], "Rendered size of the largest zones")
+
+
+register_collector(_zone_gauges)
+
+
+def _remember_version(hashes) -> str:
+    """
+    Compute the version of an export and remember its zone hashes for incremental exports
+    :param hashes: {zone name: content hash}
+    :return: export version
+    """
+    global _export_zone_count
+    _export_zone_count = len(hashes)
+
+    # Drop cached renders of zones that no longer exist
+    for name in list(_zone_cache):
+        if name not in hashes:
+            _zone_cache.pop(name, None)
+
+    digest = hashlib.sha1()
+    for name in sorted(hashes):
+        digest.update((name + ":" + hashes[name] + "\n").encode())
+    version = digest.hexdigest()
+
+    if version not in _export_versions:
+        _export_versions[version] = hashes
+        # The newest version is always kept
+        while len(_export_versions) > 1 and (len(_export_versions) > MAX_EXPORT_VERSIONS or
+                                             sum(len(versions) for versions in _export_versions.values()) > MAX_EXPORT_ENTRIES):
+            _export_versions.popitem(last=False)
+
+    return version
+
+
+def build_manifest(db_zones):
+    """
+    Hash every zone and compute the version of the whole export
     :param db_zones: Array of zones
-    :return:
+    :return: (export version, {zone name: (content hash, zone document)})
+    """
+    manifest = {}
+    for zone in db_zones:
+        manifest[zone["zone"]] = (zone_hash(zone), zone)
+
+    version = _remember_version({name: manifest[name][0] for name in manifest})
+    return version, manifest
+
+
+def known_version(version) -> bool:
     """
+    Check if an export version is still remembered for incremental exports
+    :param version: Export version
+    :return: True if build_zones can diff against the version
+    """
+    return version in _export_versions
+
+
+def build_zones(db_zones, manifest=None, since=None):
+    """
+    Build zone object
+    :param db_zones: Array of zones, ignored if manifest is given
+    :param manifest: Manifest from build_manifest
+    :param since: Only include zones changed since this export version. Deleted zones map to None
+    :return: dict of zone name to rendered zone file
+    """
+    if manifest is None:
+        _, manifest = build_manifest(db_zones)
+
+    previous = _export_versions.get(since) if since else None
+
     zones = {}
+    for name, (content_hash, zone) in manifest.items():
+        if previous is None or previous.get(name) != content_hash:
+            zones[name] = render_zone(zone, content_hash)
 
-    for zone in db_zones:
-        zones[zone["zone"]] = _build_template("config/zone.j2",
-                                              serial=zone["serial"],
-                                              records=zone["records"],
-                                              nameservers=configuration["nameservers"],
-                                              soa_root=configuration["soa_root"]
-                                              )
+    if previous is not None:
+        for name in previous:
+            if name not in manifest:
+                zones[name] = None
 
     return zones
 
-# def export_zones():
-#     os.system("rm -rf source/dns/db.*")
-#     with open("config/local.j2") as local_template_file:
-#         local_template = local_template_file.read()
-#
-#     with open("config/zone.j2") as zone_template_file:
-#         zone_template = zone_template_file.read()
-#
-#     local = ""
-#     for zone in zones:
-#         local += Template(local_template).render(zone=zone["zone"])
-#
-#         with open("source/dns/db." + zone["zone"], "w") as zone_file:
-#             zone_file.write(Template(zone_template).render(
-#                 zone=zone["zone"],
-#                 records=zone.get("records"),
-#                 serial=strftime("%Y%m%d%S"))
-#             )
-#
-#     with open("../source/dns/named.conf.local", "w") as zones_file:
-#         zones_file.write(local)
+
+def _record_line(record) -> str:
+    """
+    Format a record as a zone file line
+    :param record: Record dict
+    :return: zone file line, same format as zone.j2
+    """
+    return str(record["domain"]) + "    " + str(record["ttl"]) + "    IN    " + str(record["type"]) + "    " + str(record["value"])
+
+
+def build_changes(changes) -> list:
+    """
+    Build IXFR-style change sets from journal entries
+    :param changes: Journal entries from CDNDatabase.get_changes
+    :return: list of {"serial", "deleted", "added"} with records as zone file lines
+    """
+    return [{
+        "serial": change["serial"],
+        "deleted": [_record_line(record) for record in change["deleted"]],
+        "added": [_record_line(record) for record in change["added"]]
+    } for change in changes]
+
+
+def stream_zones(db_zones, since=None):
+    """
+    Render zones as the cursor reaches them and yield one NDJSON line per zone
+    The last line holds the export version: {"version": "..."}
+    :param db_zones: Zone cursor
+    :param since: Only include zones changed since this export version. Deleted zones have null data
+    :return: generator of NDJSON lines
+    """
+    previous = _export_versions.get(since) if since else None
+
+    hashes = {}
+    for zone in db_zones:
+        content_hash = zone_hash(zone)
+        hashes[zone["zone"]] = content_hash
+        if previous is None or previous.get(zone["zone"]) != content_hash:
+            yield json.dumps({"zone": zone["zone"], "data": render_zone(zone, content_hash)}) + "\n"
+
+    if previous is not None:
+        for name in previous:
+            if name not in hashes:
+                yield json.dumps({"zone": name, "data": None}) + "\n"
+
+    yield json.dumps({"version": _remember_version(hashes)}) + "\n"
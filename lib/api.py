@@ -1,237 +1,223 @@
-import argon2
-import pymongo
-from bson.objectid import ObjectId
-from flask import Flask
+import json
+from functools import wraps
 
-# Database
-_client = pymongo.MongoClient(mongo_uri)
-_db = self._client["cdn"]
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 
-# Collections
-users = _db["users"]
-zones = _db["zones"]
-nodes = _db["nodes"]
+from lib.linter import lint_record
 
-app = Flask(__name__)
 
+# Fields of each batch action that must be non-empty strings
+BATCH_FIELDS = {
+    "create": ("zone", "domain", "type", "value"),
+    "update": ("zone", "id", "domain", "type", "value"),
+    "delete": ("zone", "id")
+}
 
-# Helpers
 
-def _exists(collection, query):
-    return collection.find_one(query) is not None
-
-
-# User routes
-
-@app.route("/users/add")
-def users_add():
-    """
-    Register a new user
-    Example:
-    requests.post("api/users/add", data={
-        "username": "test@example.com",
-        "password": "plaintext-password"
-    })
-    """
-
-    username = request.json.get("username")
-    password = request.json.get("password")
-
-    if not (username and password):
-        return jsonify({"success": False, "message": "username and password must not be empty"})
-
-    if _exists(users, {"username": username}):
-        return jsonify({"success": False, "message": "A user with this username already exists"})
-
-    users.insert_one({
-        "username": username,
-        "password": argon2.argon2_hash(password, self.salt)
-    })
-
-    return jsonify({"success": True, "message": "User created"})
-
-
-# Zone methods
-
-def add_zone(zone, user_id):
-    """
-    Add a zone
-    :param zone: Zone in human form (example.com/2001:db8::1)
-    :param user_id: User to authorize zone to (Document ID)
-    :return: Error, None if no error
-    """
-    if zone and ("." in zone):
-        if self._user_exists(user_id):
-            user = ObjectId(user_id)
-            if not self.zone_exists(zone):
-                # Create zone
-                new_zone = self.zones.insert_one({
-                    "zone": zone,
-                    "users": [user],
-                    "records": []
-                })
-
-                # Update the user's document to include new zone
-                self.users.update_one({"_id": user}, {"$push": {"zones": new_zone.inserted_id}})
-
-                return None  # No error
-            else:
-                return "Zone already exists"
-
-        else:
-            return "User doesn't exist"
-    else:
-        return "Invalid zone"
-
-
-def delete_zone(self, zone):
-    """
-    Delete a zone
-    :param zone: Zone ID
-    :return: Error, None if success
-    """
-
-    if self.zone_exists(zone):
-        zone_doc = self.zones.find_one({"zone": zone})
-
-        zone_users = zone_doc.get("users")
-        if zone_users:
-            for user in zone_users:
-                # Pull the zone doc out of the user's zones array
-                self.users.update_one({"_id": user}, {"$pull": {"zones": zone_doc["_id"]}})
-
-        # Delete the zone itself
-        self.zones.delete_one({"_id": zone_doc["_id"]})
-
-        return None  # No error
-    else:
-        return "Zone doesn't exist"
-
-
-def get_zones(self, user_id: str) -> list:
-    """
-    Get all zones for a user
-    :param user_id: User ID
-    :return: list of authorized zones
-    """
-
-    authorized_zones = []
-
-    if self._user_exists(user_id):
-        user_doc = self.users.find_one({"_id": ObjectId(user_id)})
-        user_zones = user_doc.get("zones")
-        if user_zones:
-            for zone_id in user_zones:
-                authorized_zones.append(self.zones.find_one({"_id": zone_id}))
-
-    return authorized_zones
-
-
-# End zone methods
-# Start record methods
-
-def add_record(self, zone: str, domain: str, _type: str, value: str, ttl: str):
-    """
-    Add a record to a zone
-    :param zone: Parent zone
-    :param domain: Domain in BIND format
-    :param _type: Record type
-    :param value: Record value
-    :param ttl: TTL
-    :return:
-    """
-
-    if self.zone_exists(zone) and (zone and domain and _type and value and ttl):
-        self.zones.update_one({"zone": zone}, {"$push": {"records": {
-            "domain": domain,
-            "type": _type,
-            "value": value,
-            "ttl": ttl
-        }}})
-    else:
-        return "Zone doesn't exist or entry is blank"
-
-
-def delete_record(self, zone, record_id):
-    """
-    Delete a record by id
-    :param zone: Parent zone
-    :param record_id:
-    :return:
-    """
-
-    if self.zone_exists(zone):
-        # Get current records
-        current_records = self.zones.find_one({"zone": zone})["records"]
-
-        # Remove the record
-        current_records.pop(int(record_id))
-
-        # Set the modified records
-        self.zones.update_one({"zone": zone}, {"$set": {"records": current_records}})
-
-
-# End record methods
-# Start node methods
-
-def get_nodes(self):
-    return list(self.nodes.find())
-
-
-def add_node(self, uid: str, location: str, management: str, operational: bool):
-    """
-    Add a node
-    :param uid: location-country_code. For example Fremont, California is fmt-us
-    :param location: Full location, for example: Fremont, California
-    :param management: Management IP address
-    :param operational: Is the node operational?
-    :return:
+def _record_json(record):
     """
+    Make a record JSON serializable
+    :param record: Record dict
+    :return: Record dict with a string ID
+    """
+    return {
+        "id": str(record.get("id")),
+        "domain": record.get("domain"),
+        "type": record.get("type"),
+        "value": record.get("value"),
+        "ttl": record.get("ttl")
+    }
+
 
-    self.nodes.insert_one({
-        "uid": uid,
-        "location": location,
-        "management": management,
-        "operational": operational
-    })
-
-
-# End node methods
-
-def authorized_for_zone(self, user_id, zone):
-    """
-    Is user authorized for zone?
-    :param user_id:
-    :param zone:
-    :return:
+def _page():
     """
-    if self._user_exists(user_id) and self.zone_exists(zone):
-        zone_doc = self.zones.find_one({"zone": zone})
-        return ObjectId(user_id) in zone_doc["users"]
-    else:
-        return False
-
-
-def get_zone(self, user, zone):
-    if self.authorized_for_zone(user, zone):
-        return self.zones.find_one({"zone": zone})
-    else:
-        return "Error: Zone not authorized"
-
-
-def get_all_zones(self):
-    return self.zones.find({})
-
-
-def get_total_records(self, user: str) -> int:
-    """
-    Get total number of records that a user has
-    :param user: User's id
-    :return: number of records
-    """
-    total_records = 0
-    if self._user_exists(user):
-        for zone in self.get_zones(user):
-            total_records += len(zone["records"])
-
-    return total_records
+    Read pagination arguments
+    :return: (skip, limit)
+    """
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    skip = max(request.args.get("skip", 0, type=int), 0)
+    return skip, limit
+
+
+def create_api(db):
+    """
+    Build the JSON API
+    :param db: CDNDatabase
+    :return: Flask blueprint, mount it at /api
+    """
+    api = Blueprint("api", __name__)
+
+    def token_required(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            user_id = db.token_user(request.headers.get("X-API-Token"))
+            if not user_id:
+                return jsonify({"success": False, "message": "Invalid API token"}), 401
+            return route(user_id, *args, **kwargs)
+
+        return wrapper
+
+    # User routes
+
+    @api.route("/users/add", methods=["POST"])
+    def users_add():
+        """
+        Register a new user
+        Example:
+        requests.post("api/users/add", json={
+            "username": "test@example.com",
+            "password": "plaintext-password"
+        })
+        """
+
+        body = request.get_json(silent=True) or {}
+        error = db.add_user(body.get("username"), body.get("password"))
+        if error:
+            return jsonify({"success": False, "message": error}), 400
+
+        return jsonify({"success": True, "message": "User created"})
+
+    @api.route("/tokens", methods=["POST"])
+    def tokens_add():
+        """
+        Create an API token, send it in the X-API-Token header
+        Example:
+        requests.post("api/tokens", json={
+            "username": "test@example.com",
+            "password": "plaintext-password"
+        })
+        """
+
+        body = request.get_json(silent=True) or {}
+        user_id, error = db.login(body.get("username"), body.get("password"))
+        if not user_id:
+            return jsonify({"success": False, "message": error}), 401
+
+        return jsonify({"success": True, "token": db.create_token(user_id)})
+
+    # Zone routes
+
+    @api.route("/zones")
+    @token_required
+    def zones_list(user_id):
+        """
+        List zones, paginated with skip and limit
+        """
+
+        skip, limit = _page()
+        zones = db.get_zones(user_id, skip, limit)
+        return jsonify({
+            "success": True,
+            "skip": skip,
+            "limit": limit,
+            "zones": [{"zone": zone["zone"], "serial": zone["serial"], "records": zone["record_count"]} for zone in zones]
+        })
+
+    @api.route("/zones/<zone>/records")
+    @token_required
+    def records_list(user_id, zone):
+        """
+        List a zone's records, paginated with skip and limit
+        With format=ndjson every record is streamed, one per line
+        """
+
+        if not db.authorized_for_zone(user_id, zone):
+            return jsonify({"success": False, "message": "Not authorized for zone"}), 403
+
+        if request.args.get("format") == "ndjson":
+            def stream():
+                for record in db.iter_records(zone):
+                    yield json.dumps(_record_json(record)) + "\n"
+
+            return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
+        skip, limit = _page()
+        page = db.get_records(zone, skip, limit, request.args.get("q"), request.args.get("match") == "prefix")
+        if page is None:
+            return jsonify({"success": False, "message": "Zone doesn't exist"}), 404
+
+        return jsonify({
+            "success": True,
+            "zone": zone,
+            "serial": page["serial"],
+            "total": page["record_count"],
+            "skip": skip,
+            "limit": limit,
+            "records": [_record_json(record) for record in page["records"]]
+        })
+
+    # Record routes
+
+    @api.route("/records/batch", methods=["POST"])
+    @token_required
+    def records_batch(user_id):
+        """
+        Create, update and delete records across zones, with one serial bump per zone
+        Example:
+        requests.post("api/records/batch", headers={"X-API-Token": token}, json={
+            "create": [{"zone": "example.com", "domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "3600"}],
+            "update": [{"zone": "example.com", "id": "...", "domain": "www", "type": "A", "value": "192.0.2.2", "ttl": "3600"}],
+            "delete": [{"zone": "example.com", "id": "..."}]
+        })
+        """
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify({"success": False, "message": "Body must be a JSON object"}), 400
+
+        batches = {}
+        errors = []
+        changed_ids = set()
+
+        # Validate the whole payload before writing anything
+        for action in ("create", "update", "delete"):
+            entries = body.get(action) or []
+            if not isinstance(entries, list):
+                errors.append({"action": action, "message": action + " must be a list"})
+                continue
+
+            for index, entry in enumerate(entries):
+                if not isinstance(entry, dict):
+                    errors.append({"action": action, "index": index, "message": "Entry must be an object"})
+                    continue
+
+                # Checked before linting and grouping, both need strings
+                field_errors = [field + " is required" if entry.get(field) in (None, "") else field + " must be a string"
+                                for field in BATCH_FIELDS[action] if not (isinstance(entry.get(field), str) and entry[field])]
+                if field_errors:
+                    errors += [{"action": action, "index": index, "message": error} for error in field_errors]
+                    continue
+
+                if action == "delete":
+                    item = entry["id"]
+                else:
+                    record_errors = lint_record(entry, entry["zone"])
+                    if record_errors:
+                        errors += [{"action": action, "index": index, "message": error} for error in record_errors]
+                        continue
+                    item = entry
+
+                # A record can only be updated or deleted once per batch
+                if action != "create":
+                    record_id = (entry["zone"], str(entry["id"]))
+                    if record_id in changed_ids:
+                        errors.append({"action": action, "index": index, "message": "Record " + str(entry["id"]) + " is changed more than once"})
+                        continue
+                    changed_ids.add(record_id)
+
+                batches.setdefault(entry["zone"], {"create": [], "update": [], "delete": []})[action].append(item)
+
+        unauthorized = set(batches) - db.authorized_zones(user_id, batches)
+        errors += [{"zone": zone, "message": "Not authorized for zone"} for zone in sorted(unauthorized)]
+
+        if errors:
+            return jsonify({"success": False, "message": "Validation failed", "errors": errors}), 400
+
+        results = {}
+        for zone, batch in batches.items():
+            error = db.apply_records(zone, batch["create"], batch["update"], batch["delete"])
+            results[zone] = {"success": error is None, "message": error or "Applied " + str(sum(len(items) for items in batch.values())) + " changes"}
+
+        return jsonify({"success": all(result["success"] for result in results.values()), "zones": results})
+
+    return api
@@ -0,0 +1,135 @@
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from argon2 import PasswordHasher, Type
+from argon2.exceptions import InvalidHash, VerificationError
+from argon2.low_level import hash_secret_raw
+
+from lib.config import configuration
+
+# Encoded Argon2id hashes with a random salt per password
+_hasher = PasswordHasher(
+    time_cost=configuration.get("argon2-time-cost", 3),
+    memory_cost=configuration.get("argon2-memory-cost", 65536),
+    parallelism=configuration.get("argon2-parallelism", 1)
+)
+
+# Argon2 releases the GIL, so hashes run on the request thread. At most auth-workers run at once so login
+# bursts can't take every CPU, and at most auth-queue-depth more wait for a turn before logins are rejected
+_workers = threading.BoundedSemaphore(configuration.get("auth-workers", 2))
+_queue = threading.BoundedSemaphore(configuration.get("auth-workers", 2) + configuration.get("auth-queue-depth", 32))
+
+# Verified for unknown usernames so they take as long as wrong passwords
+_dummy_hash = None
+
+# Username -> attempt timestamps inside the rate limit window, least recently tried first
+_attempts = OrderedDict()
+_attempts_lock = threading.Lock()
+
+
+def _limited(func, *args):
+    """
+    Run a hashing function once a hashing slot is free
+    :return: (result, error), error is set if too many hashes are waiting
+    """
+    if not _queue.acquire(blocking=False):
+        return None, "Server busy, try again later"
+
+    try:
+        with _workers:
+            return func(*args), None
+    finally:
+        _queue.release()
+
+
+def rate_limited(username) -> bool:
+    """
+    Record a login attempt and check if the username is over its limit
+    :param username: Username
+    :return: True if the attempt should be rejected
+    """
+    window = configuration.get("login-window", 60)
+    limit = configuration.get("login-attempts", 5)
+    now = time.monotonic()
+
+    with _attempts_lock:
+        attempts = [attempt for attempt in _attempts.get(username, []) if now - attempt < window]
+        limited = len(attempts) >= limit
+        if not limited:
+            attempts.append(now)
+        _attempts[username] = attempts
+        _attempts.move_to_end(username)
+
+        # Forget idle usernames from the front, each one is removed once so this stays cheap during a burst
+        while _attempts:
+            name, times = next(iter(_attempts.items()))
+            if times and now - times[-1] < window:
+                break
+            del _attempts[name]
+
+    return limited
+
+
+def hash_password(password):
+    """
+    Hash a password
+    :param password: Plaintext password
+    :return: (encoded hash, error)
+    """
+    return _limited(_hasher.hash, password)
+
+
+def _legacy_hash(password, salt):
+    # Parameters of argon2.argon2_hash used before encoded hashes: Argon2i, t=16, m=2^8 KiB, p=1, 128 byte output
+    return hash_secret_raw(password.encode(), salt.encode(), time_cost=16, memory_cost=1 << 8, parallelism=1, hash_len=128, type=Type.I)
+
+
+def _verify(stored, password, legacy_salt):
+    """
+    Verify a password against a stored hash
+    :return: (valid, new hash if the stored one should be replaced)
+    """
+    if isinstance(stored, str) and stored.startswith("$argon2"):
+        try:
+            _hasher.verify(stored, password)
+        except (VerificationError, InvalidHash):
+            return False, None
+
+        return True, _hasher.hash(password) if _hasher.check_needs_rehash(stored) else None
+
+    # Raw hash with the global salt from config.yml, upgrade on success
+    if legacy_salt and hmac.compare_digest(bytes(stored), _legacy_hash(password, legacy_salt)):
+        return True, _hasher.hash(password)
+
+    return False, None
+
+
+def verify_password(stored, password, legacy_salt=None):
+    """
+    Verify a password
+    :param stored: Stored password hash
+    :param password: Plaintext password
+    :param legacy_salt: Global salt of hashes created before per-user salts
+    :return: (valid, new hash or None, error)
+    """
+    result, error = _limited(_verify, stored, password, legacy_salt)
+    if error:
+        return False, None, error
+
+    return result[0], result[1], None
+
+
+def reject_unknown_user(password):
+    """
+    Spend the time of a password check for a username that doesn't exist, so login times don't reveal usernames
+    :param password: Plaintext password
+    :return: error if hashing is busy, None otherwise
+    """
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = _hasher.hash(secrets.token_hex(16))
+
+    return verify_password(_dummy_hash, password)[2]
@@ -1,15 +1,96 @@
+import hashlib
+import re
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
 from time import strftime
 
-import argon2
 import pymongo
 from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from lib.auth import hash_password, rate_limited, reject_unknown_user, verify_password
+from lib.linter import find_conflicts, lint_record, owner_name
+from lib.metrics import inc, observe
+from lib.migrations import migrate, search_keys
+
+
+def _caller_method() -> str:
+    """
+    Find the outermost CDNDatabase method on the current stack
+    :return: method name, or "other" for commands issued outside of CDNDatabase
+    """
+    method = "other"
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_filename == __file__:
+            method = frame.f_code.co_name
+        frame = frame.f_back
+    return method
+
+
+# Records per journal document, large changes are split so no document nears the 16 MB limit
+JOURNAL_CHUNK = 1000
+
+# Changes with more records than this are journaled as "full transfer required"
+MAX_JOURNAL_RECORDS = 100000
+
+# Seconds after which a journal claim whose writer never bumped the serial can be taken over
+JOURNAL_CLAIM_TIMEOUT = 30
+
+# Attempts to write a change when other writers bump the serial first
+SERIAL_RETRIES = 5
+
+# Returned when every attempt lost the serial to another writer, retrying later can succeed
+ZONE_BUSY = "Zone is being changed by another request, try again"
+
+
+class _QueryCounter(monitoring.CommandListener):
+    """
+    Count Mongo commands issued by the current thread and time them per CDNDatabase method
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def count(self):
+        return getattr(self._local, "count", 0)
+
+    def reset(self):
+        self._local.count = 0
+
+    def started(self, event):
+        self._local.count = self.count + 1
+        if not hasattr(self._local, "methods"):
+            self._local.methods = {}
+        self._local.methods[event.request_id] = _caller_method()
+
+    def _finished(self, event, status):
+        # Events of one command are published on the thread that issued it
+        method = getattr(self._local, "methods", {}).pop(event.request_id, "other")
+        inc("delivr_mongo_commands_total", "Mongo commands by CDNDatabase method", method=method, command=event.command_name, status=status)
+        observe("delivr_mongo_command_seconds", event.duration_micros / 1e6, "Mongo command duration by CDNDatabase method", method=method, command=event.command_name)
+
+    def succeeded(self, event):
+        self._finished(event, "ok")
+
+    def failed(self, event):
+        self._finished(event, "failed")
 
 
 class CDNDatabase:
-    def __init__(self, mongo_uri, salt):
-        self._client = pymongo.MongoClient(mongo_uri)
-        self._db = self._client["cdn"]
+    def __init__(self, mongo_uri, salt, database="cdn", client=None):
+        self._query_counter = _QueryCounter()
+        self._client = client or pymongo.MongoClient(mongo_uri, event_listeners=[self._query_counter])
+        self._db = self._client[database]
+
+        # Commands are counted through the listener of the client created here, a given client isn't counted
+        self.counts_queries = client is None
 
         self.salt = salt
 
@@ -17,6 +98,107 @@ class CDNDatabase:
         self.users = self._db["users"]
         self.zones = self._db["zones"]
         self.nodes = self._db["nodes"]
+        self.journal = self._db["journal"]
+        self.record_search = self._db["record_search"]
+
+        # Bring indexes and documents up to the current schema
+        migrate(self._db)
+
+        # Per-request document cache, only set between begin_request and end_request
+        self._local = threading.local()
+
+        # Route -> {"requests": n, "queries": n}, updated by every request thread
+        self.query_stats = {}
+        self._stats_lock = threading.Lock()
+
+        # (fetch time, nodes)
+        self._nodes_cache = None
+
+        # Called with the zone name after its records change
+        self._zone_listeners = []
+
+    # Request methods
+
+    def begin_request(self):
+        """
+        Start caching user and zone documents for the current request
+        """
+
+        self._local.cache = {}
+        self._query_counter.reset()
+
+    def end_request(self, route=None) -> int:
+        """
+        Stop caching documents and record the request's query count
+        :param route: Route to attribute the queries to, None to not record
+        :return: number of queries issued during the request
+        """
+
+        self._local.cache = None
+        queries = self._query_counter.count
+
+        if route:
+            with self._stats_lock:
+                stats = self.query_stats.setdefault(route, {"requests": 0, "queries": 0})
+                stats["requests"] += 1
+                stats["queries"] += queries
+
+        return queries
+
+    def get_query_stats(self) -> dict:
+        """
+        Get a consistent copy of the query counts per route
+        :return: {route: {"requests": n, "queries": n}}
+        """
+
+        with self._stats_lock:
+            return {route: dict(stats) for route, stats in self.query_stats.items()}
+
+    def _cached(self, key, fetch):
+        """
+        Get a value from the request cache, fetching it on a miss
+        :param key: Cache key
+        :param fetch: Function to fetch the value
+        :return: Cached or fetched value
+        """
+
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            return fetch()
+
+        if key not in cache:
+            cache[key] = fetch()
+        return cache[key]
+
+    def _invalidate(self, *keys):
+        """
+        Drop keys from the request cache
+        """
+
+        cache = getattr(self._local, "cache", None)
+        if cache is not None:
+            for key in keys:
+                cache.pop(key, None)
+
+            # Authorization results depend on zone documents
+            for key in [key for key in cache if key[0] == "authorized"]:
+                del cache[key]
+
+    def on_zone_change(self, listener):
+        """
+        Call a function whenever a zone's records change or the zone is deleted
+        :param listener: Function taking the zone name
+        """
+
+        self._zone_listeners.append(listener)
+
+    def _zone_changed(self, zone):
+        """
+        Tell the zone listeners about a change
+        """
+
+        for listener in self._zone_listeners:
+            listener(zone)
 
     # User methods
 
@@ -27,17 +209,25 @@ class CDNDatabase:
         :return: True if user exists, False if not
         """
 
-        # Check user doc validity
+        return self._get_user(user) is not None
+
+    def _get_user(self, user, projection=None):
+        """
+        Get a user document
+        :param user: User's document ID as string
+        :param projection: Fields to fetch, None for the whole document. Ignored within a request, where the whole document is cached
+        :return: User document, None if user doesn't exist
+        """
+
         try:
             user_id = ObjectId(user)
         except InvalidId:
-            return False
+            return None
 
-        # If no user exists
-        if not self.users.find_one({"_id": user_id}):
-            return False
+        if getattr(self._local, "cache", None) is not None:
+            return self._cached(("user", user_id), lambda: self.users.find_one({"_id": user_id}))
 
-        return True
+        return self.users.find_one({"_id": user_id}, projection)
 
     def add_user(self, username, password):
         """
@@ -47,34 +237,219 @@ class CDNDatabase:
         :return: error string, None if success
         """
 
-        user_doc = self.users.find_one({"username": username})
+        if not (username and password):
+            return "Username and password must not be empty"
+
+        user_doc = self.users.find_one({"username": username}, {"_id": 1})
         if user_doc is None:
-            self.users.insert_one({
-                "username": username,
-                "password": argon2.argon2_hash(password, self.salt)
-            })
+            password_hash, error = hash_password(password)
+            if error:
+                return error
+
+            try:
+                self.users.insert_one({
+                    "username": username,
+                    "password": password_hash
+                })
+            except DuplicateKeyError:
+                return "Account with this email already exists"
 
             return None  # No error
         else:
             return "Account with this email already exists"
 
+    def login(self, username: str, password: str):
+        """
+        Validate user credentials, upgrading the stored hash if needed
+        :param username: Plaintext username
+        :param password: Plaintext password
+        :return: (user's document ID as string, error), ID is "" if not authorized
+        """
+
+        if not (username and password):
+            return "", "Not authorized"
+
+        if rate_limited(username):
+            return "", "Too many login attempts, try again later"
+
+        user_doc = self.users.find_one({"username": username}, {"password": 1})
+        if not user_doc:
+            return "", reject_unknown_user(password) or "Not authorized"
+
+        valid, new_hash, error = verify_password(user_doc["password"], password, self.salt)
+        if error:
+            return "", error
+        if not valid:
+            return "", "Not authorized"
+
+        if new_hash:
+            self.users.update_one({"_id": user_doc["_id"]}, {"$set": {"password": new_hash}})
+
+        return str(user_doc["_id"]), None
+
     def authenticated(self, username: str, password: str) -> str:
         """
         Validate user credentials and return user document ID
         :param username: Plaintext username
-        :param password: Hashed password
+        :param password: Plaintext password
         :return: user's document ID as string, "" if not authorized
         """
 
-        user_doc = self.users.find_one({"username": username})
-        if user_doc and (user_doc["password"] == argon2.argon2_hash(password, self.salt)):
-            return str(user_doc["_id"])
+        return self.login(username, password)[0]
+
+    def _count_change(self, users, zones=0, records=0):
+        """
+        Update the dashboard counters of users
+        :param users: List of user ObjectIds
+        :param zones: Change in zone count
+        :param records: Change in record count
+        """
+
+        if users:
+            self.users.update_many({"_id": {"$in": users}}, {
+                "$inc": {"zone_count": zones, "record_count": records},
+                "$set": {"last_change": datetime.utcnow()}
+            })
+            self._invalidate(*[("user", user) for user in users])
+
+    def get_dashboard(self, user_id: str, recent=10):
+        """
+        Get a user's dashboard counters and most recent zones
+        :param user_id: User ID
+        :param recent: Number of recent zones to include
+        :return: dict with zone_count, record_count, last_change and zones
+        """
+
+        try:
+            user = ObjectId(user_id)
+        except (InvalidId, TypeError):
+            user = None
+
+        projection = {"zone_count": 1, "record_count": 1, "last_change": 1}
+        if recent:
+            projection["zones"] = {"$slice": -recent}
+
+        user_doc = self.users.find_one({"_id": user}, projection) if user else None
+        if not user_doc:
+            return {"zone_count": 0, "record_count": 0, "last_change": None, "zones": []}
+
+        zones = []
+        if user_doc.get("zones"):
+            zones = list(self.zones.aggregate([
+                {"$match": {"_id": {"$in": user_doc["zones"]}}},
+                {"$project": {"zone": 1, "record_count": {"$size": {"$ifNull": ["$records", []]}}}}
+            ]))
+
+            # Newest first
+            order = {zone_id: index for index, zone_id in enumerate(user_doc["zones"])}
+            zones.sort(key=lambda zone_doc: -order[zone_doc["_id"]])
+
+        return {
+            "zone_count": user_doc.get("zone_count", 0),
+            "record_count": user_doc.get("record_count", 0),
+            "last_change": user_doc.get("last_change"),
+            "zones": zones
+        }
+
+    def _computed_counts(self, users=None) -> dict:
+        """
+        Count users' zones and records from the zones themselves
+        :param users: List of user ObjectIds, None for every user
+        :return: {user ObjectId: {"zone_count", "record_count"}}
+        """
+
+        pipeline = [
+            {"$project": {"users": 1, "record_count": {"$size": {"$ifNull": ["$records", []]}}}},
+            {"$unwind": "$users"},
+            {"$group": {"_id": "$users", "zone_count": {"$sum": 1}, "record_count": {"$sum": "$record_count"}}}
+        ]
+        if users is not None:
+            pipeline.insert(0, {"$match": {"users": {"$in": users}}})
+            pipeline.insert(3, {"$match": {"users": {"$in": users}}})
+
+        return {row["_id"]: {"zone_count": row["zone_count"], "record_count": row["record_count"]} for row in self.zones.aggregate(pipeline)}
+
+    def reconcile_counters(self, settle=5.0):
+        """
+        Recompute users' dashboard counters from their zones
+        Writes update the zone before the counters, so a mismatch is only corrected if it is still there
+        after settle seconds with no counter change in between, and only if the counters weren't changed since
+        :param settle: Seconds for in-flight writes to finish before a mismatch is confirmed
+        :return: number of users updated
+        """
 
-        return ""  # Not authorized
+        empty = {"zone_count": 0, "record_count": 0}
+        projection = {"zone_count": 1, "record_count": 1, "last_change": 1}
+
+        counts = self._computed_counts()
+        mismatched = {}
+        for user_doc in self.users.find({}, projection):
+            row = counts.get(user_doc["_id"], empty)
+            if user_doc.get("zone_count") != row["zone_count"] or user_doc.get("record_count") != row["record_count"]:
+                mismatched[user_doc["_id"]] = (user_doc, row)
+
+        if not mismatched:
+            return 0
+
+        time.sleep(settle)
+
+        counts = self._computed_counts(list(mismatched))
+        updated = 0
+        for user_doc in self.users.find({"_id": {"$in": list(mismatched)}}, projection):
+            first_doc, first_row = mismatched[user_doc["_id"]]
+            unchanged = all(user_doc.get(field) == first_doc.get(field) for field in projection)
+            if not unchanged or counts.get(user_doc["_id"], empty) != first_row:
+                continue  # Changed while settling, the next run checks again
+
+            # Only if no write counted a change since the counters were read
+            updated += self.users.update_one(
+                {"_id": user_doc["_id"], **{field: user_doc.get(field) for field in projection}},
+                {"$set": first_row}
+            ).modified_count
+
+        return updated
+
+    def create_token(self, user_id: str) -> str:
+        """
+        Create an API token for a user, only its hash is stored
+        :param user_id: User ID
+        :return: plaintext token, "" if the user doesn't exist
+        """
+
+        token = secrets.token_urlsafe(32)
+        try:
+            result = self.users.update_one({"_id": ObjectId(user_id)}, {"$push": {"api_tokens": hashlib.sha256(token.encode()).hexdigest()}})
+        except (InvalidId, TypeError):
+            return ""
+
+        return token if result.matched_count else ""
+
+    def token_user(self, token: str) -> str:
+        """
+        Find the user an API token belongs to
+        :param token: Plaintext token
+        :return: user's document ID as string, "" if the token is invalid
+        """
+
+        if not token:
+            return ""
+
+        token_hash = hashlib.sha256(token.encode()).hexdigest()
+        user_doc = self._cached(("token", token_hash), lambda: self.users.find_one({"api_tokens": token_hash}, {"_id": 1}))
+        return str(user_doc["_id"]) if user_doc else ""
 
     # End user methods
     # Start zone methods
 
+    def _get_zone(self, zone):
+        """
+        Get a zone document
+        :param zone: Zone as string
+        :return: Zone document, None if zone doesn't exist
+        """
+
+        return self._cached(("zone", zone), lambda: self.zones.find_one({"zone": zone}))
+
     def zone_exists(self, zone):
         """
         Check if a zone exists
@@ -82,11 +457,7 @@ class CDNDatabase:
         :return: True if zone exists, False if not
         """
 
-        # If no user exists
-        if not self.zones.find_one({"zone": zone}):
-            return False
-
-        return True
+        return self._get_zone(zone) is not None
 
     def add_zone(self, zone, user_id):
         """
@@ -104,11 +475,16 @@ class CDNDatabase:
                         "zone": zone,
                         "users": [user],
                         "records": [],
-                        "serial": strftime("%Y%m%d%S")
+                        "serial": int(strftime("%Y%m%d00"))
                     })
 
                     # Update the user's document to include new zone
-                    self.users.update_one({"_id": user}, {"$push": {"zones": new_zone.inserted_id}})
+                    self.users.update_one({"_id": user}, {
+                        "$push": {"zones": new_zone.inserted_id},
+                        "$inc": {"zone_count": 1},
+                        "$set": {"last_change": datetime.utcnow()}
+                    })
+                    self._invalidate(("zone", zone), ("user", user))
 
                     return None  # No error
                 else:
@@ -126,43 +502,135 @@ class CDNDatabase:
         :return: Error, None if success
         """
 
-        if self.zone_exists(zone):
-            zone_doc = self.zones.find_one({"zone": zone})
-
+        zone_doc = self._get_zone(zone)
+        if zone_doc:
             zone_users = zone_doc.get("users")
             if zone_users:
-                for user in zone_users:
-                    # Pull the zone doc out of the user's zones array
-                    self.users.update_one({"_id": user}, {"$pull": {"zones": zone_doc["_id"]}})
+                # Pull the zone doc out of the users' zones arrays
+                self.users.update_many({"_id": {"$in": zone_users}}, {
+                    "$pull": {"zones": zone_doc["_id"]},
+                    "$inc": {"zone_count": -1, "record_count": -len(zone_doc.get("records") or [])},
+                    "$set": {"last_change": datetime.utcnow()}
+                })
 
             # Delete the zone itself
             self.zones.delete_one({"_id": zone_doc["_id"]})
+            self.journal.delete_many({"zone": zone})
+            self.record_search.delete_many({"zone": zone})
+            self._invalidate(("zone", zone), *[("user", user) for user in zone_users or []])
+            self._zone_changed(zone)
 
             return None  # No error
         else:
             return "Zone doesn't exist"
 
-    def get_zones(self, user_id: str) -> list:
+    def get_zones(self, user_id: str, skip=0, limit=None) -> list:
         """
-        Get all zones for a user
+        Get a user's zones
         :param user_id: User ID
-        :return: list of authorized zones
+        :param skip: Number of zones to skip
+        :param limit: Maximum number of zones to return, None for all
+        :return: list of authorized zones with a record_count instead of records
         """
 
-        authorized_zones = []
+        if skip or limit:
+            try:
+                user_doc = self.users.find_one({"_id": ObjectId(user_id)}, {"zones": {"$slice": [skip, limit or 2 ** 31 - 1]}})
+            except (InvalidId, TypeError):
+                return []
+        else:
+            user_doc = self._get_user(user_id, {"zones": 1})
+
+        if not (user_doc and user_doc.get("zones")):
+            return []
 
-        if self._user_exists(user_id):
-            user_doc = self.users.find_one({"_id": ObjectId(user_id)})
-            user_zones = user_doc.get("zones")
-            if user_zones:
-                for zone_id in user_zones:
-                    authorized_zones.append(self.zones.find_one({"_id": zone_id}))
+        zone_docs = self.zones.aggregate([
+            {"$match": {"_id": {"$in": user_doc["zones"]}}},
+            {"$project": {
+                "zone": 1,
+                "serial": 1,
+                "users": 1,
+                "record_count": {"$size": {"$ifNull": ["$records", []]}}
+            }}
+        ])
 
-        return authorized_zones
+        # Keep the order of the user's zones array
+        order = {zone_id: index for index, zone_id in enumerate(user_doc["zones"])}
+        return sorted(zone_docs, key=lambda zone_doc: order[zone_doc["_id"]])
+
+    def search_zones(self, user_id: str, query: str, skip=0, limit=100, prefix=True):
+        """
+        Search a user's zones by name, ignoring case like record searches
+        :param user_id: User ID
+        :param query: Search string
+        :param skip: Number of zones to skip
+        :param limit: Maximum number of zones to return
+        :param prefix: Match the start of the name instead of anywhere in it
+        :return: (list of zones with a record_count, total matching zones)
+        """
+
+        try:
+            user = ObjectId(user_id)
+        except (InvalidId, TypeError):
+            return [], 0
+
+        match = {"users": user, "zone": {"$regex": ("^" if prefix else "") + re.escape(query), "$options": "i"}}
+
+        zone_docs = list(self.zones.aggregate([
+            {"$match": match},
+            {"$sort": {"zone": 1}},
+            {"$skip": skip},
+            {"$limit": limit},
+            {"$project": {"zone": 1, "serial": 1, "users": 1, "record_count": {"$size": {"$ifNull": ["$records", []]}}}}
+        ]))
+
+        return zone_docs, self.zones.count_documents(match)
 
     # End zone methods
     # Start record methods
 
+    def _journal(self, zone: str, serial: int, added=None, deleted=None):
+        """
+        Claim a serial by journaling its change before the zone is written
+        The unique zone, serial and part index lets only one writer claim each serial
+        :param zone: Zone as string
+        :param serial: Serial the change will produce
+        :param added: List of added records
+        :param deleted: List of deleted records
+        :return: claim token, None if another writer holds the serial
+        """
+
+        added = added or []
+        deleted = deleted or []
+        token = secrets.token_hex(8)
+        now = datetime.utcnow()
+
+        if len(added) + len(deleted) > MAX_JOURNAL_RECORDS:
+            chunks = [{"full": True}]
+        else:
+            chunks = [{"added": added[i:i + JOURNAL_CHUNK], "deleted": []} for i in range(0, len(added), JOURNAL_CHUNK)]
+            chunks += [{"added": [], "deleted": deleted[i:i + JOURNAL_CHUNK]} for i in range(0, len(deleted), JOURNAL_CHUNK)]
+            chunks = chunks or [{"added": [], "deleted": []}]
+
+        documents = [dict(chunk, zone=zone, serial=serial, part=part, parts=len(chunks), token=token, time=now) for part, chunk in enumerate(chunks)]
+
+        for _ in range(2):
+            try:
+                self.journal.insert_many(documents, ordered=True)
+                return token
+            except (BulkWriteError, DuplicateKeyError):
+                self.journal.delete_many({"zone": zone, "serial": serial, "token": token})
+
+            # Take over a claim left behind by a writer that died before bumping the serial
+            claim = self.journal.find_one({"zone": zone, "serial": serial}, {"token": 1, "time": 1})
+            if not claim or claim["time"] > now - timedelta(seconds=JOURNAL_CLAIM_TIMEOUT):
+                return None
+            if not self.zones.find_one({"zone": zone, "serial": serial - 1}, {"_id": 1}):
+                return None
+            self.journal.delete_many({"zone": zone, "serial": serial, "token": claim.get("token")})
+
+        return None
+
     def add_record(self, zone: str, domain: str, _type: str, value: str, ttl: str):
         """
         Add a record to a zone
@@ -171,47 +639,333 @@ class CDNDatabase:
         :param _type: Record type
         :param value: Record value
         :param ttl: TTL
-        :return:
+        :return: Error, None if success
         """
 
-        if self.zone_exists(zone) and (zone and domain and _type and value and ttl):
-            self.zones.update_one({"zone": zone}, {"$push": {"records": {
-                "domain": domain,
-                "type": _type,
-                "value": value,
-                "ttl": ttl
-            }}})
+        if zone:
+            return self.add_records(zone, [{"domain": domain, "type": _type, "value": value, "ttl": ttl}])
 
-            self.zones.update_one({"zone": zone}, {"$set": {"serial": strftime("%Y%m%d%S")}})
-        else:
-            return "Zone doesn't exist or entry is blank"
+        return "Zone doesn't exist"
+
+    def add_records(self, zone: str, records: list):
+        """
+        Add many validated records to a zone in a single write, bumping the serial once
+        :param zone: Parent zone
+        :param records: List of record dicts with domain, type, value and ttl
+        :return: Error, None if success
+        """
+
+        if not records:
+            return None  # Nothing to add
+
+        return self.apply_records(zone, create=records)
+
+    def apply_records(self, zone: str, create=None, update=None, delete=None):
+        """
+        Create, update and delete records of a zone together, bumping the serial once
+        :param zone: Parent zone
+        :param create: List of record dicts with domain, type, value and ttl
+        :param update: List of record dicts with id, domain, type, value and ttl
+        :param delete: List of record IDs
+        :return: Error, None if success
+        """
+
+        create = create or []
+        update = update or []
+        delete = delete or []
+
+        try:
+            update_ids = [ObjectId(record.get("id")) for record in update]
+            delete_ids = [ObjectId(record_id) for record_id in delete]
+        except (InvalidId, TypeError):
+            return "Invalid record ID"
+
+        seen_ids = set()
+        for record_id in update_ids + delete_ids:
+            if record_id in seen_ids:
+                return "Record " + str(record_id) + " is changed more than once"
+            seen_ids.add(record_id)
+
+        for record in create + update:
+            errors = lint_record(record, zone)
+            if errors:
+                return str(record.get("domain")) + " " + str(record.get("type")) + ": " + errors[0]
+
+        new_records = [{
+            "id": ObjectId(),
+            "domain": record["domain"],
+            "type": str(record["type"]).upper(),
+            "value": record["value"],
+            "ttl": record["ttl"]
+        } for record in create]
+        updated_records = [{
+            "id": record_id,
+            "domain": record["domain"],
+            "type": str(record["type"]).upper(),
+            "value": record["value"],
+            "ttl": record["ttl"]
+        } for record_id, record in zip(update_ids, update)]
+
+        # Fetch only existing records touched by the batch: same owner names or same IDs
+        origin = zone.lower().rstrip(".") + "."
+        names = {owner_name(record["domain"], zone) for record in create + update}
+        spellings = [spelling for name in names for spelling in ((name, origin) if name == "@" else (name, name + "." + origin))]
+        changed_ids = set(update_ids) | set(delete_ids)
+
+        # Deleted and updated records are replaced in place and new ones appended, in one atomic update.
+        # Record values are wrapped in $literal since TXT values may start with $
+        records = {"$ifNull": ["$records", []]}
+        if delete_ids:
+            records = {"$filter": {"input": records, "cond": {"$eq": [{"$in": ["$$this.id", delete_ids]}, False]}}}
+        if updated_records:
+            records = {"$map": {"input": records, "in": {"$switch": {
+                "branches": [{"case": {"$eq": ["$$this.id", record["id"]]}, "then": {"$literal": record}} for record in updated_records],
+                "default": "$$this"
+            }}}}
+        if new_records:
+            records = {"$concatArrays": [records, {"$literal": new_records}]}
+
+        for attempt in range(SERIAL_RETRIES):
+            existing = next(self.zones.aggregate([
+                {"$match": {"zone": zone}},
+                {"$project": {"serial": 1, "records": {"$filter": {
+                    "input": {"$ifNull": ["$records", []]},
+                    "cond": {"$or": [
+                        {"$in": [{"$toLower": "$$this.domain"}, spellings]},
+                        {"$in": ["$$this.id", update_ids + delete_ids]}
+                    ]}
+                }}}}
+            ]), None)
+            if existing is None:
+                return "Zone doesn't exist"
+
+            by_id = {record.get("id"): record for record in existing["records"]}
+            for record_id in update_ids + delete_ids:
+                if record_id not in by_id:
+                    return "Record " + str(record_id) + " doesn't exist"
+
+            conflicts = find_conflicts(zone, [record for record in existing["records"] if record.get("id") not in changed_ids] + updated_records + new_records)
+            if conflicts:
+                return conflicts[0]
+
+            # Journal first, so every serial a client can see has its change recorded
+            serial = existing["serial"]
+            token = self._journal(zone, serial + 1, added=updated_records + new_records,
+                                  deleted=[by_id[record_id] for record_id in update_ids + delete_ids])
+            if token is None:
+                time.sleep(0.01 * (attempt + 1))
+                continue
+
+            # Only applies if nobody else changed the zone since it was read
+            zone_doc = self.zones.find_one_and_update({"zone": zone, "serial": serial}, [{"$set": {
+                "records": records,
+                "serial": {"$add": ["$serial", 1]}
+            }}], projection={"users": 1})
+            self._invalidate(("zone", zone))
+
+            if zone_doc:
+                self._count_change(zone_doc.get("users"), records=len(new_records) - len(delete_ids))
+                self._index_records(zone, updated_records + new_records, update_ids + delete_ids)
+                self._zone_changed(zone)
+                return None
+
+            self.journal.delete_many({"zone": zone, "serial": serial + 1, "token": token})
+
+        return ZONE_BUSY
+
+    def _index_records(self, zone: str, records: list, removed_ids: list):
+        """
+        Keep the record search keys in step with a zone write
+        :param zone: Zone as string
+        :param records: Created and updated records
+        :param removed_ids: IDs of updated and deleted records
+        """
+
+        if removed_ids:
+            self.record_search.delete_many({"zone": zone, "id": {"$in": removed_ids}})
+        if records:
+            self.record_search.insert_many([search_keys(zone, record) for record in records], ordered=False)
+
+    def upsert_records(self, zone: str, records: list):
+        """
+        Set the records of each domain and type, replacing what's there instead of appending
+        Records whose value is already set are skipped, and nothing is written if nothing changed
+        :param zone: Parent zone
+        :param records: List of record dicts with domain, type, value and ttl
+        :return: Error, None if success
+        """
+
+        origin = zone.lower().rstrip(".") + "."
+        names = {owner_name(str(record.get("domain") or ""), zone) for record in records} - {None}
+        spellings = [spelling for name in names for spelling in ((name, origin) if name == "@" else (name, name + "." + origin))]
+        existing = next(self.zones.aggregate([
+            {"$match": {"zone": zone}},
+            {"$project": {"records": {"$filter": {
+                "input": {"$ifNull": ["$records", []]},
+                "cond": {"$in": [{"$toLower": "$$this.domain"}, spellings]}
+            }}}}
+        ]), None)
+        if existing is None:
+            return "Zone doesn't exist"
+
+        current = {}
+        for record in existing["records"]:
+            current.setdefault((owner_name(record["domain"], zone), str(record["type"]).upper()), []).append(record)
+
+        create, update, delete = [], [], []
+        for record in records:
+            matches = current.get((owner_name(str(record.get("domain") or ""), zone), str(record.get("type")).upper()), [])
+            if not matches:
+                create.append(record)
+                continue
+
+            if len(matches) > 1 or matches[0]["value"] != record["value"] or str(matches[0]["ttl"]) != str(record["ttl"]):
+                update.append(dict(record, id=matches[0]["id"]))
+            delete += [match["id"] for match in matches[1:]]
+
+        if not (create or update or delete):
+            return None  # Nothing changed
+
+        return self.apply_records(zone, create, update, delete)
+
+    def update_record(self, zone: str, record_id: str, domain: str, _type: str, value: str, ttl: str):
+        """
+        Update a record by id
+        :param zone: Parent zone
+        :param record_id: Record ID
+        :param domain: Domain in BIND format
+        :param _type: Record type
+        :param value: Record value
+        :param ttl: TTL
+        :return: Error, None if success
+        """
+
+        return self.apply_records(zone, update=[{"id": record_id, "domain": domain, "type": _type, "value": value, "ttl": ttl}])
 
     def delete_record(self, zone, record_id):
         """
         Delete a record by id
         :param zone: Parent zone
-        :param record_id:
-        :return:
+        :param record_id: Record ID
+        :return: Error, None if success
         """
 
-        if self.zone_exists(zone):
-            # Get current records
-            current_records = self.zones.find_one({"zone": zone})["records"]
+        return self.apply_records(zone, delete=[record_id])
 
-            # Remove the record
-            current_records.pop(int(record_id))
+    def get_changes(self, zone: str, from_serial: int, to_serial=None):
+        """
+        Get IXFR-style changes of a zone between two serials
+        :param zone: Zone as string
+        :param from_serial: Serial the client has
+        :param to_serial: Serial to diff up to, None for the current serial
+        :return: List of {"serial", "added", "deleted"} changes in order, None if the journal doesn't cover the range
+        """
+
+        zone_doc = self.zones.find_one({"zone": zone}, {"serial": 1})
+        if zone_doc is None:
+            return None
 
-            # Set the modified records
-            self.zones.update_one({"zone": zone}, {"$set": {
-                "records": current_records,
-                "serial": strftime("%Y%m%d%S")
-            }})
+        # Journal entries past the zone's serial belong to writes still in progress
+        if to_serial is None or to_serial > zone_doc["serial"]:
+            if to_serial is not None:
+                return None
+            to_serial = zone_doc["serial"]
+
+        entries = self.journal.find({"zone": zone, "serial": {"$gt": from_serial, "$lte": to_serial}},
+                                    {"_id": 0, "serial": 1, "part": 1, "parts": 1, "full": 1, "added": 1, "deleted": 1})
+        by_serial = {}
+        for entry in entries.sort([("serial", pymongo.ASCENDING), ("part", pymongo.ASCENDING)]):
+            by_serial.setdefault(entry["serial"], []).append(entry)
+
+        # Every serial in the range must be journaled in full, otherwise a full transfer is needed
+        if len(by_serial) < to_serial - from_serial:
+            return None
+
+        changes = []
+        for serial in range(from_serial + 1, to_serial + 1):
+            parts = by_serial.get(serial)
+            if not parts or len(parts) != parts[0].get("parts", 1) or any(part.get("full") for part in parts):
+                return None
+
+            changes.append({
+                "serial": serial,
+                "added": [record for part in parts for record in part.get("added", [])],
+                "deleted": [record for part in parts for record in part.get("deleted", [])]
+            })
+
+        return changes
+
+    def get_records(self, zone, skip=0, limit=100, search=None, prefix=False):
+        """
+        Get a page of a zone's records without loading the whole zone
+        Searches match the lowercased keys in record_search, so prefix searches use its indexes
+        :param zone: Zone as string
+        :param skip: Number of records to skip
+        :param limit: Maximum number of records to return
+        :param search: Only include records whose domain or value matches, or whose type equals this, ignoring case
+        :param prefix: Match the start of domain and value instead of anywhere in them
+        :return: Zone document with the page of records and a record_count, None if zone doesn't exist
+        """
+
+        if not search:
+            return next(self.zones.aggregate([
+                {"$match": {"zone": zone}},
+                {"$project": {
+                    "zone": 1,
+                    "serial": 1,
+                    "record_count": {"$size": {"$ifNull": ["$records", []]}},
+                    "records": {"$slice": [{"$ifNull": ["$records", []]}, skip, limit]}
+                }}
+            ]), None)
+
+        pattern = ("^" if prefix else "") + re.escape(search.lower())
+        keys = {"zone": zone, "$or": [
+            {"domain": {"$regex": pattern}},
+            {"value": {"$regex": pattern}},
+            {"type": search.lower()}
+        ]}
+        page_ids = [key["id"] for key in self.record_search.find(keys, {"id": 1}).sort("id", 1).skip(skip).limit(limit)]
+
+        zone_doc = next(self.zones.aggregate([
+            {"$match": {"zone": zone}},
+            {"$project": {"zone": 1, "serial": 1, "records": {"$filter": {
+                "input": {"$ifNull": ["$records", []]},
+                "cond": {"$in": ["$$this.id", page_ids]}
+            }}}}
+        ]), None)
+        if zone_doc is not None:
+            zone_doc["record_count"] = self.record_search.count_documents(keys)
+
+        return zone_doc
+
+    def iter_records(self, zone, batch_size=1000):
+        """
+        Stream every record of a zone from a single cursor
+        The zone document is read once, so records aren't skipped or repeated when it changes meanwhile
+        :param zone: Zone as string
+        :param batch_size: Records per batch fetched from the database
+        :return: record iterator, empty if the zone doesn't exist
+        """
+
+        return self.zones.aggregate([
+            {"$match": {"zone": zone}},
+            {"$unwind": "$records"},
+            {"$replaceRoot": {"newRoot": "$records"}}
+        ], batchSize=batch_size)
 
     # End record methods
     # Start node methods
 
-    def get_nodes(self):
-        return list(self.nodes.find())
+    def get_nodes(self, max_age=30):
+        """
+        Get all nodes, cached in process since nodes rarely change
+        :param max_age: Seconds to reuse the cached node list
+        :return: list of nodes
+        """
+        if self._nodes_cache is None or time.monotonic() - self._nodes_cache[0] > max_age:
+            self._nodes_cache = (time.monotonic(), list(self.nodes.find()))
+
+        return self._nodes_cache[1]
 
     def add_node(self, uid: str, location: str, management: str, operational: bool):
         """
@@ -219,7 +973,7 @@ class CDNDatabase:
         :param uid: location-country_code. For example Fremont, California is fmt-us
         :param location: Full location, for example: Fremont, California
         :param management: Management IP address
-        :param operational: Is the node operational?
+        :param operational: Is the node operational? Updated by the prober (python3 -m lib.prober)
         :return:
         """
 
@@ -229,6 +983,16 @@ class CDNDatabase:
             "management": management,
             "operational": operational
         })
+        self._nodes_cache = None
+
+    def update_node_health(self, health):
+        """
+        Store prober results on the nodes
+        :param health: {node _id: health dict}
+        """
+        if health:
+            self.nodes.bulk_write([pymongo.UpdateOne({"_id": node_id}, {"$set": node_health}) for node_id, node_health in health.items()], ordered=False)
+        self._nodes_cache = None
 
     # End node methods
 
@@ -239,20 +1003,88 @@ class CDNDatabase:
         :param zone:
         :return:
         """
-        if self._user_exists(user_id) and self.zone_exists(zone):
-            zone_doc = self.zones.find_one({"zone": zone})
-            return ObjectId(user_id) in zone_doc["users"]
-        else:
+        try:
+            user = ObjectId(user_id)
+        except (InvalidId, TypeError):
             return False
 
+        return self._cached(("authorized", user, zone),
+                            lambda: self.zones.find_one({"zone": zone, "users": user}, {"_id": 1}) is not None)
+
+    def authorized_zones(self, user_id, zones) -> set:
+        """
+        Find which of many zones a user is authorized for, in one query
+        :param user_id: User ID
+        :param zones: Iterable of zone names
+        :return: set of authorized zone names
+        """
+        try:
+            user = ObjectId(user_id)
+        except (InvalidId, TypeError):
+            return set()
+
+        return {zone_doc["zone"] for zone_doc in self.zones.find({"zone": {"$in": list(zones)}, "users": user}, {"_id": 0, "zone": 1})}
+
     def get_zone(self, user, zone):
         if self.authorized_for_zone(user, zone):
-            return self.zones.find_one({"zone": zone})
+            return self._get_zone(zone)
         else:
             return "Error: Zone not authorized"
 
-    def get_all_zones(self):
-        return self.zones.find({})
+    def get_all_zones(self, batch_size=500):
+        """
+        Get a cursor over every zone with only the fields needed to render it
+        :param batch_size: Number of zones fetched per round trip
+        :return: zone cursor
+        """
+        return self.zones.find({}, {"_id": 0, "zone": 1, "serial": 1, "records": 1}).batch_size(batch_size)
+
+    def get_zone_serials(self, zones=None) -> dict:
+        """
+        Get the serial of every zone
+        :param zones: Iterable of zone names to limit to, None for every zone
+        :return: {zone: serial}
+        """
+        query = {} if zones is None else {"zone": {"$in": list(zones)}}
+        return {zone["zone"]: zone["serial"] for zone in self.zones.find(query, {"_id": 0, "zone": 1, "serial": 1})}
+
+    def get_zone_sample(self, size: int) -> list:
+        """
+        Pick random zones
+        :param size: Number of zones
+        :return: list of zone names
+        """
+        return [zone["zone"] for zone in self.zones.aggregate([{"$sample": {"size": size}}, {"$project": {"zone": 1}}])]
+
+    def get_changed_zones(self, since, limit=1000) -> list:
+        """
+        Get the zones with journaled changes since a time, most recently changed first
+        :param since: UTC datetime
+        :param limit: Maximum number of zones
+        :return: list of zone names
+        """
+        return [row["_id"] for row in self.journal.aggregate([
+            {"$match": {"time": {"$gte": since}}},
+            {"$group": {"_id": "$zone", "time": {"$max": "$time"}}},
+            {"$sort": {"time": -1}},
+            {"$limit": limit}
+        ])]
+
+    def get_zone_ids(self) -> dict:
+        """
+        Get the document ID of every zone
+        :return: {zone: ObjectId}
+        """
+        return {zone["zone"]: zone["_id"] for zone in self.zones.find({}, {"zone": 1})}
+
+    def get_export_zones(self, zones, batch_size=500):
+        """
+        Get a cursor over some zones with only the fields needed to render them
+        :param zones: Iterable of zone names
+        :param batch_size: Number of zones fetched per round trip
+        :return: zone cursor
+        """
+        return self.zones.find({"zone": {"$in": list(zones)}}, {"_id": 0, "zone": 1, "serial": 1, "records": 1}).batch_size(batch_size)
 
     def get_total_records(self, user: str) -> int:
         """
@@ -260,9 +1092,14 @@ class CDNDatabase:
         :param user: User's id
         :return: number of records
         """
-        total_records = 0
-        if self._user_exists(user):
-            for zone in self.get_zones(user):
-                total_records += len(zone["records"])
 
-        return total_records
+        user_doc = self._get_user(user, {"zones": 1})
+        if not (user_doc and user_doc.get("zones")):
+            return 0
+
+        result = list(self.zones.aggregate([
+            {"$match": {"_id": {"$in": user_doc["zones"]}}},
+            {"$group": {"_id": None, "total": {"$sum": {"$size": {"$ifNull": ["$records", []]}}}}}
+        ]))
+
+        return result[0]["total"] if result else 0
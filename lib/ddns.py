@@ -0,0 +1,130 @@
+import threading
+import time
+
+from lib.database import ZONE_BUSY
+from lib.linter import lint_record
+
+
+class DDNSBuffer:
+    """
+    Write-behind buffer for dynamic DNS updates
+    Repeated check-ins with an unchanged address are dropped, the rest are coalesced and
+    flushed per zone so each zone gets at most one serial bump per flush window
+    """
+
+    def __init__(self, db, interval=10, ttl="60"):
+        self.db = db
+        self.interval = interval
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._pending = {}  # zone -> {(domain, type): address}
+        self._flushing = {}  # zone -> {(domain, type): address} being written
+        self._known = {}  # zone -> {(domain, type): last written address}
+
+        # Any other change to a zone's records makes its last written addresses unreliable
+        db.on_zone_change(self.forget)
+
+    def check(self, zone, domain, address):
+        """
+        Lint the record an update would write, so invalid names are refused instead of failing every flush
+        :param zone: Zone
+        :param domain: Domain in BIND format
+        :param address: IPv4 or IPv6 address
+        :return: Error, None if valid
+        """
+        errors = lint_record({"domain": domain, "type": "AAAA" if ":" in address else "A", "value": address, "ttl": self.ttl}, zone)
+        return errors[0] if errors else None
+
+    def update(self, zone, domain, address) -> bool:
+        """
+        Queue an address update
+        :param zone: Zone
+        :param domain: Domain in BIND format
+        :param address: IPv4 or IPv6 address
+        :return: True if queued, False if the address hasn't changed
+        """
+        _type = "AAAA" if ":" in address else "A"
+
+        key = (domain, _type)
+
+        with self._lock:
+            # What the record will hold once the writes in flight are done
+            expected = self._flushing.get(zone, {}).get(key, self._known.get(zone, {}).get(key))
+            if expected == address:
+                # Back to the written address, so a queued change away from it is dropped too
+                pending = self._pending.get(zone, {})
+                pending.pop(key, None)
+                if not pending:
+                    self._pending.pop(zone, None)
+                return False
+
+            self._pending.setdefault(zone, {})[key] = address
+            return True
+
+    def forget(self, zone):
+        """
+        Drop the last written addresses of a zone, called when its records change
+        :param zone: Zone
+        """
+        with self._lock:
+            self._known.pop(zone, None)
+
+    def flush(self) -> dict:
+        """
+        Write every pending update, one upsert per zone
+        Updates that failed for a reason that can pass are queued again, unless newer ones arrived meanwhile
+        :return: {zone: error} for zones that failed
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushing = dict(pending)
+
+        errors = {}
+        for zone, updates in pending.items():
+            try:
+                error = self.db.upsert_records(zone, [{
+                    "domain": domain,
+                    "type": _type,
+                    "value": address,
+                    "ttl": self.ttl
+                } for (domain, _type), address in updates.items()])
+                retry = error == ZONE_BUSY
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                retry = True
+
+            with self._lock:
+                del self._flushing[zone]
+                if not error:
+                    self._known.setdefault(zone, {}).update(updates)
+                elif retry:
+                    queued = self._pending.setdefault(zone, {})
+                    for key, address in updates.items():
+                        queued.setdefault(key, address)
+
+            if error:
+                errors[zone] = error
+
+        return errors
+
+    def run(self):
+        """
+        Flush forever, every interval seconds
+        """
+        while True:
+            time.sleep(self.interval)
+            try:
+                errors = self.flush()
+            except Exception as e:
+                print("DDNS flush failed: " + (str(e) or type(e).__name__))
+                continue
+
+            for zone, error in errors.items():
+                print("DDNS flush for " + zone + " failed: " + error)
+
+    def start(self):
+        """
+        Start flushing in a background thread
+        """
+        threading.Thread(target=self.run, daemon=True).start()
@@ -1,30 +1,281 @@
+import hashlib
+import itertools
+import json
 import os
-from time import strftime
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter, strftime
 
-from jinja2 import Template
+from lib.aggregator import zone_hash
+from lib.config import configuration
+from lib.linter import lint_zone
+from lib.renderer import render, render_zone_file
 
+DNS_DIR = "source/dns"
+NODES_DIR = "source/nodes"
+MANIFEST = "manifest.json"
+DEPLOYED = "deployed.json"
+KEEP_GENERATIONS = 3
+SLOWEST_ZONES = 10
 
-def build_zones(zones):
-    os.system("rm -rf source/dns/db.*")
-    with open("../config/local.j2") as local_template_file:
-        local_template = local_template_file.read()
+# Distinguishes generations created by one process within the same second
+_generation_counter = itertools.count()
 
-    with open("../config/zone.j2") as zone_template_file:
-        zone_template = zone_template_file.read()
+# Per-node config files, file name -> template
+NODE_TEMPLATES = {
+    "bird.conf": "bird.j2",
+    "named.conf.options": "named.conf.options.j2",
+    "network.sh": "network.j2"
+}
 
-    local = ""
+
+def _read_manifest(directory, name=MANIFEST, empty=None):
+    """
+    Read the manifest of an export
+    :param directory: Export generation directory
+    :param name: Manifest file name
+    :param empty: Manifest to return if there was no export, defaults to no zones
+    :return: manifest dict
+    """
+    try:
+        with open(os.path.join(directory, name), "r") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {"zones": {}} if empty is None else empty
+
+
+def _write_file(path, data):
+    """
+    Write and fsync a file
+    :param path: File path
+    :param data: File content
+    """
+    with open(path, "w") as output_file:
+        output_file.write(data)
+        output_file.flush()
+        os.fsync(output_file.fileno())
+
+
+def _render(zone):
+    """
+    Render a zone file in a worker process
+    :param zone: (serial, records)
+    :return: (rendered zone file, render seconds)
+    """
+    start = perf_counter()
+    zone_file = render_zone_file(*zone)
+    return zone_file, perf_counter() - start
+
+
+def _render_node(node_vars):
+    """
+    Render the config files of a node in a worker process
+    :param node_vars: Template variables
+    :return: {file name: rendered file}
+    """
+    return {file_name: render(template, **node_vars) for file_name, template in NODE_TEMPLATES.items()}
+
+
+def _new_generation(directory):
+    """
+    Create an empty generation directory
+    :param directory: Export directory
+    :return: (generation name, generation path)
+    """
+    generation_name = strftime("%Y%m%d%H%M%S") + "-" + str(next(_generation_counter)).zfill(6) + "-" + str(os.getpid())
+    generation = os.path.join(directory, "generations", generation_name)
+    os.makedirs(generation)
+    return generation_name, generation
+
+
+def _swap_current(directory, generation_name, keep):
+    """
+    Atomically point <directory>/current at a finished generation and remove old ones
+    :param directory: Export directory
+    :param generation_name: Name of the new generation
+    :param keep: Number of generations to keep
+    """
+    generations_dir = os.path.join(directory, "generations")
+
+    # Make sure the directory entries are on disk before the swap
+    directory_fd = os.open(os.path.join(generations_dir, generation_name), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+    current = os.path.join(directory, "current")
+    tmp_link = current + ".tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join("generations", generation_name), tmp_link)
+    os.replace(tmp_link, current)
+
+    _collect_generations(generations_dir, generation_name, keep)
+
+
+def _collect_generations(generations_dir, current_generation, keep):
+    """
+    Remove all but the newest generations
+    :param generations_dir: Directory holding the generations
+    :param current_generation: Name of the live generation, never removed
+    :param keep: Number of generations to keep
+    """
+    for name in sorted(os.listdir(generations_dir))[:-keep]:
+        if name != current_generation:
+            shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+
+
+def build_zones(zones, directory=DNS_DIR, workers=None, keep=KEEP_GENERATIONS, force=False):
+    """
+    Export zone files and named.conf.local into a new generation and atomically make it current
+    Zones unchanged since the last export are hard linked, the rest are rendered in a process pool
+    A changed zone that fails lint keeps its last exported version. If it was never exported,
+    the whole export is aborted instead of dropping the zone from the nodes
+    :param zones: Iterable of zone documents
+    :param directory: Export directory, the live generation is <directory>/current
+    :param workers: Render processes, None for one per CPU
+    :param keep: Number of generations to keep
+    :param force: Export zones that fail lint and have no previous version as they are
+    :return: (manifest dict, report dict), manifest is None if the export was aborted
+    """
+    start = perf_counter()
+
+    current = os.path.join(directory, "current")
+    generation_name, generation = _new_generation(directory)
+
+    previous = _read_manifest(current)
+
+    manifest = {"generation": generation_name, "zones": {}}
+    to_render = []
+    render_stats = []
+    lint_errors = {}
+    unexported = []
     for zone in zones:
-        local += Template(local_template).render(zone=zone["zone"])
+        content_hash = zone_hash(zone)
+        previous_entry = previous["zones"].get(zone["zone"])
+        previous_path = os.path.join(current, "db." + zone["zone"])
+
+        if not (previous_entry and previous_entry["hash"] == content_hash):
+            # Pre-flight check changed zones, a broken zone keeps its last good version
+            errors = lint_zone(zone["zone"], zone.get("records") or [])
+            if errors:
+                lint_errors[zone["zone"]] = errors
+                if previous_entry and os.path.exists(previous_path):
+                    manifest["zones"][zone["zone"]] = previous_entry
+                    os.link(previous_path, os.path.join(generation, "db." + zone["zone"]))
+                    continue
+                if not force:
+                    unexported.append(zone["zone"])
+                    continue
+
+        manifest["zones"][zone["zone"]] = {"serial": zone["serial"], "hash": content_hash}
+
+        if previous_entry and previous_entry["hash"] == content_hash and os.path.exists(previous_path):
+            os.link(previous_path, os.path.join(generation, "db." + zone["zone"]))
+        else:
+            to_render.append(zone)
+
+    if unexported:
+        shutil.rmtree(generation, ignore_errors=True)
+        return None, {
+            "error": str(len(unexported)) + " zones fail lint and were never exported: " + ", ".join(sorted(unexported)[:20]),
+            "lint_errors": lint_errors
+        }
 
-        with open("source/dns/db." + zone["zone"], "w") as zone_file:
-            zone_file.write(Template(zone_template).render(
-                zone=zone["zone"],
-                records=zone.get("records"),
-                serial=strftime("%Y%m%d%S"))
-            )
+    if to_render:
+        with ProcessPoolExecutor(workers) as pool:
+            rendered = pool.map(_render, [(zone["serial"], zone["records"]) for zone in to_render], chunksize=64)
+            for zone, (zone_file, render_seconds) in zip(to_render, rendered):
+                _write_file(os.path.join(generation, "db." + zone["zone"]), zone_file)
+                render_stats.append((zone["zone"], round(render_seconds, 4), len(zone_file)))
 
-    with open("../source/dns/named.conf.local", "w") as zones_file:
-        zones_file.write(local)
+    _write_file(os.path.join(generation, "named.conf.local"), "".join(render("local.j2", zone=zone) for zone in sorted(manifest["zones"])))
+    _write_file(os.path.join(generation, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True))
+    _swap_current(directory, generation_name, keep)
+
+    elapsed = perf_counter() - start
+    report = {
+        "zones": len(manifest["zones"]),
+        "rendered": len(to_render),
+        "seconds": round(elapsed, 3),
+        "zones_per_second": round(len(manifest["zones"]) / elapsed) if elapsed else len(manifest["zones"]),
+        "render_seconds": round(sum(stat[1] for stat in render_stats), 3),
+        "rendered_bytes": sum(stat[2] for stat in render_stats),
+        "slowest": sorted(render_stats, key=lambda stat: -stat[1])[:SLOWEST_ZONES],
+        "lint_errors": lint_errors
+    }
+
+    return manifest, report
+
+
+def build_node_configs(nodes, directory=NODES_DIR, workers=None, keep=KEEP_GENERATIONS):
+    """
+    Render BIRD, BIND and network configs of every node into a new generation and atomically make it current
+    Nodes can override asn, ipv4_prefix, ipv6_prefix and loopbacks from config.yml
+    :param nodes: Node documents
+    :param directory: Export directory, the live generation is <directory>/current/<uid>
+    :param workers: Render processes, None for one per CPU
+    :param keep: Number of generations to keep
+    :return: (manifest dict, report dict), the report lists nodes whose config differs from the deployed one
+    """
+    start = perf_counter()
+    nodes = list(nodes)
+    generation_name, generation = _new_generation(directory)
+
+    node_vars = [{
+        "ansible_host": node["management"],
+        "ansible_hostname": node["uid"],
+        "asn": node.get("asn", configuration["asn"]),
+        "ipv4_prefix": node.get("ipv4_prefix", configuration["ipv4_prefix"]),
+        "ipv6_prefix": node.get("ipv6_prefix", configuration["ipv6_prefix"]),
+        "edge_ips": node.get("loopbacks", configuration.get("loopbacks", []))
+    } for node in nodes]
+
+    manifest = {"generation": generation_name, "nodes": {}}
+    with ProcessPoolExecutor(workers) as pool:
+        for node, files in zip(nodes, pool.map(_render_node, node_vars, chunksize=16)):
+            node_dir = os.path.join(generation, node["uid"])
+            os.makedirs(node_dir)
+
+            content_hash = hashlib.sha1()
+            for file_name in sorted(files):
+                _write_file(os.path.join(node_dir, file_name), files[file_name])
+                content_hash.update(file_name.encode() + b"\0" + files[file_name].encode() + b"\0")
+            manifest["nodes"][node["uid"]] = content_hash.hexdigest()
+
+    _write_file(os.path.join(generation, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True))
+    _swap_current(directory, generation_name, keep)
+
+    deployed = _read_manifest(directory, DEPLOYED, {"nodes": {}})
+    elapsed = perf_counter() - start
+    report = {
+        "nodes": len(manifest["nodes"]),
+        "changed": sorted(uid for uid, content_hash in manifest["nodes"].items() if deployed["nodes"].get(uid) != content_hash),
+        "seconds": round(elapsed, 3)
+    }
+
+    return manifest, report
+
+
+def mark_deployed(manifest, hosts, directory=NODES_DIR):
+    """
+    Record the node configs that were deployed, later builds only target nodes that differ from them
+    :param manifest: Manifest returned by build_node_configs
+    :param hosts: Node uids the configs were deployed to
+    :param directory: Export directory
+    """
+    deployed = _read_manifest(directory, DEPLOYED, {"nodes": {}})
+    for uid in hosts:
+        deployed["nodes"][uid] = manifest["nodes"][uid]
+
+    # Forget removed nodes
+    deployed["nodes"] = {uid: content_hash for uid, content_hash in deployed["nodes"].items() if uid in manifest["nodes"]}
+
+    tmp_path = os.path.join(directory, DEPLOYED + ".tmp")
+    _write_file(tmp_path, json.dumps(deployed, indent=2, sort_keys=True))
+    os.replace(tmp_path, os.path.join(directory, DEPLOYED))
 
 
 def build_nodes(nodes):
@@ -34,3 +285,41 @@ def build_nodes(nodes):
 
     with open("automation/hosts", "w") as hosts_file:
         hosts_file.write(servers.strip())
+
+
+if __name__ == "__main__":
+    from lib.database import CDNDatabase
+
+    database = CDNDatabase(configuration["database"], configuration["salt"])
+
+    # python3 -m lib.exporter nodes [--dry-run]: render node configs and roll them out to nodes that changed
+    if len(sys.argv) > 1 and sys.argv[1] == "nodes":
+        from lib.runner import rollout, ssh_args
+
+        fleet = database.get_nodes(max_age=0)
+        build_nodes(fleet)
+        node_manifest, node_report = build_node_configs(fleet)
+        print("Rendered " + str(node_report["nodes"]) + " node configs to generation " + node_manifest["generation"] + " in " +
+              str(node_report["seconds"]) + "s, changed: " + (", ".join(node_report["changed"]) or "none"))
+
+        if node_report["changed"] and "--dry-run" not in sys.argv:
+            result = rollout("nodes.yml", hosts=node_report["changed"], cmdline=ssh_args())
+            mark_deployed(node_manifest, result["succeeded"])
+            print("Rollout " + ("aborted" if result["aborted"] else "finished") + " in " + str(result["seconds"]) + "s, failures: " + str(result["failed"]))
+        sys.exit(0)
+
+    # python3 -m lib.exporter [--force]: --force exports zones that fail lint and were never exported as they are
+    export_manifest, export_report = build_zones(database.get_all_zones(configuration.get("export-batch-size", 500)), force="--force" in sys.argv)
+
+    for lint_zone_name, lint_zone_errors in export_report["lint_errors"].items():
+        print("Lint errors in " + lint_zone_name + ": " + "; ".join(lint_zone_errors[:5]))
+
+    if export_manifest is None:
+        print("Export aborted, " + export_report["error"])
+        sys.exit(1)
+
+    for slow_zone, slow_seconds, slow_bytes in export_report["slowest"]:
+        print("Rendered " + slow_zone + " in " + str(slow_seconds) + "s (" + str(slow_bytes) + " bytes)")
+
+    print("Exported " + str(export_report["zones"]) + " zones (" + str(export_report["rendered"]) + " rendered) to generation " +
+          export_manifest["generation"] + " in " + str(export_report["seconds"]) + "s (" + str(export_report["zones_per_second"]) + " zones/s)")
@@ -0,0 +1,214 @@
+import csv
+import io
+import sys
+from time import perf_counter
+
+from lib.linter import lint_record, owner_name
+
+RECORD_CLASSES = {"IN", "CH", "HS"}
+
+
+def _logical_lines(lines):
+    """
+    Join parenthesized BIND entries and strip comments
+    :param lines: Iterable of zone file lines
+    :return: generator of (line number, line)
+    """
+    buffer = ""
+    start = 0
+    depth = 0
+
+    for line_number, line in enumerate(lines, 1):
+        # Comments and grouping parentheses only count outside of quoted strings, TXT values may contain both
+        quoted = False
+        escaped = False
+        kept = []
+        for char in line.rstrip("\r\n"):
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                quoted = not quoted
+            elif not quoted and char == ";":
+                break
+            elif not quoted and char in "()":
+                depth += 1 if char == "(" else -1
+                char = " "
+            kept.append(char)
+
+        line = "".join(kept)
+        if not buffer:
+            start = line_number
+
+        buffer += (" " if buffer else "") + line
+
+        if depth <= 0:
+            if buffer.strip():
+                yield start, buffer
+            buffer = ""
+            depth = 0
+
+    if buffer.strip():
+        yield start, buffer
+
+
+def _absolute_name(name, origin):
+    """
+    Resolve a BIND owner name against the current origin
+    :param name: Owner name as written
+    :param origin: Absolute origin ending with a dot, None if unknown
+    :return: absolute name, or the name unchanged if it is relative and the origin is unknown
+    """
+    if name.endswith(".") or origin is None:
+        return name
+    if name == "@":
+        return origin
+    return name + "." + origin
+
+
+def parse_bind(lines, default_ttl="86400", zone=None):
+    """
+    Parse a BIND zone file, skipping the SOA and apex NS records that delivr generates
+    :param lines: Iterable of zone file lines
+    :param default_ttl: TTL for records without one and no $TTL directive
+    :param zone: Zone name, owner names are made relative to it. None to keep them as written
+    :return: generator of (line number, record dict)
+    """
+    ttl = default_ttl
+    origin = zone.lower().rstrip(".") + "." if zone else None
+    last_domain = "@"
+
+    for line_number, line in _logical_lines(lines):
+        if line.startswith("$TTL"):
+            ttl = line.split()[1]
+            continue
+        if line.startswith("$ORIGIN"):
+            fields = line.split()
+            if len(fields) > 1:
+                origin = _absolute_name(fields[1].lower(), origin)
+            continue
+        if line.startswith("$"):
+            continue  # $INCLUDE is not supported
+
+        fields = line.split()
+        if line[0] in " \t":
+            domain = last_domain
+        else:
+            domain = _absolute_name(fields.pop(0), origin)
+            if zone and domain.endswith("."):
+                # Names outside the zone are kept absolute for the linter to reject
+                domain = owner_name(domain, zone) or domain
+            last_domain = domain
+
+        record_ttl = ttl
+        while fields and (fields[0].isdigit() or fields[0].upper() in RECORD_CLASSES):
+            if fields[0].isdigit():
+                record_ttl = fields[0]
+            fields.pop(0)
+
+        if not fields:
+            yield line_number, {"domain": domain, "type": "", "value": "", "ttl": record_ttl}
+            continue
+
+        _type = fields.pop(0).upper()
+        if _type == "SOA" or (_type == "NS" and domain == "@"):
+            continue
+
+        yield line_number, {"domain": domain, "type": _type, "value": " ".join(fields), "ttl": record_ttl}
+
+
+def parse_csv(lines):
+    """
+    Parse a CSV file with domain, type, value and ttl columns
+    :param lines: Iterable of CSV lines
+    :return: generator of (line number, record dict)
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, {
+            "domain": (row.get("domain") or "").strip(),
+            "type": (row.get("type") or "").strip().upper(),
+            "value": (row.get("value") or "").strip(),
+            "ttl": (row.get("ttl") or "").strip()
+        }
+
+
+def parse(lines, file_format, zone=None):
+    """
+    Parse and validate records
+    :param lines: Iterable of lines
+    :param file_format: "bind" or "csv"
+    :param zone: Zone name, None to skip the out-of-zone check
+    :return: (records, errors)
+    """
+    parsed = parse_csv(lines) if file_format == "csv" else parse_bind(lines, zone=zone)
+
+    records = []
+    errors = []
+    for line_number, record in parsed:
+        record_errors = lint_record(record, zone)
+        if record_errors:
+            errors += ["Line " + str(line_number) + ": " + error for error in record_errors]
+        else:
+            records.append(record)
+
+    return records, errors
+
+
+def file_format(filename) -> str:
+    """
+    Guess the import format from a filename
+    :param filename: Uploaded file name
+    :return: "csv" or "bind"
+    """
+    return "csv" if (filename or "").lower().endswith(".csv") else "bind"
+
+
+def import_records(db, zone, lines, file_format):
+    """
+    Parse, validate and write records to a zone
+    :param db: CDNDatabase
+    :param zone: Zone to import into
+    :param lines: Iterable of lines
+    :param file_format: "bind" or "csv"
+    :return: (report dict, errors)
+    """
+    start = perf_counter()
+
+    records, errors = parse(lines, file_format, zone)
+    if errors:
+        return None, errors
+
+    error = db.add_records(zone, records)
+    if error:
+        return None, [error]
+
+    elapsed = perf_counter() - start
+    return {
+        "records": len(records),
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(len(records) / elapsed) if elapsed else len(records)
+    }, []
+
+
+if __name__ == "__main__":
+    from lib.config import configuration
+    from lib.database import CDNDatabase
+
+    if len(sys.argv) < 3:
+        print("Usage: python3 -m lib.importer <zone> <file>")
+        exit(1)
+
+    database = CDNDatabase(configuration["database"], configuration["salt"])
+
+    with io.open(sys.argv[2], "r", newline="") as import_file:
+        report, import_errors = import_records(database, sys.argv[1], import_file, file_format(sys.argv[2]))
+
+    for import_error in import_errors[:50]:
+        print(import_error)
+
+    if import_errors:
+        exit(1)
+
+    print("Imported " + str(report["records"]) + " records in " + str(report["seconds"]) + "s (" + str(report["records_per_second"]) + " records/s)")
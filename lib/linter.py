@@ -0,0 +1,200 @@
+import ipaddress
+import re
+
+RECORD_TYPES = {
+    "A", "AAAA", "CNAME", "SRV", "PTR", "MX", "TXT", "NS", "CAA", "SOA",
+    # Stored before records were linted, exports must keep accepting them
+    "AFSDB", "CDNSKEY", "CDS", "CERT", "DNAME", "DNSKEY", "DS", "HINFO", "HTTPS", "LOC", "NAPTR",
+    "OPENPGPKEY", "RP", "SMIMEA", "SPF", "SSHFP", "SVCB", "TLSA", "URI"
+}
+
+# RFC 3597 generic type names, like TYPE65534
+_GENERIC_TYPE = re.compile(r"^TYPE[0-9]{1,5}$")
+
+# Types whose values start with numeric fields: type -> (numeric fields, minimum fields, format)
+_NUMERIC_PREFIX = {
+    "DS": (3, 4, "<key tag> <algorithm> <digest type> <digest>"),
+    "CDS": (3, 4, "<key tag> <algorithm> <digest type> <digest>"),
+    "TLSA": (3, 4, "<usage> <selector> <matching type> <data>"),
+    "SMIMEA": (3, 4, "<usage> <selector> <matching type> <data>"),
+    "SSHFP": (2, 3, "<algorithm> <type> <fingerprint>"),
+    "NAPTR": (2, 6, "<order> <preference> <flags> <service> <regexp> <replacement>"),
+}
+
+# RFC 2181 section 8
+MAX_TTL = 2147483647
+
+_LABEL = re.compile(r"^(\*|[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?)$", re.IGNORECASE)
+
+
+def _valid_name(name) -> bool:
+    """
+    Check if a domain name is syntactically valid
+    :param name: Relative or absolute domain name
+    :return: True if valid
+    """
+    if name == "@":
+        return True
+
+    name = name[:-1] if name.endswith(".") else name
+    if not name or len(name) > 253:
+        return False
+
+    return all(_LABEL.match(label) for label in name.split("."))
+
+
+def owner_name(domain, zone) -> str:
+    """
+    Normalize a record's owner name relative to its zone
+    :param domain: Domain in BIND format
+    :param zone: Zone name
+    :return: lowercase name relative to the zone, "@" for the apex, None if outside the zone
+    """
+    domain = domain.lower()
+    zone = zone.lower().rstrip(".")
+
+    if not domain.endswith("."):
+        return domain
+
+    domain = domain[:-1]
+    if domain == zone:
+        return "@"
+    if domain.endswith("." + zone):
+        return domain[:-len(zone) - 1]
+
+    return None
+
+
+def _check_value(_type, value):
+    """
+    Check a record value for its type
+    :return: Error, None if valid
+    """
+    fields = value.split()
+
+    if _type == "A":
+        try:
+            ipaddress.IPv4Address(value)
+        except ValueError:
+            return "Invalid IPv4 address " + value
+    elif _type == "AAAA":
+        try:
+            ipaddress.IPv6Address(value)
+        except ValueError:
+            return "Invalid IPv6 address " + value
+    elif _type in ("CNAME", "NS", "PTR"):
+        if len(fields) != 1 or not _valid_name(value):
+            return "Invalid " + _type + " target " + value
+    elif _type == "MX":
+        if len(fields) != 2 or not fields[0].isdigit() or not _valid_name(fields[1]):
+            return "MX value must be <preference> <exchange>"
+    elif _type == "SRV":
+        if len(fields) != 4 or not all(field.isdigit() for field in fields[:3]) or not _valid_name(fields[3]):
+            return "SRV value must be <priority> <weight> <port> <target>"
+    elif _type == "CAA":
+        if len(fields) < 3 or not fields[0].isdigit():
+            return "CAA value must be <flags> <tag> <value>"
+    elif _type in _NUMERIC_PREFIX:
+        numeric, minimum, value_format = _NUMERIC_PREFIX[_type]
+        if len(fields) < minimum or not all(field.isdigit() for field in fields[:numeric]):
+            return _type + " value must be " + value_format
+
+    return None
+
+
+def lint_record(record, zone=None) -> list:
+    """
+    Check a single record
+    :param record: Record dict with domain, type, value and ttl
+    :param zone: Zone name, None to skip the out-of-zone check
+    :return: list of errors
+    """
+    # A TTL of 0 is valid, so only missing and empty fields count as blank
+    fields = [record.get(field) for field in ("domain", "type", "value", "ttl")]
+    if any(field is None or str(field).strip() == "" for field in fields):
+        return ["Entry is blank"]
+
+    domain, _type, value, ttl = (str(field).strip() for field in fields)
+    _type = _type.upper()
+
+    errors = []
+
+    if _type not in RECORD_TYPES and not _GENERIC_TYPE.match(_type):
+        errors.append("Unsupported record type " + _type)
+    elif _type == "SOA":
+        errors.append("SOA records are generated by delivr")
+    else:
+        error = _check_value(_type, value)
+        if error:
+            errors.append(error)
+
+    if not ttl.isdigit() or int(ttl) > MAX_TTL:
+        errors.append("TTL must be between 0 and " + str(MAX_TTL))
+
+    if not _valid_name(domain):
+        errors.append("Invalid domain " + domain)
+    elif zone and owner_name(domain, zone) is None:
+        errors.append(domain + " is outside of zone " + zone)
+
+    return errors
+
+
+def find_conflicts(zone, records) -> list:
+    """
+    Find CNAME and other data conflicts between records
+    :param zone: Zone name
+    :param records: List of record dicts
+    :return: list of errors
+    """
+    # Owner name -> [CNAME count, other record count]
+    owners = {"@": [0, 1]}  # The apex always has SOA and NS records
+
+    for record in records:
+        name = owner_name(str(record.get("domain") or ""), zone)
+        if name is None:
+            continue
+
+        counts = owners.setdefault(name, [0, 0])
+        if str(record.get("type") or "").upper() == "CNAME":
+            counts[0] += 1
+        else:
+            counts[1] += 1
+
+    errors = []
+    for name, (cnames, others) in owners.items():
+        if cnames > 1:
+            errors.append(name + ": Multiple CNAME records")
+        if cnames and others:
+            errors.append(name + ": CNAME and other data")
+
+    return errors
+
+
+def lint_zone(zone, records) -> list:
+    """
+    Check every record of a zone and the conflicts between them
+    :param zone: Zone name
+    :param records: List of record dicts
+    :return: list of errors
+    """
+    errors = []
+    for record in records:
+        for error in lint_record(record, zone):
+            errors.append(str(record.get("domain")) + " " + str(record.get("type")) + ": " + error)
+
+    return errors + find_conflicts(zone, records)
+
+
+def lint_zones(zones) -> dict:
+    """
+    Check every zone
+    :param zones: Iterable of zone documents
+    :return: {zone name: list of errors} for zones with errors
+    """
+    results = {}
+    for zone in zones:
+        errors = lint_zone(zone["zone"], zone.get("records") or [])
+        if errors:
+            results[zone["zone"]] = errors
+
+    return results
@@ -0,0 +1,178 @@
+import hmac
+import ipaddress
+import json
+import os
+import threading
+
+# Only the end of the rollout log is read, it grows with every rollout and push
+ROLLOUT_LOG_TAIL = 65536
+
+# Clients allowed to read metrics without a token
+LOCAL_NETWORKS = ("127.0.0.0/8", "::1/128")
+
+# Default latency buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics = {}
+_collectors = []
+
+
+def _labels(labels) -> str:
+    """
+    Format labels for the Prometheus text format
+    :param labels: Tuple of (name, value) pairs
+    :return: {name="value",...} or "" without labels
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels) + "}"
+
+
+def _metric(name, kind, description):
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = {"kind": kind, "description": description, "values": {}}
+    return metric
+
+
+def inc(name, description="", value=1, **labels):
+    """
+    Increment a counter
+    :param name: Metric name
+    :param description: Help text
+    :param value: Amount to add
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _metric(name, "counter", description)["values"]
+        values[key] = values.get(key, 0) + value
+
+
+def set_gauge(name, value, description="", **labels):
+    """
+    Set a gauge
+    :param name: Metric name
+    :param value: Value
+    :param description: Help text
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        _metric(name, "gauge", description)["values"][key] = value
+
+
+def replace_gauges(name, values, description=""):
+    """
+    Replace every value of a gauge, dropping label sets that are no longer present
+    :param name: Metric name
+    :param values: List of (labels dict, value)
+    :param description: Help text
+    """
+    with _lock:
+        _metric(name, "gauge", description)["values"] = {tuple(sorted(labels.items())): value for labels, value in values}
+
+
+def register_collector(collector):
+    """
+    Register a function called before every render to refresh gauges
+    :param collector: Function without arguments
+    """
+    _collectors.append(collector)
+
+
+def observe(name, value, description="", buckets=BUCKETS, **labels):
+    """
+    Record a value in a histogram
+    :param name: Metric name
+    :param value: Observed value
+    :param description: Help text
+    :param buckets: Bucket upper bounds
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _metric(name, "histogram", description)["values"]
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+
+        for index, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def _rollout_gauges(log_path):
+    """
+    Export the last rollout of every playbook from the runner's rollout log
+    :param log_path: Path of the rollout log
+    """
+    if not os.path.exists(log_path):
+        return
+
+    last = {}
+    with open(log_path, "rb") as log_file:
+        log_file.seek(max(os.path.getsize(log_path) - ROLLOUT_LOG_TAIL, 0))
+        for line in log_file:
+            # The first line may be cut off by the seek
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            last[entry.get("playbook", "")] = entry
+
+    for playbook, entry in last.items():
+        set_gauge("delivr_rollout_last_seconds", entry.get("seconds", 0), "Duration of the last rollout", playbook=playbook)
+        set_gauge("delivr_rollout_last_failed_hosts", len(entry.get("failed", [])), "Failed hosts in the last rollout", playbook=playbook)
+        set_gauge("delivr_rollout_last_timestamp", entry.get("started", 0), "Start time of the last rollout", playbook=playbook)
+
+
+def authorized(address, authorization, token=None, allow=LOCAL_NETWORKS) -> bool:
+    """
+    Check that a client may read metrics
+    :param address: Address the connection came from, not a forwarded header a client can set
+    :param authorization: Authorization header
+    :param token: Bearer token that allows any address, None to only use the allowlist
+    :param allow: Networks allowed without the token
+    :return: True if allowed
+    """
+    if token and hmac.compare_digest((authorization or "").encode(), ("Bearer " + token).encode()):
+        return True
+
+    try:
+        client = ipaddress.ip_address(address or "")
+    except ValueError:
+        return False
+    return any(client in ipaddress.ip_network(network, strict=False) for network in allow)
+
+
+def render(rollout_log="automation/rollouts.jsonl") -> str:
+    """
+    Render every metric in the Prometheus text format
+    :param rollout_log: Rollout log written by the runner and push daemon
+    :return: metrics text
+    """
+    _rollout_gauges(rollout_log)
+    for collector in _collectors:
+        collector()
+
+    lines = []
+    with _lock:
+        for name in sorted(_metrics):
+            metric = _metrics[name]
+            if metric["description"]:
+                lines.append("# HELP " + name + " " + metric["description"])
+            lines.append("# TYPE " + name + " " + metric["kind"])
+
+            for key, value in sorted(metric["values"].items()):
+                if metric["kind"] != "histogram":
+                    lines.append(name + _labels(key) + " " + str(value))
+                    continue
+
+                for bound, count in zip(value["buckets"], value["counts"]):
+                    lines.append(name + "_bucket" + _labels(key + (("le", bound),)) + " " + str(count))
+                lines.append(name + "_bucket" + _labels(key + (("le", "+Inf"),)) + " " + str(value["count"]))
+                lines.append(name + "_sum" + _labels(key) + " " + str(value["sum"]))
+                lines.append(name + "_count" + _labels(key) + " " + str(value["count"]))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,288 @@
+import secrets
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+# Seconds before a lock left behind by a crashed migration can be taken over
+LOCK_TIMEOUT = 300
+
+# Characters of a record value kept as its search key, longer values match on their start
+SEARCH_VALUE_LENGTH = 256
+
+
+def search_keys(zone, record) -> dict:
+    """
+    Build the lowercased search keys of a record, stored in the record_search collection
+    :param zone: Zone name
+    :param record: Record dict with id, domain, type and value
+    :return: record_search document
+    """
+    return {
+        "zone": zone,
+        "id": record["id"],
+        "domain": str(record.get("domain")).lower(),
+        "type": str(record.get("type")).lower(),
+        "value": str(record.get("value"))[:SEARCH_VALUE_LENGTH].lower()
+    }
+
+
+def _duplicates(collection, field):
+    """
+    Find documents sharing a value that is about to get a unique index
+    :param collection: Mongo collection
+    :param field: Field name
+    :return: list of {"_id": value, "ids": [document IDs, oldest first]}
+    """
+    return list(collection.aggregate([
+        {"$group": {"_id": "$" + field, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]))
+
+
+def _dedupe_zones(db):
+    """
+    Merge zones with the same name into the oldest one so the unique index can be built
+    """
+    for duplicate in _duplicates(db["zones"], "zone"):
+        keep, *extra = sorted(duplicate["ids"])
+        kept = db["zones"].find_one({"_id": keep})
+        seen = {(record.get("domain"), record.get("type"), record.get("value")) for record in kept.get("records") or []}
+
+        users = list(kept.get("users") or [])
+        records = list(kept.get("records") or [])
+        for zone in db["zones"].find({"_id": {"$in": extra}}):
+            users += [user for user in zone.get("users") or [] if user not in users]
+            for record in zone.get("records") or []:
+                if (record.get("domain"), record.get("type"), record.get("value")) not in seen:
+                    seen.add((record.get("domain"), record.get("type"), record.get("value")))
+                    records.append(record)
+
+        db["zones"].update_one({"_id": keep}, {"$set": {"users": users, "records": records}})
+        db["zones"].delete_many({"_id": {"$in": extra}})
+
+        # Point owners of the removed documents at the kept one, $addToSet avoids listing it twice
+        owners = [user["_id"] for user in db["users"].find({"zones": {"$in": extra}}, {"_id": 1})]
+        if owners:
+            db["users"].update_many({"_id": {"$in": owners}}, {"$addToSet": {"zones": keep}})
+            db["users"].update_many({"_id": {"$in": owners}}, {"$pull": {"zones": {"$in": extra}}})
+        print("Merged " + str(len(extra)) + " duplicate documents of zone " + str(duplicate["_id"]) + " into " + str(keep))
+
+
+def _dedupe_users(db):
+    """
+    Rename users with a taken username, keeping the oldest account under the original name
+    """
+    for duplicate in _duplicates(db["users"], "username"):
+        for user_id in sorted(duplicate["ids"])[1:]:
+            username = str(duplicate["_id"]) + "-" + str(user_id)
+            db["users"].update_one({"_id": user_id}, {"$set": {"username": username}})
+            print("Renamed duplicate user " + str(duplicate["_id"]) + " (" + str(user_id) + ") to " + username)
+
+
+def _initial_indexes(db):
+    """
+    Create the indexes every hot query depends on
+    """
+    _dedupe_zones(db)
+    _dedupe_users(db)
+
+    db["zones"].create_index("zone", unique=True)
+    db["zones"].create_index("users")
+    db["users"].create_index("username", unique=True)
+
+
+def _record_ids(db):
+    """
+    Give every existing record a stable ID
+    """
+    for zone in db["zones"].find({"records": {"$elemMatch": {"id": {"$exists": False}}}}, {"records": 1}):
+        records = zone["records"]
+        for record in records:
+            record.setdefault("id", ObjectId())
+        db["zones"].update_one({"_id": zone["_id"]}, {"$set": {"records": records}})
+
+    db["zones"].create_index("records.id")
+
+
+def _integer_serials(db):
+    """
+    Store serials as integers so they can be incremented, and index the change journal
+    """
+    for zone in db["zones"].find({"serial": {"$type": "string"}}, {"serial": 1}):
+        db["zones"].update_one({"_id": zone["_id"]}, {"$set": {"serial": int(zone["serial"])}})
+
+    db["journal"].create_index([("zone", 1), ("serial", 1)], unique=True)
+    db["journal"].create_index("time", expireAfterSeconds=7 * 24 * 60 * 60)
+
+
+def _api_tokens(db):
+    """
+    Index API token hashes
+    """
+    db["users"].create_index("api_tokens", sparse=True)
+
+
+def _journal_parts(db):
+    """
+    Allow a change to span several journal documents
+    """
+    if "zone_1_serial_1" in db["journal"].index_information():
+        db["journal"].drop_index("zone_1_serial_1")
+    db["journal"].create_index([("zone", 1), ("serial", 1), ("part", 1)], unique=True)
+
+
+def _record_search(db):
+    """
+    Index lowercased record keys per zone, so record searches don't scan whole zones
+    """
+    db["record_search"].create_index([("zone", 1), ("domain", 1)])
+    db["record_search"].create_index([("zone", 1), ("value", 1)])
+    db["record_search"].create_index([("zone", 1), ("type", 1)])
+    db["record_search"].create_index([("zone", 1), ("id", 1)])
+
+    db["record_search"].delete_many({})
+    for zone in db["zones"].find({}, {"zone": 1, "records": 1}):
+        keys = [search_keys(zone["zone"], record) for record in zone.get("records") or []]
+        for start in range(0, len(keys), 1000):
+            db["record_search"].insert_many(keys[start:start + 1000], ordered=False)
+
+
+# Versioned migrations, applied in order and recorded in the meta collection
+MIGRATIONS = [
+    (1, "Initial zone and user indexes", _initial_indexes),
+    (2, "Stable record IDs", _record_ids),
+    (3, "Integer serials and change journal", _integer_serials),
+    (4, "API token index", _api_tokens),
+    (5, "Chunked journal entries", _journal_parts),
+    (6, "Record search keys", _record_search),
+]
+
+# Hot queries from CDNDatabase that must be index-covered: (collection, filter)
+HOT_QUERIES = [
+    ("users", {"_id": ObjectId()}),
+    ("users", {"username": ""}),
+    ("zones", {"zone": ""}),
+    ("zones", {"zone": "", "users": ObjectId()}),
+    ("zones", {"_id": {"$in": [ObjectId()]}}),
+    ("zones", {"users": ObjectId()}),
+    ("zones", {"zone": "", "records.id": ObjectId()}),
+    ("journal", {"zone": "", "serial": {"$gt": 0}}),
+    ("zones", {"users": ObjectId(), "zone": {"$regex": "^example"}}),
+    ("users", {"api_tokens": ""}),
+    ("zones", {"zone": {"$in": [""]}, "users": ObjectId()}),
+    ("journal", {"time": {"$gte": datetime.utcnow()}}),
+    ("record_search", {"zone": "", "domain": {"$regex": "^www"}}),
+    ("record_search", {"zone": "", "value": {"$regex": "^192"}}),
+    ("record_search", {"zone": "", "type": "a"}),
+    ("record_search", {"zone": "", "id": {"$in": [ObjectId()]}}),
+]
+
+
+def schema_version(db) -> int:
+    """
+    Get the current schema version
+    :param db: Mongo database
+    :return: version of the last applied migration, 0 if none
+    """
+    meta = db["meta"].find_one({"_id": "schema"})
+    return meta["version"] if meta else 0
+
+
+def _acquire_lock(db, owner) -> bool:
+    """
+    Take the migration lock, or a lock whose holder stopped renewing it
+    :param db: Mongo database
+    :param owner: Unique lock owner
+    :return: True if the lock was taken
+    """
+    expires = datetime.utcnow() + timedelta(seconds=LOCK_TIMEOUT)
+    try:
+        db["meta"].insert_one({"_id": "migration-lock", "owner": owner, "expires": expires})
+        return True
+    except DuplicateKeyError:
+        result = db["meta"].update_one(
+            {"_id": "migration-lock", "expires": {"$lt": datetime.utcnow()}},
+            {"$set": {"owner": owner, "expires": expires}}
+        )
+        return result.modified_count == 1
+
+
+def migrate(db, wait=1.0) -> list:
+    """
+    Apply pending migrations in order, one process at a time
+    :param db: Mongo database
+    :param wait: Seconds between attempts to take the migration lock
+    :return: list of applied migration versions
+    """
+    applied = []
+    latest = MIGRATIONS[-1][0]
+    if schema_version(db) >= latest:
+        return applied
+
+    # Workers starting together wait for the one holding the lock instead of racing it
+    owner = secrets.token_hex(8)
+    while not _acquire_lock(db, owner):
+        if schema_version(db) >= latest:
+            return applied
+        time.sleep(wait)
+
+    try:
+        current = schema_version(db)
+        for version, description, migration in MIGRATIONS:
+            if version > current:
+                print("Applying migration " + str(version) + ": " + description)
+                migration(db)
+                db["meta"].update_one({"_id": "schema"}, {"$set": {"version": version}}, upsert=True)
+                db["meta"].update_one({"_id": "migration-lock", "owner": owner}, {"$set": {"expires": datetime.utcnow() + timedelta(seconds=LOCK_TIMEOUT)}})
+                applied.append(version)
+    finally:
+        db["meta"].delete_one({"_id": "migration-lock", "owner": owner})
+
+    return applied
+
+
+def _stages(plan):
+    """
+    Walk every stage of a query plan
+    :param plan: Plan dict from explain()
+    :return: generator of stage names
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _stages(value)
+
+
+def check_query_plans(db) -> list:
+    """
+    Explain every hot query and find the ones that aren't index-covered
+    :param db: Mongo database
+    :return: list of (collection, filter) tuples that need a collection scan
+    """
+    uncovered = []
+    for collection, query in HOT_QUERIES:
+        plan = db[collection].find(query).explain()
+        if "COLLSCAN" in _stages(plan.get("queryPlanner", {}).get("winningPlan", {})):
+            uncovered.append((collection, query))
+
+    return uncovered
+
+
+if __name__ == "__main__":
+    from lib.config import configuration
+    from lib.database import CDNDatabase
+
+    database = CDNDatabase(configuration["database"], configuration["salt"])
+
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        collscans = check_query_plans(database._db)
+        for collection, query in collscans:
+            print("COLLSCAN: " + collection + " " + str(query))
+        exit(1 if collscans else 0)
@@ -0,0 +1,276 @@
+import asyncio
+import secrets
+import struct
+import time
+from datetime import datetime, timedelta
+
+from lib.config import configuration
+
+# DNS types and classes
+TYPE_SOA = 6
+TYPE_TXT = 16
+CLASS_IN = 1
+CLASS_CHAOS = 3
+
+# Lagging zones stored per node, the counts cover the rest
+MAX_LAGGING = 100
+
+
+def _encode_query(query_id, name, query_type, query_class) -> bytes:
+    """
+    Build a DNS query packet
+    :param query_id: 16 bit query ID
+    :param name: Query name
+    :param query_type: Query type
+    :param query_class: Query class
+    :return: DNS packet
+    """
+    question = b"".join(bytes([len(label)]) + label.encode() for label in name.strip(".").split(".") if label) + b"\x00"
+    return struct.pack("!HHHHHH", query_id, 0, 1, 0, 0, 0) + question + struct.pack("!HH", query_type, query_class)
+
+
+def _skip_name(packet, offset) -> int:
+    """
+    Skip over a possibly compressed name
+    :param packet: DNS packet
+    :param offset: Offset of the name
+    :return: offset after the name
+    """
+    while True:
+        length = packet[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+
+def _decode_answers(packet, query_id):
+    """
+    Parse the answer section of a DNS response
+    :param packet: DNS packet
+    :param query_id: ID of the query the response must answer
+    :return: (rcode, [(type, rdata offset, rdata)])
+    """
+    response_id, flags, questions, answers, _, _ = struct.unpack("!HHHHHH", packet[:12])
+    if response_id != query_id:
+        raise ValueError("Response ID mismatch")
+
+    offset = 12
+    for _ in range(questions):
+        offset = _skip_name(packet, offset) + 4
+
+    records = []
+    for _ in range(answers):
+        offset = _skip_name(packet, offset)
+        record_type, _, _, length = struct.unpack("!HHIH", packet[offset:offset + 10])
+        offset += 10
+        records.append((record_type, offset, packet[offset:offset + length]))
+        offset += length
+
+    return flags & 0x000F, records
+
+
+class _Query(asyncio.DatagramProtocol):
+    def __init__(self, packet):
+        self.packet = packet
+        self.response = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        transport.sendto(self.packet)
+
+    def datagram_received(self, data, addr):
+        if not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
+
+async def query(address, name, query_type, query_class=CLASS_IN, timeout=2.0):
+    """
+    Send a single UDP DNS query
+    :param address: Server address
+    :param name: Query name
+    :param query_type: Query type
+    :param query_class: Query class
+    :param timeout: Seconds to wait for the response
+    :return: (rcode, answers, packet, seconds)
+    """
+    query_id = secrets.randbits(16)
+    start = time.monotonic()
+    transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: _Query(_encode_query(query_id, name, query_type, query_class)),
+        remote_addr=(address, 53)
+    )
+    try:
+        packet = await asyncio.wait_for(protocol.response, timeout)
+    finally:
+        transport.close()
+
+    rcode, answers = _decode_answers(packet, query_id)
+    return rcode, answers, packet, time.monotonic() - start
+
+
+async def pop_tag(address, timeout=2.0):
+    """
+    Ask a node for its PoP tag, set as the BIND version string by named.conf.options.j2
+    :param address: Node address
+    :param timeout: Seconds to wait for the response
+    :return: (tag, seconds), tag is None if the node did not answer with a PoP tag
+    """
+    _, answers, _, seconds = await query(address, "version.bind", TYPE_TXT, CLASS_CHAOS, timeout)
+    for record_type, _, rdata in answers:
+        if record_type == TYPE_TXT and rdata:
+            text = rdata[1:1 + rdata[0]].decode(errors="replace")
+            if text.startswith("PoP-Tag "):
+                return text[len("PoP-Tag "):], seconds
+    return None, seconds
+
+
+async def soa_serial(address, zone, timeout=2.0):
+    """
+    Get the SOA serial a node serves for a zone
+    :param address: Node address
+    :param zone: Zone name
+    :param timeout: Seconds to wait for the response
+    :return: serial, None if the node does not serve the zone
+    """
+    rcode, answers, packet, _ = await query(address, zone, TYPE_SOA, CLASS_IN, timeout)
+    if rcode != 0:
+        return None
+
+    for record_type, offset, _ in answers:
+        if record_type == TYPE_SOA:
+            # Serial follows the primary nameserver and responsible mailbox names
+            offset = _skip_name(packet, _skip_name(packet, offset))
+            return struct.unpack("!I", packet[offset:offset + 4])[0]
+    return None
+
+
+async def _retry(coroutine_function, *args, attempts=2):
+    """
+    Retry a query that timed out, UDP packets get lost
+    :return: query result
+    """
+    for attempt in range(attempts):
+        try:
+            return await coroutine_function(*args)
+        except asyncio.TimeoutError:
+            if attempt == attempts - 1:
+                raise
+
+
+async def probe_node(node, serials, semaphore, timeout=2.0):
+    """
+    Check that a node answers with its PoP tag and how far behind its zones are
+    :param node: Node document
+    :param serials: {zone: serial} to check, empty to skip serial checks
+    :param semaphore: Limits queries in flight across all nodes
+    :param timeout: Seconds to wait for each response
+    :return: health dict
+    """
+    health = {"operational": False, "latency": None, "pop_tag": None, "zones_behind": 0, "zones_missing": 0, "lagging": [], "error": None}
+
+    try:
+        async with semaphore:
+            tag, seconds = await _retry(pop_tag, node["management"], timeout)
+    except (asyncio.TimeoutError, OSError, ValueError, struct.error, IndexError) as e:
+        health["error"] = str(e) or type(e).__name__
+        return health
+
+    health["pop_tag"] = tag
+    health["latency"] = round(seconds * 1000, 2)
+    if tag is None:
+        health["error"] = "No PoP tag in version.bind"
+        return health
+    if tag != node["uid"]:
+        # The management address answers for another node
+        health["error"] = "PoP tag " + tag + " doesn't match " + node["uid"]
+        return health
+
+    async def check(zone, serial):
+        async with semaphore:
+            try:
+                return zone, serial, await _retry(soa_serial, node["management"], zone, timeout)
+            except (asyncio.TimeoutError, OSError, ValueError, struct.error, IndexError):
+                return zone, serial, None
+
+    for zone, serial, node_serial in await asyncio.gather(*(check(zone, serial) for zone, serial in serials.items())):
+        if node_serial is None:
+            health["zones_missing"] += 1
+        elif node_serial < serial:
+            health["zones_behind"] += 1
+            health["lagging"].append({"zone": zone, "lag": serial - node_serial})
+
+    health["lagging"] = sorted(health["lagging"], key=lambda entry: -entry["lag"])[:MAX_LAGGING]
+    health["operational"] = True
+    return health
+
+
+async def probe(nodes, serials, concurrency=200, timeout=2.0):
+    """
+    Probe every node concurrently
+    :param nodes: Node documents
+    :param serials: {zone: serial} to check on every node
+    :param concurrency: Maximum queries in flight
+    :param timeout: Seconds to wait for each response
+    :return: {node _id: health dict}
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(probe_node(node, serials, semaphore, timeout) for node in nodes))
+    checked = datetime.utcnow()
+    for health in results:
+        health["checked"] = checked
+    return {node["_id"]: health for node, health in zip(nodes, results)}
+
+
+def zones_to_check(database, sample, since, max_changed=1000) -> dict:
+    """
+    Pick the zones whose serials are checked on every node
+    A fixed sample catches nodes that stopped updating, recently changed zones show how far pushes lag
+    :param database: CDNDatabase
+    :param sample: Zone names checked on every run
+    :param since: UTC datetime of the last run
+    :param max_changed: Maximum number of recently changed zones
+    :return: {zone: serial}
+    """
+    return database.get_zone_serials(set(sample) | set(database.get_changed_zones(since, max_changed)))
+
+
+if __name__ == "__main__":
+    from lib.database import CDNDatabase
+
+    database = CDNDatabase(configuration["database"], configuration["salt"])
+    sample_size = configuration.get("probe-sample-size", 100)
+    zone_sample = []
+    last_run = datetime.utcnow() - timedelta(seconds=configuration.get("probe-interval", 30))
+
+    while True:
+        start = time.monotonic()
+        started = datetime.utcnow()
+        if len(zone_sample) < sample_size:
+            # Pick the sample again until there are enough zones to fill it
+            zone_sample = database.get_zone_sample(sample_size)
+        probe_nodes = database.get_nodes(max_age=0)
+        zone_serials = zones_to_check(
+            database,
+            zone_sample,
+            last_run,
+            configuration.get("probe-changed-zones", 1000)
+        ) if configuration.get("probe-serials", True) else {}
+        last_run = started
+        node_health = asyncio.run(probe(
+            probe_nodes,
+            zone_serials,
+            configuration.get("probe-concurrency", 200),
+            configuration.get("probe-timeout", 2.0)
+        ))
+        database.update_node_health(node_health)
+
+        down = [node["uid"] for node in probe_nodes if not node_health[node["_id"]]["operational"]]
+        print("Probed " + str(len(probe_nodes)) + " nodes and " + str(len(zone_serials)) + " zones in " +
+              str(round(time.monotonic() - start, 2)) + "s, down: " + (", ".join(down) or "none"))
+
+        time.sleep(max(configuration.get("probe-interval", 30) - (time.monotonic() - start), 0))
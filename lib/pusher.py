@@ -0,0 +1,222 @@
+import json
+import os
+import time
+
+import ansible_runner
+from pymongo.errors import OperationFailure
+
+from lib.aggregator import render_zone
+from lib.config import configuration
+from lib.database import CDNDatabase
+from lib.renderer import render
+from lib.runner import ROLLOUT_LOG, ssh_args
+
+PUSH_DIR = "source/push"
+
+# Serials of the zones every node got in the last successful pushes, delete it to push everything again
+PUSHED_STATE = os.path.join(PUSH_DIR, "pushed.json")
+
+
+def _load_pushed():
+    """
+    Read the serials of the last successful pushes
+    :return: {zone: serial}, None if nothing was pushed yet
+    """
+    if not os.path.exists(PUSHED_STATE):
+        return None
+    with open(PUSHED_STATE, "r") as state_file:
+        return json.load(state_file)
+
+
+def _save_pushed(pushed):
+    """
+    Atomically write the serials of the last successful pushes
+    :param pushed: {zone: serial}
+    """
+    tmp_path = PUSHED_STATE + ".tmp"
+    with open(tmp_path, "w") as state_file:
+        json.dump(pushed, state_file)
+    os.replace(tmp_path, PUSHED_STATE)
+
+
+def _startup_changes(serials):
+    """
+    Find the zones that changed since the last successful push
+    :param serials: Current {zone: serial}
+    :return: (changed zone names, deleted zone names), every zone if nothing was pushed yet
+    """
+    pushed = _load_pushed()
+    if pushed is None:
+        return set(serials), set()
+    return {zone for zone, serial in serials.items() if pushed.get(zone) != serial}, set(pushed) - set(serials)
+
+
+def _poll_changes(db, interval):
+    """
+    Poll zone serials for changes, for deployments without a replica set
+    :param db: CDNDatabase
+    :param interval: Seconds between polls
+    :return: generator of (changed zone names, deleted zone names), empty sets when idle
+    """
+    serials = db.get_zone_serials()
+    yield _startup_changes(serials)
+
+    while True:
+        time.sleep(interval)
+        current = db.get_zone_serials()
+        changed = {zone for zone, serial in current.items() if serials.get(zone) != serial}
+        deleted = set(serials) - set(current)
+        serials = current
+        yield changed, deleted
+
+
+def _stream_changes(db, interval):
+    """
+    Watch the zones collection with a change stream
+    :param db: CDNDatabase
+    :param interval: Seconds to wait for an event before yielding an idle tick
+    :return: generator of (changed zone names, deleted zone names), empty sets when idle
+    """
+    # Update events only carry the document ID, zone documents can be megabytes so they aren't looked up
+    with db.zones.watch([{"$project": {"operationType": 1, "documentKey": 1, "fullDocument.zone": 1}}],
+                        max_await_time_ms=int(interval * 1000)) as stream:
+        names = {zone_id: zone for zone, zone_id in db.get_zone_ids().items()}
+        yield _startup_changes(db.get_zone_serials())
+
+        while stream.alive:
+            event = stream.try_next()
+            if event is None:
+                yield set(), set()
+                continue
+
+            zone_id = event["documentKey"]["_id"]
+            if event["operationType"] == "delete":
+                zone = names.pop(zone_id, None)
+                yield set(), {zone} if zone else set()
+                continue
+
+            if event.get("fullDocument"):
+                names[zone_id] = event["fullDocument"]["zone"]
+            elif zone_id not in names:
+                zone_doc = db.zones.find_one({"_id": zone_id}, {"zone": 1})
+                if zone_doc:
+                    names[zone_id] = zone_doc["zone"]
+
+            if zone_id in names:
+                yield {names[zone_id]}, set()
+
+
+def watch_changes(db, debounce=2.0, interval=1.0, max_wait=30.0):
+    """
+    Watch for zone changes and coalesce them over a debounce window
+    Uses a change stream on replica sets, and polls zone serials otherwise
+    :param db: CDNDatabase
+    :param debounce: Seconds without changes before a batch is released
+    :param interval: Poll interval in seconds
+    :param max_wait: Seconds after the first pending change a batch is released even if changes keep coming
+    :return: generator of (changed zone names, deleted zone names)
+    """
+    try:
+        changes = _stream_changes(db, interval)
+        first = next(changes)
+    except OperationFailure:
+        print("Change streams unavailable, polling zone serials every " + str(interval) + "s")
+        changes = _poll_changes(db, interval)
+        first = next(changes)
+
+    yield first
+
+    changed, deleted = set(), set()
+    first_change = last_change = None
+    for new_changed, new_deleted in changes:
+        now = time.monotonic()
+        if new_changed or new_deleted:
+            changed = (changed | new_changed) - new_deleted
+            deleted = (deleted | new_deleted) - new_changed
+            if first_change is None:
+                first_change = now
+            last_change = now
+
+        # Steady edits would keep resetting the debounce window, so batches are capped at max_wait
+        if last_change is not None and (now - last_change >= debounce or now - first_change >= max_wait):
+            yield changed, deleted
+            changed, deleted = set(), set()
+            first_change = last_change = None
+
+
+def push(db, changed, deleted):
+    """
+    Write changed zone files and push only them to every node
+    :param db: CDNDatabase
+    :param changed: Set of changed zone names
+    :param deleted: Set of deleted zone names
+    :return: ansible_runner result
+    """
+    started = time.time()
+    os.makedirs(PUSH_DIR, exist_ok=True)
+
+    serials = {}
+    for zone in db.get_export_zones(changed):
+        serials[zone["zone"]] = zone["serial"]
+        with open(os.path.join(PUSH_DIR, "db." + zone["zone"]), "w") as zone_file:
+            zone_file.write(render_zone(zone))
+
+    for zone in deleted:
+        path = os.path.join(PUSH_DIR, "db." + zone)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # The zone set only changes when zones are added or deleted
+    local_path = os.path.join(PUSH_DIR, "named.conf.local")
+    local = "".join(render("local.j2", zone=zone) for zone in sorted(db.get_zone_serials()))
+    local_changed = not os.path.exists(local_path) or open(local_path).read() != local
+    if local_changed:
+        with open(local_path, "w") as local_file:
+            local_file.write(local)
+
+    result = ansible_runner.run(
+        private_data_dir="automation/",
+        playbook="push.yml",
+        forks=configuration.get("push-forks", 50),
+        cmdline=ssh_args(),
+        extravars={
+            "zones": sorted(changed),
+            "local_changed": local_changed
+        }
+    )
+
+    failed = sorted(set(result.stats.get("failures", {})) | set(result.stats.get("dark", {}))) if result.stats else []
+
+    # Only pushes every node got count, so the next start pushes failed zones again
+    if result.status == "successful" and not failed:
+        pushed = _load_pushed() or {}
+        pushed.update(serials)
+        for zone in deleted:
+            pushed.pop(zone, None)
+        _save_pushed(pushed)
+
+    # Log pushes alongside rollouts so /metrics reports both
+    with open(ROLLOUT_LOG, "a") as rollout_log:
+        rollout_log.write(json.dumps({
+            "playbook": "push.yml",
+            "zones": len(changed) + len(deleted),
+            "started": started,
+            "seconds": round(time.time() - started, 3),
+            "failed": failed
+        }) + "\n")
+
+    return result
+
+
+if __name__ == "__main__":
+    database = CDNDatabase(configuration["database"], configuration["salt"])
+
+    for changed_zones, deleted_zones in watch_changes(database, configuration.get("push-debounce", 2.0), configuration.get("push-poll-interval", 1.0),
+                                                    configuration.get("push-max-wait", 30.0)):
+        if not (changed_zones or deleted_zones):
+            continue
+
+        start = time.monotonic()
+        r = push(database, changed_zones, deleted_zones)
+        print("Pushed " + str(len(changed_zones)) + " changed and " + str(len(deleted_zones)) + " deleted zones in " +
+              str(round(time.monotonic() - start, 2)) + "s, failures: " + str(r.stats["failures"]))
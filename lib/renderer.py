@@ -0,0 +1,76 @@
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from lib.config import configuration
+
+# Zone, local and node templates
+TEMPLATE_DIRS = ["config", "automation/templates"]
+
+_bytecode_dir = configuration.get("template-cache", ".template-cache")
+os.makedirs(_bytecode_dir, exist_ok=True)
+
+# Templates are compiled once per process and cached as bytecode on disk.
+# auto_reload recompiles a template when its file changes.
+environment = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIRS),
+    bytecode_cache=FileSystemBytecodeCache(_bytecode_dir),
+    auto_reload=True,
+    cache_size=-1
+)
+
+
+def render(name, **kwargs) -> str:
+    """
+    Render a template by name
+    :param name: Template file name, for example zone.j2
+    :return: Rendered template
+    """
+    return environment.get_template(name).render(kwargs)
+
+
+def serialize_zone(serial, records, nameservers, soa_root) -> str:
+    """
+    Fast path zone serializer, writes the same BIND text as zone.j2 without going through Jinja
+    :param serial: Zone serial
+    :param records: List of record dicts
+    :param nameservers: List of nameservers
+    :param soa_root: SOA responsible mailbox
+    :return: Rendered zone file
+    """
+    lines = [
+        "$TTL\t86400\n"
+        "@\tIN\tSOA  " + str(nameservers[0]) + ". " + str(soa_root) + ". (\n"
+        "         " + str(serial) + "     ; Serial\n"
+        "\t\t\t 604800\t\t; Refresh\n"
+        "\t\t\t  86400\t\t; Retry\n"
+        "\t\t\t2419200\t\t; Expire\n"
+        "\t\t\t  86400 )\t; Negative Cache TTL\n"
+    ]
+
+    for nameserver in nameservers:
+        lines.append("@\tIN\tNS\t" + str(nameserver) + ".\n")
+    lines.append("\n")
+
+    for record in records:
+        lines.append(str(record["domain"]) + "    " + str(record["ttl"]) + "    IN    " + str(record["type"]) + "    " + str(record["value"]) + "\n")
+
+    return "".join(lines)
+
+
+def render_zone_file(serial, records) -> str:
+    """
+    Render a zone file with the configured nameservers, using the fast path serializer if enabled
+    :param serial: Zone serial
+    :param records: List of record dicts
+    :return: Rendered zone file
+    """
+    if configuration.get("fast-serializer"):
+        return serialize_zone(serial, records, configuration["nameservers"], configuration["soa_root"])
+
+    return render("zone.j2",
+                  serial=serial,
+                  records=records,
+                  nameservers=configuration["nameservers"],
+                  soa_root=configuration["soa_root"]
+                  )
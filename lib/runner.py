@@ -1,6 +1,14 @@
+import json
+import math
+import sys
+import time
+
 import ansible_runner
 
-from config import configuration
+from lib.config import configuration
+
+# Rollout durations, one JSON object per line
+ROLLOUT_LOG = "automation/rollouts.jsonl"
 
 
 def _get_ext_args(**kwargs):
@@ -17,19 +25,163 @@ def _get_ext_args(**kwargs):
     return payload.lstrip()
 
 
-r = ansible_runner.run(
-    private_data_dir="automation/",
-    playbook="install.yml",
-    rotate_artifacts=1,
-    cmdline=_get_ext_args(
-        ansible_port=34553,
-        ansible_ssh_private_key_file="ssh-key",
-        ansible_user="root",
+def ssh_args(**kwargs) -> str:
+    """
+    Ansible CLI options every playbook needs to reach the nodes
+    :param kwargs: Extra variables to pass along
+    :return: formatted "-e" string
+    """
+    return _get_ext_args(
+        ansible_port=configuration.get("ssh-port", 34553),
+        ansible_ssh_private_key_file=configuration.get("ssh-key", "ssh-key"),
+        ansible_user=configuration.get("ssh-user", "root"),
+        **kwargs
+    )
+
+
+def _inventory_hosts(inventory="automation/hosts"):
+    """
+    Read host names from the inventory written by exporter.build_nodes
+    :param inventory: Inventory file path
+    :return: list of host names
+    """
+    with open(inventory, "r") as hosts_file:
+        return [line.split()[0] for line in hosts_file.read().split("\n") if line.strip()]
+
+
+def _stages(hosts, stages):
+    """
+    Split hosts into rollout batches
+    :param hosts: List of host names
+    :param stages: Batch sizes, ints are host counts and floats are fractions of the fleet
+    :return: list of host lists
+    """
+    batches = []
+    remaining = list(hosts)
+
+    for stage in stages:
+        if not remaining:
+            break
+
+        size = stage if isinstance(stage, int) else math.ceil(len(hosts) * stage)
+        batches.append(remaining[:max(size, 1)])
+        remaining = remaining[max(size, 1):]
+
+    if remaining:
+        batches.append(remaining)
+
+    return batches
+
+
+class _HostTimer:
+    """
+    Collect per-host task timings from runner events
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.hosts = {}
+
+    def __call__(self, event):
+        data = event.get("event_data", {})
+        host = data.get("host")
+        if host and event.get("event") in ("runner_on_ok", "runner_on_failed", "runner_on_unreachable", "runner_on_skipped"):
+            duration = data.get("duration") or 0
+            timing = self.hosts.setdefault(host, {"tasks": 0, "seconds": 0.0, "failed": False})
+            timing["tasks"] += 1
+            timing["seconds"] += duration
+            if event["event"] in ("runner_on_failed", "runner_on_unreachable") and not data.get("ignore_errors"):
+                timing["failed"] = True
+
+            if self.verbose:
+                print("[" + host + "] " + event["event"][len("runner_on_"):] + " " + str(data.get("task", "")) + " (" + str(round(duration, 2)) + "s)")
+
+        return True  # Keep the event in artifacts
+
+
+def rollout(playbook, hosts=None, cmdline=None, forks=None, stages=None, max_failure_rate=None, verbose=True):
+    """
+    Roll a playbook out canary first, then in batches, aborting when too many hosts fail
+    :param playbook: Playbook file in automation/
+    :param hosts: List of hosts, None for every host in the inventory
+    :param cmdline: Ansible CLI options, None for ssh_args(). Options passed here must include ssh_args()
+    :param forks: Parallel hosts per batch
+    :param stages: Batch sizes, for example [1, 0.1, 1.0] is one canary, then 10% of the fleet, then the rest
+    :param max_failure_rate: Abort after a batch when more than this fraction of finished hosts failed
+    :param verbose: Print every host event
+    :return: rollout summary dict
+    """
+    if hosts is None:
+        hosts = _inventory_hosts()
+    if cmdline is None:
+        cmdline = ssh_args()
+    if forks is None:
+        forks = configuration.get("rollout-forks", 50)
+    if stages is None:
+        stages = configuration.get("rollout-stages", [1, 0.1, 1.0])
+    if max_failure_rate is None:
+        max_failure_rate = configuration.get("rollout-max-failure-rate", 0.0)
+
+    timer = _HostTimer(verbose)
+    summary = {"playbook": playbook, "hosts": len(hosts), "batches": [], "aborted": False, "started": time.time()}
+    finished = 0
+    failed = set()
+    attempted = []
+
+    for batch in _stages(hosts, stages):
+        batch_start = time.monotonic()
+        thread, r = ansible_runner.run_async(
+            private_data_dir="automation/",
+            playbook=playbook,
+            rotate_artifacts=1,
+            forks=forks,
+            limit=",".join(batch),
+            cmdline=cmdline,
+            event_handler=timer,
+            quiet=True
+        )
+        thread.join()
+
+        stats = r.stats or {}
+        batch_failed = set(stats.get("failures", {})) | set(stats.get("dark", {}))
+        failed |= batch_failed
+        finished += len(batch)
+        attempted += batch
+
+        summary["batches"].append({
+            "hosts": len(batch),
+            "failed": sorted(batch_failed),
+            "seconds": round(time.monotonic() - batch_start, 3)
+        })
+
+        if len(failed) / finished > max_failure_rate:
+            summary["aborted"] = True
+            print("Aborting rollout, " + str(len(failed)) + "/" + str(finished) + " hosts failed")
+            break
+
+    summary["seconds"] = round(time.time() - summary["started"], 3)
+    summary["failed"] = sorted(failed)
+    summary["succeeded"] = sorted(set(attempted) - failed)
+    summary["host_seconds"] = {host: round(timing["seconds"], 3) for host, timing in timer.hosts.items()}
+
+    with open(ROLLOUT_LOG, "a") as rollout_log:
+        rollout_log.write(json.dumps(summary) + "\n")
+
+    return summary
+
+
+if __name__ == "__main__":
+    result = rollout(
+        sys.argv[1] if len(sys.argv) > 1 else "install.yml",
+        cmdline=ssh_args(
+            asn=configuration["asn"],
+            ipv4_prefix=configuration["ipv4_prefix"],
+            ipv6_prefix=configuration["ipv6_prefix"]
+        )
+    )
 
-        asn=configuration["asn"],
-        ipv4_prefix=configuration["ipv4_prefix"],
-        ipv6_prefix=configuration["ipv6_prefix"]
-    ),
-)
+    # Slowest hosts first
+    for host, seconds in sorted(result["host_seconds"].items(), key=lambda item: -item[1])[:20]:
+        print(host + ": " + str(seconds) + "s")
 
-print(r.stats["failures"])
+    print("Rollout " + ("aborted" if result["aborted"] else "finished") + " in " + str(result["seconds"]) + "s, failures: " + str(result["failed"]))
@@ -1,11 +1,23 @@
+import cProfile
+import gzip
+import io
+import os
+import random
+import threading
+import time
+import zlib
 from datetime import timedelta
 from os import urandom
 
-from flask import Flask, session, render_template, request, redirect
+from flask import Flask, session, render_template, request, redirect, jsonify, Response, stream_with_context, g
 
-from lib.aggregator import build_zones
+from lib.aggregator import build_changes, build_manifest, build_zones, known_version, serial_version, stream_zones
+from lib.api import create_api
 from lib.config import configuration
 from lib.database import CDNDatabase
+from lib.ddns import DDNSBuffer
+from lib.importer import file_format, import_records
+from lib.metrics import LOCAL_NETWORKS, authorized, observe, render as render_metrics
 
 app = Flask(__name__)
 
@@ -15,6 +27,35 @@ else:
     app.secret_key = urandom(12)
 
 db = CDNDatabase(configuration["database"], configuration["salt"])
+app.register_blueprint(create_api(db), url_prefix="/api")
+
+
+# Periodically correct dashboard counters that drifted, for example after a crash between writes
+def _reconcile_counters():
+    while True:
+        updated = db.reconcile_counters()
+        if updated:
+            print("Reconciled dashboard counters of " + str(updated) + " users")
+        time.sleep(configuration.get("reconcile-interval", 3600))
+
+
+threading.Thread(target=_reconcile_counters, daemon=True).start()
+
+# Dynamic DNS updates are buffered and flushed in batches
+ddns = DDNSBuffer(db, configuration.get("ddns-flush-interval", 10), str(configuration.get("ddns-ttl", 60)))
+ddns.start()
+
+# Zone set version shared by every long-polling node, refreshed at most once per second
+_zone_set = {"version": None, "checked": 0.0}
+_zone_set_lock = threading.Lock()
+
+
+def _zone_set_version():
+    with _zone_set_lock:
+        if time.monotonic() - _zone_set["checked"] >= 1:
+            _zone_set["version"] = serial_version(db.get_zone_serials())
+            _zone_set["checked"] = time.monotonic()
+        return _zone_set["version"]
 
 
 # Set daily rotating sessions
@@ -24,6 +65,59 @@ def make_session_permanent():
     app.permanent_session_lifetime = timedelta(days=1)
 
 
+# Cache user and zone documents for the life of a request
+@app.before_request
+def begin_request():
+    g.start = time.perf_counter()
+    db.begin_request()
+
+    # Profile a sample of requests, only the slow ones are kept
+    g.profiler = None
+    if random.random() < configuration.get("profile-sample-rate", 0):
+        try:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        except ValueError:
+            # Another request on a different thread is already being profiled
+            g.profiler = None
+
+
+def _finish_request(route, method, status, start) -> int:
+    queries = db.end_request(route)
+    observe("delivr_request_seconds", time.perf_counter() - start, "Request duration by route", route=route or "unmatched", method=method, status=status)
+    return queries
+
+
+@app.after_request
+def end_request(response):
+    seconds = time.perf_counter() - g.start
+    if response.is_streamed:
+        # The body is generated after this hook, so its queries are counted once it has been sent.
+        # Headers are already out by then, streamed responses have no X-Query-Count
+        finish = (request.endpoint, request.method, response.status_code, g.start)
+        response.call_on_close(lambda: _finish_request(*finish))
+    else:
+        response.headers["X-Query-Count"] = str(_finish_request(request.endpoint, request.method, response.status_code, g.start))
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        if seconds >= configuration.get("profile-slow-requests", 1.0):
+            profile_dir = configuration.get("profile-dir", "profiles")
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, (request.endpoint or "unmatched") + "-" + str(int(time.time() * 1000)) + ".prof"))
+
+    return response
+
+
+# Stop the profiler of requests that raised before after_request ran
+@app.teardown_request
+def stop_profiler(exception):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+
+
 @app.errorhandler(404)
 def error_notfound(e):
     return render_template("errors/404.html"), 404
@@ -39,11 +133,13 @@ def index():
     if not session.get("username"):
         return redirect("/login")
 
+    dashboard = db.get_dashboard(session.get("user_id"))
     return render_template("index.html",
                            name=session["username"],
                            servers=db.get_nodes(),
-                           zones=db.get_zones(session.get("user_id")),
-                           total_records=db.get_total_records(session.get("user_id"))
+                           zones=dashboard["zones"],
+                           zone_count=dashboard["zone_count"],
+                           total_records=dashboard["record_count"]
                            )
 
 
@@ -52,13 +148,13 @@ def login():
     if request.method == "GET":
         return render_template("auth/login.html")
     elif request.method == "POST":
-        user_id = db.authenticated(request.form.get("username"), request.form.get("password"))
+        user_id, error = db.login(request.form.get("username"), request.form.get("password"))
         if user_id != "":
             session["user_id"] = user_id
             session["username"] = request.form.get("username")
             return redirect("/")
         else:
-            return render_template("errors/400.html", message="Not authorized")
+            return render_template("errors/400.html", message=error)
 
 
 @app.route("/signup", methods=["GET", "POST"])
@@ -104,31 +200,74 @@ def records(zone):
         return redirect("/login")
 
     if db.authorized_for_zone(session["user_id"], zone):
-        error = db.zone_exists(session["user_id"])
-        if error:
-            return error
-
         if request.method == "GET":
+            page_size = configuration.get("records-page-size", 100)
+            page = max(request.args.get("page", 1, type=int), 1)
+            search = request.args.get("q", "").strip()
+            prefix = request.args.get("match") == "prefix"
             return render_template("records.html",
                                    name=session["username"],
-                                   zone=db.get_zone(session["user_id"], zone)
+                                   zone=db.get_records(zone, (page - 1) * page_size, page_size, search, prefix),
+                                   page=page,
+                                   page_size=page_size,
+                                   search=search,
+                                   prefix=prefix
                                    )
 
         elif request.method == "POST":
-            db.add_record(zone, request.form.get("domain"), request.form.get("type"), request.form.get("value"), request.form.get("ttl"))
+            error = db.add_record(zone, request.form.get("domain"), request.form.get("type"), request.form.get("value"), request.form.get("ttl"))
+            if error:
+                return render_template("errors/400.html", message=error)
+
             return redirect("/records/" + zone)
     else:
         return render_template("errors/400.html", message="Not authorized for zone")
 
 
+@app.route("/records/<zone>/import", methods=["POST"])
+def records_import(zone):
+    if not session.get("username"):
+        return redirect("/login")
+
+    if not db.authorized_for_zone(session["user_id"], zone):
+        return jsonify({"success": False, "message": "Not authorized for zone"}), 403
+
+    upload = request.files.get("file")
+    if not upload:
+        return jsonify({"success": False, "message": "No file uploaded"}), 400
+
+    lines = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+    report, errors = import_records(db, zone, lines, request.form.get("format") or file_format(upload.filename))
+    if errors:
+        return jsonify({"success": False, "message": "Import failed", "errors": errors[:100]}), 400
+
+    return jsonify({"success": True, "message": "Records imported", **report})
+
+
 @app.route("/zones")
 def zones():
     if not session.get("username"):
         return redirect("/login")
 
+    page_size = configuration.get("zones-page-size", 100)
+    page = max(request.args.get("page", 1, type=int), 1)
+    search = request.args.get("q", "").strip()
+    prefix = request.args.get("match") != "contains"
+
+    if search:
+        zone_docs, zone_count = db.search_zones(session.get("user_id"), search, (page - 1) * page_size, page_size, prefix)
+    else:
+        zone_docs = db.get_zones(session.get("user_id"), (page - 1) * page_size, page_size)
+        zone_count = db.get_dashboard(session.get("user_id"), 0)["zone_count"]
+
     return render_template("zones.html",
                            name=session["username"],
-                           zones=db.get_zones(session.get("user_id"))
+                           zones=zone_docs,
+                           zone_count=zone_count,
+                           page=page,
+                           page_size=page_size,
+                           search=search,
+                           prefix=prefix
                            )
 
 
@@ -149,27 +288,139 @@ def zone_delete(zone):
     return redirect("/")
 
 
-@app.route("/records/<zone>/delete/<record_index>")
-def delete_record(zone, record_index):
+@app.route("/records/<zone>/delete/<record_id>")
+def delete_record(zone, record_id):
     if db.authorized_for_zone(session["user_id"], zone):
-        db.delete_record(zone, record_index)
+        db.delete_record(zone, record_id)
         return redirect("/records/" + zone)
     else:
         return redirect("/login")
 
 
+def _gzip_stream(lines):
+    """
+    Gzip a streamed response as it is generated
+    :param lines: Generator of text
+    :return: generator of gzip bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        data = compressor.compress(line.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 @app.route("/export/zones")
 def export():
-    return build_zones(db.get_all_zones())
+    batch_size = configuration.get("export-batch-size", 500)
+
+    since = request.args.get("since")
+    if since and not known_version(since):
+        since = None  # Unknown version, fall back to a full export
+
+    # Zone serials are cheap to read, so they version the export before any zone is fetched
+    version = serial_version(db.get_zone_serials())
+    if request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+        response.set_etag(version)
+        return response
+
+    # Zone files compress well, so exports are gzipped for clients that accept it
+    compress = configuration.get("export-compression", True) and "gzip" in request.accept_encodings
+
+    if request.args.get("format") == "ndjson":
+        lines = stream_zones(db.get_all_zones(batch_size), since)
+        response = Response(stream_with_context(_gzip_stream(lines) if compress else lines), mimetype="application/x-ndjson")
+    else:
+        export_version, manifest = build_manifest(db.get_all_zones(batch_size))
+        response = jsonify(build_zones(None, manifest=manifest, since=since))
+        # Pass this back as since for an incremental export
+        response.headers["X-Export-Version"] = export_version
+        if compress:
+            response.set_data(gzip.compress(response.get_data()))
+
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+
+    response.set_etag(version)
+
+    if since:
+        response.headers["X-Export-Since"] = since
+    return response
+
+
+@app.route("/export/wait")
+def export_wait():
+    known = request.args.get("version")
+    deadline = time.monotonic() + min(request.args.get("timeout", 30, type=float), 60)
+
+    # Hold the request until the zone set changes or the timeout passes
+    version = _zone_set_version()
+    while version == known and time.monotonic() < deadline:
+        time.sleep(1)
+        version = _zone_set_version()
+
+    return jsonify({"version": version, "changed": version != known})
+
+
+@app.route("/export/zones/<zone>/changes")
+def export_changes(zone):
+    from_serial = request.args.get("from", type=int)
+    if from_serial is None:
+        return jsonify({"success": False, "message": "from serial is required"}), 400
+
+    changes = db.get_changes(zone, from_serial, request.args.get("to", type=int))
+    if changes is None:
+        # Journal doesn't cover the range, the node has to fetch the whole zone
+        return jsonify({"success": False, "message": "Full transfer required"}), 410
+
+    return jsonify({"success": True, "zone": zone, "from": from_serial, "changes": build_changes(changes)})
+
+
+@app.route("/stats/queries")
+def query_stats():
+    if not _metrics_authorized():
+        return jsonify({"success": False, "message": "Forbidden"}), 403
+
+    return jsonify(db.get_query_stats())
+
+
+def _metrics_authorized():
+    return authorized(request.remote_addr, request.headers.get("Authorization"),
+                      configuration.get("metrics-token"), configuration.get("metrics-allow", LOCAL_NETWORKS))
+
+
+@app.route("/metrics")
+def metrics():
+    if not _metrics_authorized():
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/ddns/<zone>/<domain>")
+def api_ddns(zone, domain):
+    user_id = db.token_user(request.headers.get("X-API-Token"))
+    if not user_id:
+        return jsonify({"success": False, "message": "Invalid API token"}), 401
+
+    if not db.authorized_for_zone(user_id, zone):
+        return jsonify({"success": False, "message": "Not authorized for zone"}), 403
+
+    ip = (request.headers.get("X-Forwarded-For") or request.remote_addr or "").split(",")[0].strip()
+    if not ip:
+        return jsonify({"success": False, "message": "No client address"}), 400
+
+    error = ddns.check(zone, domain, ip)
+    if error:
+        return jsonify({"success": False, "message": error}), 400
 
+    if ddns.update(zone, domain, ip):
+        return jsonify({"success": True, "message": "Queued", "address": ip}), 202
 
-# @app.route("/api/ddns/<zone>/<domain>")
-# def api_ddns(zone, domain):
-#     ip = request.headers.get("X-Forwarded-For")
-#     auth = request.headers.get("X-API-Token")
-#     # todo: auth
-#     if zone and ip and domain:
-#         db.add_record(zone, domain, "A" if "." in ip else "AAAA", ip, ttl="60")
+    return jsonify({"success": True, "message": "Unchanged", "address": ip})
 
 
 app.run(
@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+
+# lib.config reads config.yml from the working directory on import, so tests run
+# from a scratch directory with a test config and links to the repository's templates
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix="delivr-tests-")
+os.symlink(os.path.join(ROOT, "config"), os.path.join(_workdir, "config"))
+os.makedirs(os.path.join(_workdir, "automation"))
+os.symlink(os.path.join(ROOT, "automation", "templates"), os.path.join(_workdir, "automation", "templates"))
+
+with open(os.path.join(_workdir, "config.yml"), "w") as config_file:
+    config_file.write("""development: true
+database: mongodb://localhost:27017
+salt: test
+nameservers:
+  - ns1.example.com
+  - ns2.example.com
+soa_root: root.example.com
+asn: 65000
+ipv4_prefix: 192.0.2.0/24
+ipv6_prefix: 2001:db8::/48
+loopbacks:
+  - 192.0.2.1/24
+""")
+
+os.chdir(_workdir)
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def empty_db():
+    """
+    CDNDatabase on an in-memory mongomock client
+    """
+    mongomock = pytest.importorskip("mongomock")
+    pytest.importorskip("argon2")
+    from lib.database import CDNDatabase
+
+    return CDNDatabase(None, "salt", client=mongomock.MongoClient())
+
+
+@pytest.fixture
+def db(empty_db):
+    """
+    CDNDatabase with the user nate owning example.com
+    """
+    assert empty_db.add_user("nate", "correct horse battery") is None
+    user_id = str(empty_db.users.find_one({"username": "nate"})["_id"])
+    assert empty_db.add_zone("example.com", user_id) is None
+    return empty_db
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import subprocess
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+
+import agent  # noqa: E402
+
+BIG_ZONE = "".join("host" + str(i) + "    300    IN    A    192.0.2.1\n" for i in range(20000))
+
+
+async def _portal(zones, version="v1"):
+    """
+    Stand-in portal serving a fixed export
+    """
+    async def wait(request):
+        return web.json_response({"version": version, "changed": request.query.get("version") != version})
+
+    async def export(request):
+        body = "".join(json.dumps({"zone": zone, "data": data}) + "\n" for zone, data in zones.items())
+        return web.Response(text=body + json.dumps({"version": "export-1"}) + "\n", content_type="application/x-ndjson")
+
+    app = web.Application()
+    app.router.add_get("/export/wait", wait)
+    app.router.add_get("/export/zones", export)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, "http://127.0.0.1:" + str(site._server.sockets[0].getsockname()[1])
+
+
+def test_sync_writes_zones_of_any_size(tmp_path, monkeypatch):
+    reloads = []
+
+    async def rndc(*args):
+        reloads.append(args)
+        return True
+
+    monkeypatch.setattr(agent, "_rndc", rndc)
+    assert len(json.dumps(BIG_ZONE)) > 128 * 1024
+
+    async def run():
+        runner, url = await _portal({"example.com": BIG_ZONE, "example.org": "small\n"})
+        try:
+            node = agent.NodeAgent(url, str(tmp_path))
+            async with agent.aiohttp.ClientSession() as session:
+                version = await node.wait_for_change(session)
+                await node.sync(session)
+            return node, version
+        finally:
+            await runner.cleanup()
+
+    node, version = asyncio.run(run())
+
+    assert version == "v1"
+    assert node.state["export"] == "export-1"
+    assert node.state["zones"] == ["example.com", "example.org"]
+    assert (tmp_path / "db.example.com").read_text() == BIG_ZONE
+    assert "example.org" in (tmp_path / "named.conf.local").read_text()
+    assert reloads == [("reconfig",)]
+
+
+def _sync(node_factory, zones, syncs=1):
+    async def run():
+        runner, url = await _portal(zones)
+        try:
+            node = node_factory(url)
+            async with agent.aiohttp.ClientSession() as session:
+                for _ in range(syncs):
+                    try:
+                        await node.sync(session)
+                    except RuntimeError:
+                        pass
+            return node
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_failed_rndc_keeps_the_export_version(tmp_path, monkeypatch):
+    calls = []
+
+    async def rndc(*args):
+        calls.append(args)
+        return len(calls) > 1  # The first reconfig fails
+
+    monkeypatch.setattr(agent, "_rndc", rndc)
+    node = _sync(lambda url: agent.NodeAgent(url, str(tmp_path)), {"example.com": "zone\n"})
+    assert (node.state["export"], node.state["zones"]) == (None, [])
+
+    def restarted(url):
+        node.portal = url
+        return node
+
+    node = _sync(restarted, {"example.com": "zone\n"})
+    assert (node.state["export"], node.state["zones"]) == ("export-1", ["example.com"])
+
+
+def test_reloads_are_bounded(tmp_path, monkeypatch):
+    zones = {"zone" + str(n) + ".com": "zone\n" for n in range(20)}
+    running = {"now": 0, "max": 0, "calls": []}
+
+    async def rndc(*args):
+        running["calls"].append(args)
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        return True
+
+    monkeypatch.setattr(agent, "_rndc", rndc)
+
+    def configured(url, reload_all_over=100):
+        node = agent.NodeAgent(url, str(tmp_path), reload_concurrency=4, reload_all_over=reload_all_over)
+        node.state["zones"] = sorted(zones)
+        return node
+
+    _sync(configured, zones)
+    assert len(running["calls"]) == 20
+    assert running["max"] == 4
+
+    running["calls"].clear()
+    _sync(lambda url: configured(url, reload_all_over=10), zones)
+    assert running["calls"] == [("reload",)]
+
+
+def test_lines_splits_across_chunks():
+    class Content:
+        async def iter_chunked(self, size):
+            for chunk in (b'{"a":', b' 1}\n{"b"', b': 2}\n', b'{"c": 3}'):
+                yield chunk
+
+    async def collect():
+        return [line async for line in agent._lines(Content())]
+
+    assert asyncio.run(collect()) == [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']
+
+
+def test_jump_reads_the_inventory(tmp_path):
+    inventory = tmp_path / "hosts"
+    inventory.write_text("fmt-us ansible_host=198.51.100.1\nams-nl ansible_host=198.51.100.2\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    output = subprocess.run(["python3", os.path.join(root, "jump.py"), str(inventory)], capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == str({"fmt-us": "198.51.100.1", "ams-nl": "198.51.100.2"})
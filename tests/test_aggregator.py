@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+pytest.importorskip("jinja2")
+
+from lib import aggregator  # noqa: E402
+
+
+def _zone(name, serial, value="192.0.2.1"):
+    return {"zone": name, "serial": serial, "records": [{"id": "1", "domain": "www", "ttl": 300, "type": "A", "value": value}]}
+
+
+def test_serial_version_changes_with_serials():
+    assert aggregator.serial_version({"a.com": 1}) == aggregator.serial_version({"a.com": 1})
+    assert aggregator.serial_version({"a.com": 1}) != aggregator.serial_version({"a.com": 2})
+    assert aggregator.serial_version({"a.com": 1}) != aggregator.serial_version({"a.com": 1, "b.com": 1})
+
+
+def test_incremental_build_only_returns_changes():
+    version, _ = aggregator.build_manifest([_zone("a.com", 1), _zone("b.com", 1)])
+    zones = aggregator.build_zones([_zone("a.com", 2, "192.0.2.2")], since=version)
+
+    assert set(zones) == {"a.com", "b.com"}
+    assert "192.0.2.2" in zones["a.com"]
+    assert zones["b.com"] is None
+
+
+def test_stream_ends_with_version():
+    lines = [json.loads(line) for line in aggregator.stream_zones([_zone("a.com", 1)])]
+
+    assert lines[0]["zone"] == "a.com"
+    assert aggregator.known_version(lines[-1]["version"])
+
+
+def test_zone_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(aggregator, "MAX_CACHED_ZONES", 2)
+    monkeypatch.setattr(aggregator, "_export_zone_count", 0)
+    aggregator._zone_cache.clear()
+
+    for name in ("a.com", "b.com", "c.com"):
+        aggregator.render_zone(_zone(name, 1))
+
+    assert list(aggregator._zone_cache) == ["b.com", "c.com"]
+
+
+def test_repeated_exports_hit_the_cache_beyond_its_minimum_size(monkeypatch):
+    monkeypatch.setattr(aggregator, "MAX_CACHED_ZONES", 100)
+    monkeypatch.setattr(aggregator, "_export_zone_count", 0)
+    aggregator._zone_cache.clear()
+    zones = [_zone("zone" + str(n) + ".com", 1) for n in range(150)]
+    renders = []
+    render_zone_file = aggregator.render_zone_file
+    monkeypatch.setattr(aggregator, "render_zone_file", lambda *args: renders.append(args) or render_zone_file(*args))
+
+    for _ in range(3):
+        aggregator.build_zones(zones)
+
+    # The manifest sizes the cache before rendering, so only the first export renders
+    assert len(renders) == 150
+    assert len(aggregator._zone_cache) == 150
+
+
+def test_remembered_versions_are_bounded_by_entries(monkeypatch):
+    monkeypatch.setattr(aggregator, "MAX_EXPORT_ENTRIES", 5)
+    aggregator._export_versions.clear()
+
+    first, _ = aggregator.build_manifest([_zone("a.com", 1), _zone("b.com", 1)])
+    second, _ = aggregator.build_manifest([_zone("a.com", 2), _zone("b.com", 1)])
+    third, _ = aggregator.build_manifest([_zone("a.com", 3), _zone("b.com", 1)])
+
+    assert not aggregator.known_version(first)
+    assert aggregator.known_version(second) and aggregator.known_version(third)
+
+    monkeypatch.setattr(aggregator, "MAX_EXPORT_ENTRIES", 1)
+    latest, _ = aggregator.build_manifest([_zone("a.com", 4), _zone("b.com", 1)])
+    assert list(aggregator._export_versions) == [latest]
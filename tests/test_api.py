@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+pytest.importorskip("mongomock")
+pytest.importorskip("argon2")
+
+from flask import Flask  # noqa: E402
+
+from lib.api import create_api  # noqa: E402
+
+
+@pytest.fixture
+def client(db):
+    app = Flask(__name__)
+    app.register_blueprint(create_api(db), url_prefix="/api")
+    client = app.test_client()
+    token = db.create_token(str(db.users.find_one({"username": "nate"})["_id"]))
+    client.environ_base["HTTP_X_API_TOKEN"] = token
+    return client
+
+
+def _record_ids(db):
+    return [str(record["id"]) for record in db.zones.find_one({"zone": "example.com"})["records"]]
+
+
+def test_ndjson_streams_every_record_once(db, client):
+    assert db.add_records("example.com", [
+        {"domain": "host" + str(n), "type": "A", "value": "192.0.2." + str(n), "ttl": "300"} for n in range(25)
+    ]) is None
+
+    response = client.get("/api/zones/example.com/records?format=ndjson")
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line["id"] for line in lines] == _record_ids(db)
+
+
+def test_records_of_a_deleted_zone_are_not_found(db, client, monkeypatch):
+    monkeypatch.setattr(db, "authorized_for_zone", lambda user_id, zone: True)
+    assert client.get("/api/zones/missing.com/records").status_code == 404
+
+
+@pytest.mark.parametrize("body", [[], "create", {"create": {"zone": "example.com"}}, {"delete": "id"}])
+def test_batch_rejects_malformed_bodies(client, body):
+    response = client.post("/api/records/batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["success"] is False
+
+
+def test_batch_rejects_duplicate_ids(db, client):
+    assert db.add_record("example.com", "www", "A", "192.0.2.1", "300") is None
+    record_id = _record_ids(db)[0]
+
+    response = client.post("/api/records/batch", json={
+        "update": [{"zone": "example.com", "id": record_id, "domain": "www", "type": "A", "value": "192.0.2.2", "ttl": "300"}],
+        "delete": [{"zone": "example.com", "id": record_id}]
+    })
+    assert response.status_code == 400
+    assert "more than once" in response.get_json()["errors"][0]["message"]
+    assert db.apply_records("example.com", delete=[record_id, record_id]) == "Record " + record_id + " is changed more than once"
+
+
+def test_batch_applies_changes_per_zone(db, client):
+    response = client.post("/api/records/batch", json={
+        "create": [{"zone": "example.com", "domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}]
+    })
+    assert response.get_json()["success"] is True
+    assert len(_record_ids(db)) == 1
+
+
+@pytest.mark.parametrize("action,entry,message", [
+    ("create", {"zone": 1, "domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}, "zone must be a string"),
+    ("create", {"zone": {"name": "example.com"}, "domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}, "zone must be a string"),
+    ("create", {"zone": "example.com", "domain": ["www"], "type": "A", "value": "192.0.2.1", "ttl": "300"}, "domain must be a string"),
+    ("update", {"zone": "example.com", "id": 5, "domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}, "id must be a string"),
+    ("delete", {"zone": ["example.com"], "id": "5"}, "zone must be a string"),
+    ("delete", {"zone": "example.com"}, "id is required"),
+    ("delete", "example.com", "Entry must be an object"),
+])
+def test_batch_rejects_fields_of_the_wrong_type(client, action, entry, message):
+    response = client.post("/api/records/batch", json={action: [entry]})
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["message"] == message
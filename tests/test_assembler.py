@@ -0,0 +1,53 @@
+import gzip
+import importlib
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+
+class _Portal(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = gzip.compress((json.dumps({"zone": "example.com", "data": "zone file\n"}) + "\n" + json.dumps({"version": "export-1"}) + "\n").encode())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def portal():
+    server = HTTPServer(("127.0.0.1", 0), _Portal)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:" + str(server.server_address[1]) + "/export/zones"
+    server.shutdown()
+
+
+def test_fetch_writes_compressed_exports(portal, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["assembler.py", portal, str(tmp_path)])
+    sys.modules.pop("assembler", None)
+    assembler = importlib.import_module("assembler")
+
+    state = {}
+    session = assembler._session()
+
+    assert assembler.fetch(session, state)
+    assert (tmp_path / "db.example.com").read_text() == "zone file\n"
+    assert state == {"etag": "v1", "export": "export-1", "zones": ["example.com"]}
+
+    # Unchanged exports are answered with 304
+    assert not assembler.fetch(session, state)
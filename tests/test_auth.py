@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+pytest.importorskip("argon2")
+
+from lib import auth  # noqa: E402
+
+
+def test_hash_and_verify():
+    password_hash, error = auth.hash_password("correct horse")
+
+    assert error is None
+    assert auth.verify_password(password_hash, "correct horse") == (True, None, None)
+    assert auth.verify_password(password_hash, "wrong")[0] is False
+
+
+def test_legacy_hashes_are_upgraded():
+    legacy = auth._legacy_hash("correct horse", "legacy-salt")
+    valid, new_hash, error = auth.verify_password(legacy, "correct horse", "legacy-salt")
+
+    assert valid and error is None
+    assert new_hash.startswith("$argon2id$")
+    assert auth.verify_password(legacy, "wrong", "legacy-salt")[0] is False
+
+
+def test_unknown_users_spend_a_password_check(monkeypatch):
+    checked = []
+    monkeypatch.setattr(auth, "_verify", lambda stored, password, salt: checked.append(stored) or (False, None))
+
+    assert auth.reject_unknown_user("password") is None
+    assert checked and checked[0].startswith("$argon2id$")
+
+
+def test_logins_are_rejected_when_too_many_wait(monkeypatch):
+    monkeypatch.setattr(auth, "_queue", threading.BoundedSemaphore(1))
+    assert auth._queue.acquire(blocking=False)
+
+    assert auth.hash_password("password") == (None, "Server busy, try again later")
+
+
+def test_rate_limit(monkeypatch):
+    monkeypatch.setattr(auth, "_attempts", auth.OrderedDict())
+    results = [auth.rate_limited("nate") for _ in range(6)]
+
+    assert results == [False] * 5 + [True]
+
+
+def test_idle_usernames_are_forgotten(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(auth, "_attempts", auth.OrderedDict())
+    monkeypatch.setattr(auth.time, "monotonic", lambda: clock[0])
+
+    for name in ("a", "b", "c"):
+        auth.rate_limited(name)
+    clock[0] += 30
+    auth.rate_limited("a")
+    clock[0] += 45
+
+    # b and c are past the 60 second window, a tried again 45 seconds ago
+    auth.rate_limited("d")
+    assert list(auth._attempts) == ["a", "d"]
@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("mongomock")
+pytest.importorskip("argon2")
+
+from benchmarks import suite  # noqa: E402
+
+
+def _report(backend, p50=0.01, queries=3):
+    return {"backend": backend, "results": {"dashboard": {"p50": p50, "p95": p50, "mean": p50, "queries": queries}}}
+
+
+def test_mongomock_runs_do_not_count_queries(empty_db):
+    assert suite._time(empty_db, lambda: empty_db.get_nodes(max_age=0), 3)["queries"] is None
+
+
+def test_query_thresholds_are_skipped_without_counts():
+    assert suite.compare(_report("mongomock", queries=None), _report("mongomock", queries=None), 1.25) == []
+    assert suite.compare(_report("mongod", queries=4), _report("mongod", queries=3), 1.25) == ["dashboard: queries 3 -> 4"]
+
+
+def test_slower_runs_are_regressions():
+    assert len(suite.compare(_report("mongod", p50=0.02), _report("mongod"), 1.25)) == 1
+
+
+def test_baselines_from_another_backend_are_refused():
+    regressions = suite.compare(_report("mongod"), _report("mongomock", queries=None), 1.25)
+    assert regressions == ["baseline ran on mongomock, not mongod, compare runs on the same backend"]
+
+
+def test_seeding_keeps_the_migration_indexes(empty_db):
+    suite._seed(empty_db, 2, 4, 8)
+
+    assert "zone_1" in empty_db.zones.index_information()
+    assert "zone_1_serial_1_part_1" in empty_db.journal.index_information()
+    assert empty_db.zones.count_documents({}) == 4
+    assert empty_db.users.find_one({"username": "user0@example.com"})["record_count"] == 4
@@ -0,0 +1,189 @@
+import threading
+
+import pytest
+
+pytest.importorskip("mongomock")
+pytest.importorskip("argon2")
+
+from lib import database as database_module  # noqa: E402
+
+
+def _serial(db):
+    return db.zones.find_one({"zone": "example.com"})["serial"]
+
+
+def _records(db):
+    return db.zones.find_one({"zone": "example.com"})["records"]
+
+
+def test_changes_are_journaled_per_serial(db):
+    start = _serial(db)
+    assert db.add_record("example.com", "www", "A", "192.0.2.1", "300") is None
+    record_id = str(_records(db)[0]["id"])
+    assert db.update_record("example.com", record_id, "www", "A", "192.0.2.2", "300") is None
+    assert db.delete_record("example.com", record_id) is None
+
+    changes = db.get_changes("example.com", start)
+    assert [change["serial"] for change in changes] == [start + 1, start + 2, start + 3]
+    assert [record["value"] for record in changes[1]["added"]] == ["192.0.2.2"]
+    assert [record["value"] for record in changes[1]["deleted"]] == ["192.0.2.1"]
+    assert [record["value"] for record in changes[2]["deleted"]] == ["192.0.2.2"]
+    assert _records(db) == []
+
+
+def test_updates_keep_record_order(db):
+    db.add_records("example.com", [{"domain": name, "type": "A", "value": "192.0.2.1", "ttl": "300"} for name in ("a", "b", "c")])
+    records = _records(db)
+
+    assert db.apply_records("example.com", update=[dict(records[1], value="192.0.2.9")], delete=[str(records[0]["id"])]) is None
+    assert [(record["domain"], record["value"]) for record in _records(db)] == [("b", "192.0.2.9"), ("c", "192.0.2.1")]
+
+
+def test_values_starting_with_dollar_are_stored_literally(db):
+    assert db.add_record("example.com", "txt", "TXT", "$notafield", "300") is None
+    assert _records(db)[0]["value"] == "$notafield"
+
+
+def test_large_changes_are_split_into_parts(db, monkeypatch):
+    monkeypatch.setattr(database_module, "JOURNAL_CHUNK", 2)
+    start = _serial(db)
+    db.add_records("example.com", [{"domain": "host" + str(i), "type": "A", "value": "192.0.2.1", "ttl": "300"} for i in range(5)])
+
+    assert db.journal.count_documents({"zone": "example.com", "serial": start + 1}) == 3
+    assert len(db.get_changes("example.com", start)[0]["added"]) == 5
+
+
+def test_oversized_changes_require_full_transfer(db, monkeypatch):
+    monkeypatch.setattr(database_module, "MAX_JOURNAL_RECORDS", 2)
+    start = _serial(db)
+    db.add_records("example.com", [{"domain": "host" + str(i), "type": "A", "value": "192.0.2.1", "ttl": "300"} for i in range(3)])
+
+    assert _serial(db) == start + 1
+    assert db.get_changes("example.com", start) is None
+
+
+def test_missing_serials_require_full_transfer(db):
+    start = _serial(db)
+    db.add_record("example.com", "a", "A", "192.0.2.1", "300")
+    db.add_record("example.com", "b", "A", "192.0.2.1", "300")
+    db.journal.delete_many({"serial": start + 2})
+
+    assert db.get_changes("example.com", start) is None
+    assert len(db.get_changes("example.com", start, start + 1)) == 1
+    assert db.get_changes("example.com", 0) is None
+
+
+def test_claimed_serial_makes_writers_retry(db, monkeypatch):
+    start = _serial(db)
+    monkeypatch.setattr(database_module.time, "sleep", lambda seconds: None)
+
+    # Another writer holds the next serial and never finishes
+    assert db._journal("example.com", start + 1, added=[]) is not None
+    assert db.add_record("example.com", "a", "A", "192.0.2.1", "300") == "Zone is being changed by another request, try again"
+    assert _serial(db) == start
+
+
+def test_stale_claims_are_taken_over(db, monkeypatch):
+    start = _serial(db)
+    db._journal("example.com", start + 1, added=[])
+    db.journal.update_many({}, {"$set": {"time": database_module.datetime(2000, 1, 1)}})
+
+    assert db.add_record("example.com", "a", "A", "192.0.2.1", "300") is None
+    assert [record["domain"] for record in db.get_changes("example.com", start)[0]["added"]] == ["a"]
+
+
+def test_types_are_stored_uppercase_and_zero_ttl_is_allowed(db):
+    assert db.add_record("example.com", "www", "a", "192.0.2.1", 0) is None
+    assert _records(db)[0]["type"] == "A"
+    assert _records(db)[0]["ttl"] == 0
+
+
+def test_reconcile_fixes_drifted_counters(db, monkeypatch):
+    monkeypatch.setattr(database_module.time, "sleep", lambda seconds: None)
+    db.add_record("example.com", "www", "A", "192.0.2.1", "300")
+    db.users.update_many({}, {"$set": {"record_count": 7}})
+
+    assert db.reconcile_counters() == 1
+    assert db.users.find_one({})["record_count"] == 1
+    assert db.reconcile_counters() == 0
+
+
+def test_reconcile_leaves_counters_changed_while_settling(db, monkeypatch):
+    db.users.update_many({}, {"$set": {"record_count": 7}})
+    user = db.users.find_one({})["_id"]
+
+    # A write lands between the two passes
+    monkeypatch.setattr(database_module.time, "sleep", lambda seconds: db._count_change([user], records=1))
+
+    assert db.reconcile_counters() == 0
+    assert db.users.find_one({})["record_count"] == 8
+
+
+def test_record_search_ignores_case_and_follows_writes(db):
+    assert db.add_records("example.com", [
+        {"domain": "WWW", "type": "A", "value": "192.0.2.1", "ttl": "300"},
+        {"domain": "mail", "type": "A", "value": "192.0.2.2", "ttl": "300"},
+        {"domain": "@", "type": "TXT", "value": "v=spf1 -all", "ttl": "300"}
+    ]) is None
+
+    assert [record["domain"] for record in db.get_records("example.com", search="ww", prefix=True)["records"]] == ["WWW"]
+    assert db.get_records("example.com", search="txt")["record_count"] == 1
+    assert db.get_records("example.com", search="SPF1")["record_count"] == 1
+    assert db.get_records("example.com", search="spf1", prefix=True)["record_count"] == 0
+
+    mail = next(record for record in _records(db) if record["domain"] == "mail")
+    assert db.update_record("example.com", str(mail["id"]), "smtp", "A", "192.0.2.2", "300") is None
+    assert db.get_records("example.com", search="mail")["record_count"] == 0
+    assert db.get_records("example.com", search="smtp")["record_count"] == 1
+
+    assert db.delete_record("example.com", str(mail["id"])) is None
+    assert db.get_records("example.com", search="192.0.2.", prefix=True)["record_count"] == 1
+
+    assert db.delete_zone("example.com") is None
+    assert db.record_search.count_documents({}) == 0
+
+
+def test_record_search_pages_in_zone_order(db):
+    assert db.add_records("example.com", [
+        {"domain": "host" + str(n), "type": "A", "value": "192.0.2." + str(n), "ttl": "300"} for n in range(5)
+    ]) is None
+
+    page = db.get_records("example.com", skip=2, limit=2, search="host", prefix=True)
+    assert page["record_count"] == 5
+    assert [record["domain"] for record in page["records"]] == ["host2", "host3"]
+
+
+def test_zone_search_ignores_case(db):
+    user_id = str(db.users.find_one({"username": "nate"})["_id"])
+    assert db.search_zones(user_id, "EXAMPLE")[1] == 1
+    assert db.search_zones(user_id, "AMPLE", prefix=False)[1] == 1
+
+
+def test_query_stats_add_up_across_threads(db):
+    def requests():
+        for _ in range(500):
+            db.begin_request()
+            db.end_request("records")
+
+    threads = [threading.Thread(target=requests) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = db.get_query_stats()
+    assert stats["records"]["requests"] == 4000
+    stats["records"]["requests"] = 0
+    assert db.get_query_stats()["records"]["requests"] == 4000
+
+
+def test_recently_changed_zones_come_from_the_journal(db):
+    user_id = str(db.users.find_one({"username": "nate"})["_id"])
+    assert db.add_zone("example.org", user_id) is None
+    before = database_module.datetime.utcnow() - database_module.timedelta(seconds=1)
+    assert db.add_record("example.org", "www", "A", "192.0.2.1", "300") is None
+
+    assert db.get_changed_zones(before) == ["example.org"]
+    assert db.get_changed_zones(database_module.datetime.utcnow() + database_module.timedelta(seconds=1)) == []
+    assert sorted(db.get_zone_sample(5)) == ["example.com", "example.org"]
+    assert db.get_zone_serials(["example.org"]) == {"example.org": _serial(db) + 1}
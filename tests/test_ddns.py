@@ -0,0 +1,85 @@
+import pytest
+
+pytest.importorskip("mongomock")
+pytest.importorskip("argon2")
+
+from lib.database import ZONE_BUSY  # noqa: E402
+from lib.ddns import DDNSBuffer  # noqa: E402
+
+
+def _values(db):
+    return [record["value"] for record in db.zones.find_one({"zone": "example.com"})["records"]]
+
+
+def test_updates_are_coalesced_per_record(db):
+    buffer = DDNSBuffer(db)
+    serial = db.zones.find_one({"zone": "example.com"})["serial"]
+
+    assert buffer.update("example.com", "home", "192.0.2.1")
+    assert buffer.update("example.com", "home", "192.0.2.2")
+    assert buffer.flush() == {}
+
+    assert _values(db) == ["192.0.2.2"]
+    assert db.zones.find_one({"zone": "example.com"})["serial"] == serial + 1
+    assert not buffer.update("example.com", "home", "192.0.2.2")
+
+
+def test_returning_to_the_written_address_drops_the_queued_change(db):
+    buffer = DDNSBuffer(db)
+    buffer.update("example.com", "home", "192.0.2.1")
+    buffer.flush()
+
+    assert buffer.update("example.com", "home", "192.0.2.2")
+    assert not buffer.update("example.com", "home", "192.0.2.1")
+    assert buffer.flush() == {}
+    assert _values(db) == ["192.0.2.1"]
+
+
+def test_other_writes_invalidate_written_addresses(db):
+    buffer = DDNSBuffer(db)
+    buffer.update("example.com", "home", "192.0.2.1")
+    buffer.flush()
+
+    record_id = str(db.zones.find_one({"zone": "example.com"})["records"][0]["id"])
+    assert db.update_record("example.com", record_id, "home", "A", "192.0.2.9", "60") is None
+
+    assert buffer.update("example.com", "home", "192.0.2.1")
+    buffer.flush()
+    assert _values(db) == ["192.0.2.1"]
+
+
+def test_failed_flushes_are_queued_again(db, monkeypatch):
+    buffer = DDNSBuffer(db)
+    upsert_records = db.upsert_records
+
+    def fail(zone, records):
+        raise ConnectionError("database unreachable")
+
+    monkeypatch.setattr(db, "upsert_records", fail)
+    buffer.update("example.com", "home", "192.0.2.1")
+    assert buffer.flush() == {"example.com": "database unreachable"}
+
+    monkeypatch.setattr(db, "upsert_records", lambda zone, records: ZONE_BUSY)
+    assert buffer.flush() == {"example.com": ZONE_BUSY}
+
+    # A newer address queued meanwhile wins over the failed one
+    buffer.update("example.com", "home", "192.0.2.2")
+    monkeypatch.setattr(db, "upsert_records", upsert_records)
+    assert buffer.flush() == {}
+    assert _values(db) == ["192.0.2.2"]
+
+
+def test_permanent_errors_are_not_retried(db):
+    buffer = DDNSBuffer(db)
+    buffer.update("missing.com", "home", "192.0.2.1")
+    assert buffer.flush() == {"missing.com": "Zone doesn't exist"}
+    assert buffer.flush() == {}
+
+
+def test_invalid_updates_are_refused_before_queueing(db):
+    buffer = DDNSBuffer(db)
+    assert buffer.check("example.com", "home", "192.0.2.1") is None
+    assert buffer.check("example.com", "home", "2001:db8::1") is None
+    assert buffer.check("example.com", "bad name!", "192.0.2.1") is not None
+    assert buffer.check("example.com", "home.other.org.", "192.0.2.1") is not None
+    assert buffer.check("example.com", "home", "not-an-address") is not None
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+pytest.importorskip("jinja2")
+
+from lib import exporter  # noqa: E402
+
+
+def _zone(name, serial, value="192.0.2.1"):
+    return {"zone": name, "serial": serial, "records": [{"id": "1", "domain": "www", "ttl": "300", "type": "A", "value": value}]}
+
+
+def test_builds_in_the_same_second_get_their_own_generation(tmp_path):
+    first, _ = exporter.build_zones([_zone("a.com", 1)], str(tmp_path), workers=1)
+    second, _ = exporter.build_zones([_zone("a.com", 1)], str(tmp_path), workers=1)
+
+    assert first["generation"] != second["generation"]
+    assert os.readlink(tmp_path / "current") == os.path.join("generations", second["generation"])
+
+
+def test_unchanged_zones_are_linked_and_old_generations_removed(tmp_path):
+    exporter.build_zones([_zone("a.com", 1), _zone("b.com", 1)], str(tmp_path), workers=1)
+    previous = os.stat(tmp_path / "current" / "db.a.com").st_ino
+
+    for serial in range(2, 6):
+        _, report = exporter.build_zones([_zone("a.com", 1), _zone("b.com", serial)], str(tmp_path), workers=1)
+
+    assert report["rendered"] == 1
+    assert os.stat(tmp_path / "current" / "db.a.com").st_ino == previous
+    assert len(os.listdir(tmp_path / "generations")) == exporter.KEEP_GENERATIONS
+    assert "b.com" in (tmp_path / "current" / "named.conf.local").read_text()
+
+
+def test_broken_zones_keep_their_last_version(tmp_path):
+    exporter.build_zones([_zone("a.com", 1)], str(tmp_path), workers=1)
+    manifest, report = exporter.build_zones([_zone("a.com", 2, "not an address")], str(tmp_path), workers=1)
+
+    assert manifest["zones"]["a.com"]["serial"] == 1
+    assert "a.com" in report["lint_errors"]
+    assert "192.0.2.1" in (tmp_path / "current" / "db.a.com").read_text()
+
+
+def test_broken_zones_without_a_last_version_abort_the_export(tmp_path):
+    exporter.build_zones([_zone("a.com", 1)], str(tmp_path), workers=1)
+    generations = os.listdir(tmp_path / "generations")
+
+    manifest, report = exporter.build_zones([_zone("a.com", 1), _zone("b.com", 1, "not an address")], str(tmp_path), workers=1)
+
+    assert manifest is None
+    assert "b.com" in report["error"]
+    assert os.listdir(tmp_path / "generations") == generations
+
+    manifest, _ = exporter.build_zones([_zone("a.com", 1), _zone("b.com", 1, "not an address")], str(tmp_path), workers=1, force=True)
+    assert "b.com" in manifest["zones"]
+
+
+def _node(uid, management="192.0.2.10", **overrides):
+    return dict({"uid": uid, "management": management}, **overrides)
+
+
+def test_only_changed_nodes_are_rolled_out_again(tmp_path):
+    nodes = [_node("fmt-us"), _node("ams-nl", "192.0.2.11")]
+    manifest, report = exporter.build_node_configs(nodes, str(tmp_path), workers=1)
+    assert report["changed"] == ["ams-nl", "fmt-us"]
+    assert "PoP-Tag fmt-us" in (tmp_path / "current" / "fmt-us" / "named.conf.options").read_text()
+
+    # Only the node that succeeded is marked as deployed
+    exporter.mark_deployed(manifest, ["fmt-us"], str(tmp_path))
+    _, report = exporter.build_node_configs(nodes, str(tmp_path), workers=1)
+    assert report["changed"] == ["ams-nl"]
+
+    manifest, report = exporter.build_node_configs([_node("fmt-us", asn=65001), nodes[1]], str(tmp_path), workers=1)
+    assert report["changed"] == ["ams-nl", "fmt-us"]
+
+
+def test_removed_nodes_are_forgotten(tmp_path):
+    manifest, _ = exporter.build_node_configs([_node("fmt-us"), _node("ams-nl")], str(tmp_path), workers=1)
+    exporter.mark_deployed(manifest, ["fmt-us", "ams-nl"], str(tmp_path))
+
+    manifest, report = exporter.build_node_configs([_node("fmt-us")], str(tmp_path), workers=1)
+    exporter.mark_deployed(manifest, [], str(tmp_path))
+    assert report["changed"] == []
+    assert exporter._read_manifest(str(tmp_path), exporter.DEPLOYED, None)["nodes"] == {"fmt-us": manifest["nodes"]["fmt-us"]}
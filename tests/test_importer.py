@@ -0,0 +1,63 @@
+from lib.importer import file_format, parse, parse_bind, parse_csv
+
+ZONE_FILE = """$TTL 3600
+@       IN SOA ns1.example.com. root.example.com. (
+            2024010100 ; serial
+            7200 3600 1209600 3600 )
+@       IN NS  ns1.delivr.dev.
+example.com. IN NS ns2.other.
+EXAMPLE.COM. 300 IN A 192.0.2.1
+www     IN A   192.0.2.2
+        IN AAAA 2001:db8::2
+mail    600 MX 10 mx.example.com.
+txt     IN TXT "v=spf1 -all ; not a comment"
+$ORIGIN sub.example.com.
+host    IN A   192.0.2.3
+@       IN NS  ns1.sub.example.com.
+"""
+
+
+def test_parse_bind_normalizes_owners():
+    records = [record for _, record in parse_bind(ZONE_FILE.splitlines(), zone="example.com")]
+
+    assert [(record["domain"], record["type"]) for record in records] == [
+        ("@", "A"), ("www", "A"), ("www", "AAAA"), ("mail", "MX"), ("txt", "TXT"), ("host.sub", "A"), ("sub", "NS")
+    ]
+    assert records[0]["ttl"] == "300"
+    assert records[1]["ttl"] == "3600"
+    assert records[4]["value"] == '"v=spf1 -all ; not a comment"'
+
+
+def test_parse_bind_rejects_out_of_zone_names():
+    records, errors = parse(["other.org. IN A 192.0.2.1"], "bind", "example.com")
+
+    assert records == []
+    assert errors == ["Line 1: other.org. is outside of zone example.com"]
+
+
+def test_parse_csv():
+    records = [record for _, record in parse_csv(["domain,type,value,ttl", "www,a,192.0.2.1,300"])]
+
+    assert records == [{"domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}]
+
+
+def test_file_format():
+    assert file_format("records.CSV") == "csv"
+    assert file_format("db.example.com") == "bind"
+    assert file_format(None) == "bind"
+
+
+def test_parentheses_inside_quotes_are_kept():
+    lines = [
+        'smile   IN TXT "hello :) world"',
+        'open    IN TXT "a ( b \\" ( c"',
+        'www     IN A   192.0.2.1',
+        'multi   IN TXT ( "part (one)"',
+        '                 "part two" )',
+    ]
+    records = [record for _, record in parse_bind(lines, zone="example.com")]
+
+    assert [record["domain"] for record in records] == ["smile", "open", "www", "multi"]
+    assert records[0]["value"] == '"hello :) world"'
+    assert records[1]["value"] == '"a ( b \\" ( c"'
+    assert "part (one)" in records[3]["value"]
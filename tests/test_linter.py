@@ -0,0 +1,56 @@
+from lib.linter import find_conflicts, lint_record, lint_zone, owner_name
+
+
+def _record(**fields):
+    record = {"domain": "www", "type": "A", "value": "192.0.2.1", "ttl": "300"}
+    record.update(fields)
+    return record
+
+
+def test_valid_records():
+    assert lint_record(_record()) == []
+    assert lint_record(_record(type="a")) == []
+    assert lint_record(_record(type="MX", value="10 mail.example.com.")) == []
+    assert lint_record(_record(type="TXT", value='"v=spf1 -all"')) == []
+
+
+def test_previously_stored_types_are_accepted():
+    assert lint_record(_record(domain="example.com.", type="DS", value="12345 13 2 A1B2C3D4")) == []
+    assert lint_record(_record(type="SPF", value='"v=spf1 -all"')) == []
+    assert lint_record(_record(domain="_443._tcp", type="TLSA", value="3 1 1 0123456789ABCDEF")) == []
+    assert lint_record(_record(type="NAPTR", value='100 10 "U" "E2U+sip" "!^.*$!sip:info@example.com!" .')) == []
+    assert lint_record(_record(type="TYPE65534", value=r"\# 0")) == []
+
+    assert lint_record(_record(type="DS", value="12345 13")) == ["DS value must be <key tag> <algorithm> <digest type> <digest>"]
+    assert lint_record(_record(type="BOGUS", value="x")) == ["Unsupported record type BOGUS"]
+
+
+def test_zero_ttl_is_not_blank():
+    assert lint_record(_record(ttl=0)) == []
+    assert lint_record(_record(ttl="0")) == []
+
+
+def test_blank_fields():
+    assert lint_record(_record(ttl="")) == ["Entry is blank"]
+    assert lint_record(_record(value=None)) == ["Entry is blank"]
+    assert lint_record(_record(domain="  ")) == ["Entry is blank"]
+
+
+def test_invalid_values():
+    assert lint_record(_record(value="192.0.2.300")) == ["Invalid IPv4 address 192.0.2.300"]
+    assert lint_record(_record(type="SOA")) == ["SOA records are generated by delivr"]
+    assert lint_record(_record(ttl="-1")) == ["TTL must be between 0 and 2147483647"]
+    assert lint_record(_record(domain="www.other.org."), "example.com") == ["www.other.org. is outside of zone example.com"]
+
+
+def test_owner_name():
+    assert owner_name("EXAMPLE.com.", "example.com") == "@"
+    assert owner_name("www.example.com.", "example.com") == "www"
+    assert owner_name("www", "example.com") == "www"
+    assert owner_name("www.example.org.", "example.com") is None
+
+
+def test_conflicts():
+    assert find_conflicts("example.com", [_record(type="CNAME", value="a.example.com."), _record(domain="www.example.com.")]) == ["www: CNAME and other data"]
+    assert find_conflicts("example.com", [_record(domain="@", type="CNAME", value="a.example.com.")]) == ["@: CNAME and other data"]
+    assert lint_zone("example.com", [_record(), _record(domain="mail")]) == []
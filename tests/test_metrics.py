@@ -0,0 +1,43 @@
+import json
+
+from lib import metrics
+
+
+def test_render_formats_every_kind(tmp_path):
+    metrics.inc("test_render_total", "Things counted", route="a\"b")
+    metrics.set_gauge("test_render_gauge", 3, "A gauge")
+    metrics.observe("test_render_seconds", 0.02, "A histogram", buckets=(0.01, 0.1), route="x")
+
+    lines = metrics.render(str(tmp_path / "missing.jsonl")).splitlines()
+    assert "# HELP test_render_total Things counted" in lines
+    assert "# TYPE test_render_total counter" in lines
+    assert 'test_render_total{route="a\\"b"} 1' in lines
+    assert "test_render_gauge 3" in lines
+    assert 'test_render_seconds_bucket{route="x",le="0.01"} 0' in lines
+    assert 'test_render_seconds_bucket{route="x",le="0.1"} 1' in lines
+    assert 'test_render_seconds_bucket{route="x",le="+Inf"} 1' in lines
+    assert 'test_render_seconds_count{route="x"} 1' in lines
+
+
+def test_render_reads_the_last_rollout_of_each_playbook(tmp_path):
+    log = tmp_path / "rollouts.jsonl"
+    log.write_text("\n".join(json.dumps(entry) for entry in [
+        {"playbook": "test-zones.yml", "seconds": 5, "failed": [], "started": 1},
+        {"playbook": "test-zones.yml", "seconds": 7, "failed": ["pop1-us"], "started": 2},
+    ]) + "\n")
+
+    lines = metrics.render(str(log)).splitlines()
+    assert 'delivr_rollout_last_seconds{playbook="test-zones.yml"} 7' in lines
+    assert 'delivr_rollout_last_failed_hosts{playbook="test-zones.yml"} 1' in lines
+
+
+def test_only_allowed_networks_or_the_token_are_authorized():
+    assert metrics.authorized("127.0.0.1", None)
+    assert metrics.authorized("::1", None)
+    assert not metrics.authorized("203.0.113.5", None)
+    assert not metrics.authorized(None, None)
+
+    assert metrics.authorized("10.1.2.3", None, allow=["10.0.0.0/8"])
+    assert metrics.authorized("203.0.113.5", "Bearer secret", token="secret")
+    assert not metrics.authorized("203.0.113.5", "Bearer wrong", token="secret")
+    assert not metrics.authorized("203.0.113.5", "Bearer ", token="")
@@ -0,0 +1,78 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from lib import migrations  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["cdn"]
+
+
+def test_migrate_applies_every_version_once(db):
+    assert migrations.migrate(db) == [version for version, _, _ in migrations.MIGRATIONS]
+    assert migrations.migrate(db) == []
+    assert db["meta"].find_one({"_id": "migration-lock"}) is None
+
+
+def test_duplicates_are_merged_before_unique_indexes(db):
+    first = db["zones"].insert_one({"zone": "example.com", "users": ["a"], "serial": 1, "records": [
+        {"domain": "www", "type": "A", "value": "192.0.2.1", "ttl": 300}
+    ]}).inserted_id
+    db["zones"].insert_one({"zone": "example.com", "users": ["b"], "serial": 1, "records": [
+        {"domain": "www", "type": "A", "value": "192.0.2.1", "ttl": 300},
+        {"domain": "mail", "type": "A", "value": "192.0.2.2", "ttl": 300}
+    ]})
+    db["users"].insert_many([{"username": "nate"}, {"username": "nate"}])
+
+    migrations.migrate(db)
+
+    zone = db["zones"].find_one({"zone": "example.com"})
+    assert zone["_id"] == first
+    assert db["zones"].count_documents({"zone": "example.com"}) == 1
+    assert zone["users"] == ["a", "b"]
+    assert [record["domain"] for record in zone["records"]] == ["www", "mail"]
+    assert db["users"].count_documents({"username": "nate"}) == 1
+
+
+def test_waits_for_another_migration(db, monkeypatch):
+    migrations._acquire_lock(db, "other")
+    attempts = []
+
+    def finish_other(seconds):
+        # The other process finishes while this one waits
+        attempts.append(seconds)
+        db["meta"].update_one({"_id": "schema"}, {"$set": {"version": migrations.MIGRATIONS[-1][0]}}, upsert=True)
+
+    monkeypatch.setattr(migrations.time, "sleep", finish_other)
+
+    assert migrations.migrate(db) == []
+    assert attempts
+
+
+def test_record_search_keys_are_built_for_existing_records(db):
+    record_id = migrations.ObjectId()
+    db["zones"].insert_one({"zone": "example.com", "users": [], "serial": 1, "records": [
+        {"id": record_id, "domain": "WWW", "type": "A", "value": "192.0.2.1", "ttl": "300"}
+    ]})
+
+    migrations.migrate(db)
+    keys = db["record_search"].find_one({"id": record_id})
+    assert (keys["zone"], keys["domain"], keys["type"], keys["value"]) == ("example.com", "www", "a", "192.0.2.1")
+
+
+def test_owners_of_merged_zones_point_at_the_kept_one(db):
+    kept = db["zones"].insert_one({"zone": "example.com", "users": [], "serial": 1, "records": []}).inserted_id
+    removed = db["zones"].insert_one({"zone": "example.com", "users": [], "serial": 1, "records": []}).inserted_id
+    other = migrations.ObjectId()
+    db["users"].insert_many([
+        {"username": "a", "zones": [kept]},
+        {"username": "b", "zones": [other, removed]},
+        {"username": "c", "zones": [kept, removed]},
+    ])
+
+    migrations.migrate(db)
+    assert db["users"].find_one({"username": "a"})["zones"] == [kept]
+    assert db["users"].find_one({"username": "b"})["zones"] == [other, kept]
+    assert db["users"].find_one({"username": "c"})["zones"] == [kept]
@@ -0,0 +1,119 @@
+import asyncio
+import struct
+from datetime import datetime, timedelta
+
+import pytest
+
+from lib import prober
+
+
+def _name(name):
+    return b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00"
+
+
+def _response(query_id, name, answers, rcode=0):
+    """
+    Build a DNS response whose answers point back at the question name
+    :param answers: List of (type, class, rdata)
+    """
+    packet = struct.pack("!HHHHHH", query_id, 0x8400 | rcode, 1, len(answers), 0, 0)
+    packet += _name(name) + struct.pack("!HH", 1, 1)
+    for record_type, record_class, rdata in answers:
+        packet += b"\xc0\x0c" + struct.pack("!HHIH", record_type, record_class, 300, len(rdata)) + rdata
+    return packet
+
+
+def _soa(serial):
+    return _name("ns1.example.com") + b"\xc0\x0c" + struct.pack("!IIIII", serial, 7200, 3600, 1209600, 300)
+
+
+def test_queries_are_encoded_with_one_question():
+    packet = prober._encode_query(0x1234, "example.com.", prober.TYPE_SOA, prober.CLASS_IN)
+    assert packet[:12] == struct.pack("!HHHHHH", 0x1234, 0, 1, 0, 0, 0)
+    assert packet[12:] == _name("example.com") + struct.pack("!HH", prober.TYPE_SOA, prober.CLASS_IN)
+
+
+def test_answers_follow_compressed_names():
+    packet = _response(7, "example.com", [(prober.TYPE_SOA, prober.CLASS_IN, _soa(2024010101))])
+    rcode, answers = prober._decode_answers(packet, 7)
+    assert rcode == 0
+    record_type, offset, rdata = answers[0]
+    assert record_type == prober.TYPE_SOA
+    assert packet[offset:offset + len(rdata)] == rdata
+
+
+def test_mismatched_response_ids_are_rejected():
+    with pytest.raises(ValueError):
+        prober._decode_answers(_response(7, "example.com", []), 8)
+
+
+def _answering(monkeypatch, packet):
+    async def query(address, name, query_type, query_class=prober.CLASS_IN, timeout=2.0):
+        rcode, answers = prober._decode_answers(packet, 7)
+        return rcode, answers, packet, 0.005
+
+    monkeypatch.setattr(prober, "query", query)
+
+
+def test_soa_serial_is_read_after_both_names(monkeypatch):
+    _answering(monkeypatch, _response(7, "example.com", [(prober.TYPE_SOA, prober.CLASS_IN, _soa(2024010101))]))
+    assert asyncio.run(prober.soa_serial("192.0.2.1", "example.com")) == 2024010101
+
+    _answering(monkeypatch, _response(7, "example.com", [], rcode=5))
+    assert asyncio.run(prober.soa_serial("192.0.2.1", "example.com")) is None
+
+
+def test_pop_tag_is_read_from_version_bind(monkeypatch):
+    text = b"PoP-Tag fmt-us"
+    _answering(monkeypatch, _response(7, "version.bind", [(prober.TYPE_TXT, prober.CLASS_CHAOS, bytes([len(text)]) + text)]))
+    tag, seconds = asyncio.run(prober.pop_tag("192.0.2.1"))
+    assert tag == "fmt-us"
+
+
+def _node_answers(monkeypatch, tag, serials):
+    async def pop_tag(address, timeout=2.0):
+        return tag, 0.005
+
+    async def soa_serial(address, zone, timeout=2.0):
+        return serials.get(zone)
+
+    monkeypatch.setattr(prober, "pop_tag", pop_tag)
+    monkeypatch.setattr(prober, "soa_serial", soa_serial)
+
+
+def test_nodes_answering_with_another_tag_are_down(monkeypatch):
+    _node_answers(monkeypatch, "ams-nl", {})
+    health = asyncio.run(prober.probe_node({"uid": "fmt-us", "management": "192.0.2.1"}, {}, asyncio.Semaphore(1)))
+    assert not health["operational"]
+    assert health["error"] == "PoP tag ams-nl doesn't match fmt-us"
+
+
+def test_lagging_and_missing_zones_are_counted(monkeypatch):
+    _node_answers(monkeypatch, "fmt-us", {"a.com": 5, "b.com": 9})
+    health = asyncio.run(prober.probe_node(
+        {"uid": "fmt-us", "management": "192.0.2.1"},
+        {"a.com": 7, "b.com": 9, "c.com": 1},
+        asyncio.Semaphore(2)
+    ))
+    assert health["operational"]
+    assert (health["zones_behind"], health["zones_missing"]) == (1, 1)
+    assert health["lagging"] == [{"zone": "a.com", "lag": 2}]
+
+
+class _Database:
+    def __init__(self):
+        self.changed_since = None
+
+    def get_changed_zones(self, since, limit=1000):
+        self.changed_since = since
+        return ["recent.com", "sampled.com"]
+
+    def get_zone_serials(self, zones=None):
+        return {zone: 1 for zone in zones}
+
+
+def test_sample_and_recently_changed_zones_are_checked():
+    database = _Database()
+    since = datetime.utcnow() - timedelta(seconds=30)
+    assert prober.zones_to_check(database, ["sampled.com", "other.com"], since) == {"recent.com": 1, "sampled.com": 1, "other.com": 1}
+    assert database.changed_since == since
@@ -0,0 +1,121 @@
+import pytest
+
+pytest.importorskip("ansible_runner")
+pytest.importorskip("pymongo")
+
+from lib import pusher  # noqa: E402
+
+
+def _watch(monkeypatch, ticks, **kwargs):
+    """
+    Run watch_changes over (time, changed, deleted) ticks
+    """
+    clock = iter([tick[0] for tick in ticks])
+
+    def changes(db, interval):
+        yield {"first.com"}, set()
+        for _, changed, deleted in ticks:
+            yield changed, deleted
+
+    monkeypatch.setattr(pusher, "_stream_changes", changes)
+    monkeypatch.setattr(pusher.time, "monotonic", lambda: next(clock))
+    return list(pusher.watch_changes(None, **kwargs))
+
+
+def test_batches_are_released_after_a_quiet_debounce_window(monkeypatch):
+    batches = _watch(monkeypatch, [
+        (0, {"a.com"}, set()),
+        (1, {"b.com"}, set()),
+        (2, set(), {"a.com"}),
+        (3, set(), set()),
+        (5, set(), set()),
+    ], debounce=2, max_wait=30)
+
+    assert batches == [({"first.com"}, set()), ({"b.com"}, {"a.com"})]
+
+
+def test_steady_changes_are_released_at_max_wait(monkeypatch):
+    batches = _watch(monkeypatch, [(second, {"zone" + str(second) + ".com"}, set()) for second in range(8)], debounce=2, max_wait=5)
+
+    assert batches[1] == ({"zone" + str(second) + ".com" for second in range(6)}, set())
+
+
+def test_ssh_args_reach_the_nodes():
+    from lib.runner import ssh_args
+
+    assert ssh_args(asn=65000).split() == ["-e", "ansible_port=34553", "-e", "ansible_ssh_private_key_file=ssh-key", "-e", "ansible_user=root", "-e", "asn=65000"]
+
+
+class _Stream:
+    def __init__(self, events):
+        self.events = list(events)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    @property
+    def alive(self):
+        return bool(self.events)
+
+    def try_next(self):
+        return self.events.pop(0)
+
+
+class _Zones:
+    def __init__(self, events, documents):
+        self.events = events
+        self.documents = documents
+        self.pipeline = None
+        self.watch_kwargs = None
+
+    def watch(self, pipeline=None, **kwargs):
+        self.pipeline, self.watch_kwargs = pipeline, kwargs
+        return _Stream(self.events)
+
+    def find_one(self, query, projection=None):
+        return self.documents.get(query["_id"])
+
+
+class _Database:
+    def __init__(self, serials, events=(), documents=None):
+        self.serials = serials
+        self.zones = _Zones(events, documents or {})
+
+    def get_zone_ids(self):
+        return {zone: "id-" + zone for zone in self.serials}
+
+    def get_zone_serials(self, zones=None):
+        return dict(self.serials)
+
+
+@pytest.fixture
+def pushed_state(monkeypatch, tmp_path):
+    monkeypatch.setattr(pusher, "PUSHED_STATE", str(tmp_path / "pushed.json"))
+    return tmp_path / "pushed.json"
+
+
+def test_change_events_are_named_from_the_cache(pushed_state):
+    db = _Database({"a.com": 1}, events=[
+        {"operationType": "update", "documentKey": {"_id": "id-a.com"}},
+        {"operationType": "insert", "documentKey": {"_id": "id-b.com"}, "fullDocument": {"zone": "b.com"}},
+        {"operationType": "replace", "documentKey": {"_id": "id-c.com"}},
+        None,
+        {"operationType": "delete", "documentKey": {"_id": "id-a.com"}},
+    ], documents={"id-c.com": {"zone": "c.com"}})
+
+    changes = list(pusher._stream_changes(db, 1))
+    assert "full_document" not in db.zones.watch_kwargs
+    assert db.zones.pipeline == [{"$project": {"operationType": 1, "documentKey": 1, "fullDocument.zone": 1}}]
+    assert changes == [({"a.com"}, set()), ({"a.com"}, set()), ({"b.com"}, set()), ({"c.com"}, set()), (set(), set()), (set(), {"a.com"})]
+
+
+def test_restarts_only_push_zones_changed_since_the_last_push(pushed_state):
+    db = _Database({"same.com": 3, "newer.com": 5, "added.com": 1})
+    assert next(pusher._poll_changes(db, 1)) == ({"same.com", "newer.com", "added.com"}, set())
+
+    pusher._save_pushed({"same.com": 3, "newer.com": 4, "gone.com": 2})
+    assert next(pusher._poll_changes(db, 1)) == ({"newer.com", "added.com"}, {"gone.com"})
+    assert next(pusher._stream_changes(db, 1)) == ({"newer.com", "added.com"}, {"gone.com"})
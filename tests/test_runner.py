@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("ansible_runner")
+
+from lib import runner  # noqa: E402
+
+
+def test_stages_start_with_a_canary_and_cover_every_host():
+    hosts = ["pop" + str(n) for n in range(20)]
+    assert [len(batch) for batch in runner._stages(hosts, [1, 0.1, 1.0])] == [1, 2, 17]
+    assert sum(runner._stages(hosts, [5]), []) == hosts
+    assert runner._stages(["pop0"], [1, 0.1, 1.0]) == [["pop0"]]
+
+
+class _Run:
+    def __init__(self, failed):
+        self.stats = {"failures": {host: 1 for host in failed}, "dark": {}}
+
+
+class _Thread:
+    def join(self):
+        pass
+
+
+@pytest.fixture
+def runs(monkeypatch, tmp_path):
+    calls = []
+    failing = set()
+
+    def run_async(**kwargs):
+        calls.append(kwargs)
+        return _Thread(), _Run(failing & set(kwargs["limit"].split(",")))
+
+    monkeypatch.setattr(runner.ansible_runner, "run_async", run_async)
+    monkeypatch.setattr(runner, "ROLLOUT_LOG", str(tmp_path / "rollouts.jsonl"))
+    return calls, failing
+
+
+def test_rollouts_pass_ssh_args_by_default(runs):
+    calls, _ = runs
+    runner.rollout("nodes.yml", hosts=["pop0", "pop1"], stages=[1, 1.0], verbose=False)
+
+    assert [call["limit"] for call in calls] == ["pop0", "pop1"]
+    assert all(call["cmdline"] == runner.ssh_args() for call in calls)
+
+
+def test_failed_canaries_stop_the_rollout(runs):
+    calls, failing = runs
+    failing.add("pop0")
+    result = runner.rollout("nodes.yml", hosts=["pop0", "pop1", "pop2"], stages=[1, 1.0], max_failure_rate=0.0, verbose=False)
+
+    assert result["aborted"]
+    assert len(calls) == 1
+    assert (result["failed"], result["succeeded"]) == (["pop0"], [])
+
+
+def test_failures_under_the_rate_keep_going(runs):
+    calls, failing = runs
+    failing.add("pop2")
+    result = runner.rollout("nodes.yml", hosts=["pop0", "pop1", "pop2", "pop3"], stages=[1, 1.0], max_failure_rate=0.5, verbose=False)
+
+    assert not result["aborted"]
+    assert result["succeeded"] == ["pop0", "pop1", "pop3"]